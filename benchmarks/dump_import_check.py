@@ -0,0 +1,75 @@
+"""
+End to end check of the dump import, offline: indexes the sample pages-articles dump in benchmarks/fixtures with
+build_dump_index and imports it with import_wiki (dump_path, so the source is DumpWiki) into in-memory databases.
+The imported articles, center distances and links are compared with the ones the fixture should produce.
+
+    python -m benchmarks.dump_import_check
+"""
+import os
+import shutil
+import sys
+import tempfile
+from typing import Dict, List, Optional, Set, Tuple
+
+import dependencies.databases
+from benchmarks.memory_repos import InMemoryNeo4jRepository, InMemoryElasticRepository
+from dependencies.settings import settings
+from models import ImportSummary
+from wikipedia_dump import build_dump_index
+from wikipedia_import import DUMP_INDEX_SUFFIX, import_wiki
+
+FIXTURE_PATH: str = os.path.join(os.path.dirname(__file__), 'fixtures', 'pages-articles-sample.xml')
+CENTER_TITLE: str = 'Alpha'
+RADIUS: int = 2
+CATEGORIES: List[str] = ['Greek', 'Letters']
+
+# Delta no esta en las categorias, Eta esta a 3 links y Bet es un redirect a Beta
+EXPECTED_CENTER_DISTS: Dict[int, int] = {1: 0, 2: 1, 3: 1, 5: 1, 6: 2}
+EXPECTED_LINKS: Set[Tuple[int, int]] = {(1, 2), (1, 3), (1, 5), (2, 1), (2, 6), (3, 2), (6, 1)}
+
+
+def run_check(workers: int = 1) -> List[str]:
+    """ Imports the fixture and returns the differences with the expected graph (none if the import is correct) """
+    neo: InMemoryNeo4jRepository = InMemoryNeo4jRepository()
+    es: InMemoryElasticRepository = InMemoryElasticRepository()
+    dependencies.databases.neo_attach(neo)
+    dependencies.databases.es_attach(es)
+
+    # Sin cache ni checkpoints: solo el dump
+    settings.wiki_import_cache_dir = None
+    settings.wiki_import_offline = False
+    settings.wiki_import_checkpoint_file = None
+
+    # El indice se crea al lado del dump: se trabaja sobre una copia, para no dejarlo en el repo
+    directory: str = tempfile.mkdtemp(prefix='dump_import_check_')
+    try:
+        dump_path: str = shutil.copy(FIXTURE_PATH, directory)
+        build_dump_index(dump_path, dump_path + DUMP_INDEX_SUFFIX, workers=workers)
+        summary: ImportSummary = import_wiki(CENTER_TITLE, RADIUS, CATEGORIES, dump_path=dump_path)
+    finally:
+        shutil.rmtree(directory)
+
+    errors: List[str] = []
+    center_dists: Dict[int, Optional[int]] = {id: article['center_dist'] for id, article in neo.articles.items()}
+    if center_dists != EXPECTED_CENTER_DISTS:
+        errors.append(f'Articles (id: center_dist) {center_dists}, expected {EXPECTED_CENTER_DISTS}')
+    if neo.links != EXPECTED_LINKS:
+        errors.append(f'Links {sorted(neo.links)}, expected {sorted(EXPECTED_LINKS)}')
+    if summary.total_nodes != len(EXPECTED_CENTER_DISTS):
+        errors.append(f'Summary has {summary.total_nodes} nodes, expected {len(EXPECTED_CENTER_DISTS)}')
+    indexed: Set[int] = {int(id) for id in es.documents}
+    if indexed != set(EXPECTED_CENTER_DISTS):
+        errors.append(f'Indexed documents {sorted(indexed)}, expected {sorted(EXPECTED_CENTER_DISTS)}')
+    return errors
+
+
+def main() -> int:
+    errors: List[str] = run_check()
+    for error in errors:
+        print(error)
+    print('Dump import check failed' if errors else f'Dump import check passed: {len(EXPECTED_CENTER_DISTS)} articles, {len(EXPECTED_LINKS)} links')
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
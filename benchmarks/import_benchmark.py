@@ -0,0 +1,193 @@
+"""
+Import benchmark: runs import_wiki against a synthetic wiki served by a local fake MediaWiki, writing to in-memory
+databases, and reports throughput, API calls and DB round-trips per node and peak memory.
+
+    python -m benchmarks.import_benchmark --articles 20000 --radius 2 --latency 0.05
+"""
+import argparse
+import json
+import resource
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass, asdict, field
+from typing import Any, Dict, List, Optional
+
+import dependencies.databases
+from benchmarks.memory_repos import InMemoryNeo4jRepository, InMemoryElasticRepository
+from benchmarks.synthetic_wiki import SyntheticWiki, SyntheticWikiConfig, FakeMediaWikiServer, CATEGORY_PREFIX
+from dependencies.settings import settings
+from models import ImportSummary
+from wikipedia_import import import_wiki
+
+
+@dataclass
+class BenchmarkResult:
+    nodes: int = 0
+    relationships: int = 0
+    seconds: float = 0
+    nodes_per_second: float = 0
+    api_calls: int = 0
+    api_calls_per_node: float = 0
+    api_calls_by_kind: Dict[str, int] = field(default_factory=dict)
+    api_errors: int = 0
+    neo_round_trips: int = 0
+    es_round_trips: int = 0
+    db_round_trips_per_node: float = 0
+    # Contadores de cada stage del pipeline del import
+    stages: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    # Pico de memoria del proceso (incluye el arranque) y, si se pidio, pico de memoria de Python durante el import
+    peak_rss_mb: float = 0
+    peak_traced_mb: Optional[float] = None
+    # Diferencias contra el resultado esperado segun el grafo sintetico
+    missing_nodes: int = 0
+    unexpected_nodes: int = 0
+    missing_links: int = 0
+    unexpected_links: int = 0
+    wrong_center_dists: int = 0
+    error: Optional[str] = None
+
+
+def run_benchmark(config: SyntheticWikiConfig, radius: int, import_categories: int, latency_seconds: float = 0,
+                  latency_jitter_seconds: float = 0, error_rate: float = 0, async_client: bool = False,
+                  trace_memory: bool = False, validate: bool = True) -> BenchmarkResult:
+    """
+    Imports 'Article 0' with the given radius, filtering by the first import_categories categories of the synthetic wiki.
+    If validate is True, the imported graph is compared with the one the synthetic wiki says should be imported.
+    """
+    categories: List[str] = [f'{CATEGORY_PREFIX}{category}' for category in range(import_categories)]
+    neo: InMemoryNeo4jRepository = InMemoryNeo4jRepository()
+    es: InMemoryElasticRepository = InMemoryElasticRepository()
+    dependencies.databases.neo_attach(neo)
+    dependencies.databases.es_attach(es)
+
+    result: BenchmarkResult = BenchmarkResult()
+    with FakeMediaWikiServer(config, latency_seconds, latency_jitter_seconds, error_rate) as server:
+        # El import usa la configuracion global. Apuntamos al servidor falso, sin cache ni checkpoints.
+        settings.wiki_import_api_url = server.api_url
+        settings.wiki_import_async = async_client
+        settings.wiki_import_cache_dir = None
+        settings.wiki_import_offline = False
+        settings.wiki_import_checkpoint_file = None
+
+        if trace_memory:
+            tracemalloc.start()
+
+        start: float = time.perf_counter()
+        summary: Optional[ImportSummary] = None
+        try:
+            summary = import_wiki(SyntheticWiki(config).article_title(0), radius, categories)
+        except Exception as e:
+            result.error = f'{type(e).__name__}: {e}'
+        result.seconds = time.perf_counter() - start
+
+        if trace_memory:
+            result.peak_traced_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+
+        stats: Dict[str, Any] = server.stats()
+
+    # ru_maxrss esta en KB en Linux
+    result.peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    result.nodes = summary.total_nodes if summary is not None else len(neo.articles)
+    result.relationships = len(neo.links)
+    if summary is not None:
+        result.stages = {name: stage.dict() for name, stage in summary.stages.items()}
+    result.nodes_per_second = result.nodes / result.seconds if result.seconds > 0 else 0
+    result.api_calls_by_kind = dict(stats['requests'])
+    result.api_calls = sum(stats['requests'].values())
+    result.api_errors = sum(stats['errors'].values())
+    result.neo_round_trips = neo.round_trips
+    result.es_round_trips = es.round_trips
+    if result.nodes > 0:
+        result.api_calls_per_node = result.api_calls / result.nodes
+        result.db_round_trips_per_node = (neo.round_trips + es.round_trips) / result.nodes
+
+    if validate and result.error is None:
+        wiki: SyntheticWiki = SyntheticWiki(config)
+        expected_nodes, expected_links = wiki.expected_import(radius, categories)
+        expected_ids = {index + 1 for index in expected_nodes}
+        imported_ids = set(neo.articles)
+        result.missing_nodes = len(expected_ids - imported_ids)
+        result.unexpected_nodes = len(imported_ids - expected_ids)
+        result.wrong_center_dists = sum(
+            1 for index, dist in expected_nodes.items() if index + 1 in neo.articles and neo.articles[index + 1]['center_dist'] != dist
+        )
+
+        # El pageid es el indice + 1
+        expected_id_links = {(source + 1, dest + 1) for source, dest in expected_links}
+        result.missing_links = len(expected_id_links - neo.links)
+        result.unexpected_links = len(neo.links - expected_id_links)
+
+    return result
+
+
+def _print_report(result: BenchmarkResult) -> None:
+    print(f'Nodes:                   {result.nodes}')
+    print(f'Relationships:           {result.relationships}')
+    print(f'Seconds:                 {result.seconds:.2f}')
+    print(f'Nodes/sec:               {result.nodes_per_second:.1f}')
+    print(f'API calls:               {result.api_calls} ({result.api_calls_per_node:.3f} per node, {result.api_errors} failed)')
+    for kind, calls in sorted(result.api_calls_by_kind.items()):
+        print(f'    {kind}: {calls}')
+    print(f'DB round-trips:          neo {result.neo_round_trips}, es {result.es_round_trips} ({result.db_round_trips_per_node:.3f} per node)')
+    for name, stage in result.stages.items():
+        print(f'Stage {name + ":":<18}{stage["items"]} items, {stage["items_per_second"]:.1f}/sec busy, '
+              f'{stage["seconds_busy"]:.2f}s busy, import waited {stage["seconds_waiting"]:.2f}s')
+    print(f'Peak RSS:                {result.peak_rss_mb:.1f} MB')
+    if result.peak_traced_mb is not None:
+        print(f'Peak Python memory:      {result.peak_traced_mb:.1f} MB')
+    print(f'Validation:              {result.missing_nodes} missing / {result.unexpected_nodes} unexpected nodes, '
+          f'{result.missing_links} missing / {result.unexpected_links} unexpected links, {result.wrong_center_dists} wrong center distances')
+    if result.error is not None:
+        print(f'Import failed:           {result.error}')
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    defaults: SyntheticWikiConfig = SyntheticWikiConfig()
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(description='Benchmarks import_wiki against a synthetic wiki')
+    parser.add_argument('--articles', type=int, default=defaults.articles)
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+    parser.add_argument('--min-links', type=int, default=defaults.min_links)
+    parser.add_argument('--max-links', type=int, default=defaults.max_links)
+    parser.add_argument('--alpha', type=float, default=defaults.power_law_alpha, help='Power law exponent of the amount of links')
+    parser.add_argument('--skew', type=float, default=defaults.popularity_skew, help='How concentrated links are on popular articles')
+    parser.add_argument('--categories', type=int, default=defaults.categories)
+    parser.add_argument('--categories-per-article', type=int, default=defaults.categories_per_article)
+    parser.add_argument('--redirect-rate', type=float, default=defaults.redirect_rate)
+    parser.add_argument('--missing-rate', type=float, default=defaults.missing_rate)
+    parser.add_argument('--disambiguation-rate', type=float, default=defaults.disambiguation_rate)
+    parser.add_argument('--content-bytes', type=int, default=defaults.content_bytes)
+    parser.add_argument('--radius', type=int, default=2)
+    parser.add_argument('--import-categories', type=int, default=defaults.categories // 2, help='Import the first N categories')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds every API request takes')
+    parser.add_argument('--jitter', type=float, default=0, help='Max random seconds added to the latency')
+    parser.add_argument('--error-rate', type=float, default=0, help='Proportion of API requests that fail')
+    parser.add_argument('--async-client', action='store_true', help='Use the asyncio MediaWiki client')
+    parser.add_argument('--trace-memory', action='store_true', help='Measure peak Python memory with tracemalloc (slower)')
+    parser.add_argument('--no-validate', action='store_true', help="Don't compare the imported graph with the expected one")
+    parser.add_argument('--json', action='store_true', help='Print the result as json')
+    args = parser.parse_args(argv)
+
+    config: SyntheticWikiConfig = SyntheticWikiConfig(
+        articles=args.articles, seed=args.seed, min_links=args.min_links, max_links=args.max_links, power_law_alpha=args.alpha,
+        popularity_skew=args.skew, categories=args.categories, categories_per_article=args.categories_per_article,
+        redirect_rate=args.redirect_rate, missing_rate=args.missing_rate, disambiguation_rate=args.disambiguation_rate,
+        content_bytes=args.content_bytes
+    )
+    result: BenchmarkResult = run_benchmark(
+        config, args.radius, args.import_categories, args.latency, args.jitter, args.error_rate, args.async_client,
+        args.trace_memory, not args.no_validate
+    )
+
+    if args.json:
+        print(json.dumps(asdict(result)))
+    else:
+        _print_report(result)
+
+    mismatches: int = result.missing_nodes + result.unexpected_nodes + result.missing_links + result.unexpected_links + result.wrong_center_dists
+    return 1 if result.error is not None or mismatches > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,196 @@
+import json
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
+
+from elasticsearch.serializer import JSONSerializer
+from elasticsearch_dsl import Index
+
+from repositories.elastic_repo import ElasticRepository
+from repositories.neo4j_repo import Neo4jRepository
+
+
+class RecordingSession:
+    """ Stand-in for a neo4j Session: every transaction is a round-trip to the database """
+
+    def __init__(self, repo: 'InMemoryNeo4jRepository') -> None:
+        self.repo = repo
+
+    def write_transaction(self, work: Callable, *args, **kwargs) -> Any:
+        return self._run(work, *args, **kwargs)
+
+    def read_transaction(self, work: Callable, *args, **kwargs) -> Any:
+        return self._run(work, *args, **kwargs)
+
+    def _run(self, work: Callable, *args, **kwargs) -> Any:
+        self.repo.round_trips += 1
+        self.repo.calls[getattr(work, '__name__', 'transaction')] += 1
+        return work(None, *args, **kwargs)
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self) -> 'RecordingSession':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+
+class InMemoryNeo4jRepository(Neo4jRepository):
+    """
+    Neo4jRepository that keeps the graph in memory, for benchmarks.
+    The importer's transactions (the ones Neo4jBulkWriter runs) are reimplemented over dicts, and every transaction is
+    recorded in round_trips and, by name, in calls.
+    """
+    articles: Dict[int, Dict[str, Any]]
+    title_ids: Dict[str, int]
+    links: Set[Tuple[int, int]]
+    # Cantidad de referencias de cada relacion
+    link_counts: Dict[Tuple[int, int], int]
+    round_trips: int
+    calls: Counter
+
+    def __init__(self) -> None:
+        self.articles = {}
+        self.title_ids = {}
+        self.links = set()
+        self.link_counts = {}
+        self.round_trips = 0
+        self.calls = Counter()
+
+    def session(self) -> RecordingSession:
+        return RecordingSession(self)
+
+    def close(self) -> None:
+        pass
+
+    def truncate_db(self, session: Optional[RecordingSession] = None) -> None:
+        (session or self.session()).write_transaction(self._truncate_db)
+
+    def _truncate_db(self, tx) -> None:
+        self.articles.clear()
+        self.title_ids.clear()
+        self.links.clear()
+        self.link_counts.clear()
+
+    def _create_articles(self, tx, rows: List[Dict[str, Any]]) -> int:
+        created: int = 0
+        for row in rows:
+            if row['id'] not in self.articles:
+                created += 1
+            elif row['relink']:
+                self.links = {link for link in self.links if link[0] != row['id']}
+                self.link_counts = {link: count for link, count in self.link_counts.items() if link in self.links}
+            self.articles[row['id']] = {
+                'title': row['title'], 'categories': row['categories'], 'revision_id': row['revision_id'], 'center_dist': row['center_dist']
+            }
+            self.title_ids[row['title']] = row['id']
+        return created
+
+    def _link_articles(self, tx, rows: List[Dict[str, Any]]) -> int:
+        created: int = 0
+        for row in rows:
+            dest_id: Optional[int] = self.title_ids.get(row['dest_title'], None)
+            link: Tuple[int, int] = (row['source_id'], dest_id)
+            if row['source_id'] in self.articles and dest_id is not None:
+                if link not in self.links:
+                    self.links.add(link)
+                    created += 1
+                self.link_counts[link] = max(self.link_counts.get(link, 0), row['count'])
+        return created
+
+    def _set_center_dists(self, tx, rows: List[Dict[str, Any]]) -> None:
+        for row in rows:
+            if row['id'] in self.articles:
+                self.articles[row['id']]['center_dist'] = row['center_dist']
+
+    def get_article_revisions(self) -> Dict[str, Tuple[int, Optional[int]]]:
+        return self.session().read_transaction(self._get_article_revisions)
+
+    def _get_article_revisions(self, tx) -> Dict[str, Tuple[int, Optional[int]]]:
+        return {article['title']: (id, article['revision_id']) for id, article in self.articles.items()}
+
+    def delete_articles(self, articles: List[Tuple[int, str]], session: Optional[RecordingSession] = None) -> List[int]:
+        return (session or self.session()).write_transaction(self._delete_articles, articles)
+
+    def _delete_articles(self, tx, articles: List[Tuple[int, str]]) -> List[int]:
+        deleted: List[int] = [id for id, title in articles if id in self.articles and self.articles[id]['title'] == title]
+        for id in deleted:
+            del self.title_ids[self.articles.pop(id)['title']]
+        self.links = {link for link in self.links if link[0] in self.articles and link[1] in self.articles}
+        self.link_counts = {link: count for link, count in self.link_counts.items() if link in self.links}
+        return deleted
+
+
+class RecordingElasticClient:
+    """ Stand-in for the Elasticsearch client, with only the bulk API the importer uses """
+
+    def __init__(self, repo: 'InMemoryElasticRepository') -> None:
+        self.repo = repo
+        # streaming_bulk serializa las acciones con el serializer del cliente
+        self.transport = self
+        self.serializer = JSONSerializer()
+
+    def bulk(self, body: Union[str, bytes], *args, **kwargs) -> Dict[str, Any]:
+        self.repo.round_trips += 1
+        self.repo.calls['bulk'] += 1
+
+        lines: List[str] = [line for line in (body.decode() if isinstance(body, bytes) else body).split('\n') if line]
+        items: List[Dict[str, Any]] = []
+        i: int = 0
+        while i < len(lines):
+            action, meta = next(iter(json.loads(lines[i]).items()))
+            if action == 'delete':
+                found: bool = self.repo.documents.pop(str(meta['_id']), None) is not None
+                items.append({action: {'_id': meta['_id'], 'status': 200 if found else 404}})
+                i += 1
+            else:
+                self.repo.documents[str(meta['_id'])] = json.loads(lines[i + 1])
+                items.append({action: {'_id': meta['_id'], 'status': 201}})
+                i += 2
+        return {'took': 0, 'errors': False, 'items': items}
+
+
+class InMemoryElasticRepository(ElasticRepository):
+    """
+    ElasticRepository that keeps the documents in memory, for benchmarks.
+    Bulk requests, settings updates and refreshes are recorded in round_trips and, by name, in calls.
+    """
+    documents: Dict[str, Dict[str, Any]]
+    round_trips: int
+    calls: Counter
+
+    def __init__(self, index: str = 'wikipedia') -> None:
+        self.repo_id = 'wiki_es_memory'
+        # El indice solo se usa por su nombre, nunca se conecta
+        self.index = Index(index)
+        self.documents = {}
+        self.round_trips = 0
+        self.calls = Counter()
+        self._client: RecordingElasticClient = RecordingElasticClient(self)
+        self._settings: Dict[str, Any] = {'refresh_interval': None, 'number_of_replicas': None}
+
+    def _record(self, call: str) -> None:
+        self.round_trips += 1
+        self.calls[call] += 1
+
+    def client(self) -> RecordingElasticClient:
+        return self._client
+
+    def close(self) -> None:
+        pass
+
+    def truncate_db(self) -> None:
+        self._record('truncate_db')
+        self.documents.clear()
+
+    def get_import_settings(self) -> Dict[str, Any]:
+        self._record('get_settings')
+        return dict(self._settings)
+
+    def put_import_settings(self, refresh_interval: Optional[str], number_of_replicas: Optional[Union[str, int]]) -> None:
+        self._record('put_settings')
+        self._settings = {'refresh_interval': refresh_interval, 'number_of_replicas': number_of_replicas}
+
+    def refresh(self) -> None:
+        self._record('refresh')
@@ -0,0 +1,275 @@
+"""
+Search concurrency benchmark: serves the app with uvicorn over databases that answer after a fixed latency (blocking,
+like the real drivers), sends concurrent searches and reports their latency percentiles and throughput. A probe
+requests a trivial endpoint meanwhile, to measure how long the searches stall the rest of the server.
+
+    python -m benchmarks.search_benchmark --requests 400 --concurrency 32 --neo-latency 0.03 --es-latency 0.02
+
+With --embedded-es, elastic is replaced by the embedded index (EmbeddedElasticRepository) over synthetic articles
+instead of a fixed latency.
+"""
+import argparse
+import asyncio
+import json
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, asdict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import aiohttp
+import uvicorn
+from neo4j.data import Record
+
+import dependencies.databases
+from dependencies.settings import settings
+from models import ArticleCount, ElasticFilter, ElasticQueryProfile, GeneralFilter, NeoFilter, Neo4jQueryProfile, QueryReturnTypes
+from repositories.elastic_repo import ElasticRepository
+from repositories.embedded_elastic_repo import EmbeddedElasticRepository
+from repositories.neo4j_repo import Neo4jFinalBuilder, Neo4jRepository, Neo4jReturnBuilder
+
+CENTER_TITLE: str = 'Article 0'
+
+
+class SlowNeo4jRepository(Neo4jRepository):
+    """
+    Neo4jRepository whose queries block for latency_seconds and return made up results: candidates ids for
+    candidate queries and page_size rows for the rest. A slow_rate proportion of the queries take slow_latency_seconds.
+    """
+
+    def __init__(self, latency_seconds: float, slow_rate: float, slow_latency_seconds: float, candidates: int, page_size: int,
+                 seed: int = 0) -> None:
+        self.latency_seconds = latency_seconds
+        self.slow_rate = slow_rate
+        self.slow_latency_seconds = slow_latency_seconds
+        self.candidates = candidates
+        self.page_size = page_size
+        self._random: random.Random = random.Random(seed)
+        self._lock: threading.Lock = threading.Lock()
+
+    def close(self) -> None:
+        pass
+
+    def center_title(self) -> Optional[str]:
+        return CENTER_TITLE
+
+    def estimate_cardinality(self, neo_filters: List[NeoFilter], general_filters: List[GeneralFilter]) -> int:
+        time.sleep(self.latency_seconds)
+        return self.candidates
+
+    def executeQuery(self, query: Neo4jFinalBuilder, profile: Optional[Neo4jQueryProfile] = None) -> Any:
+        self._wait()
+        if isinstance(query, Neo4jReturnBuilder) and query.type == QueryReturnTypes.COUNT:
+            return ArticleCount(count=self.candidates)
+        return list(range(1, self.candidates + 1))
+
+    def streamQuery(self, query: Neo4jFinalBuilder, profile: Optional[Neo4jQueryProfile] = None) -> Iterator[Record]:
+        self._wait()
+        nodes: bool = isinstance(query, Neo4jReturnBuilder) and query.type == QueryReturnTypes.NODE
+        for id in range(1, self.page_size + 1):
+            row: Any = {'article_id': id, 'title': f'Article {id}', 'categories': [], 'links': []} if nodes else id
+            yield Record({'row': row, 'sort_key': id, 'sort_id': id, 'page_rows': self.page_size})
+
+    def _wait(self) -> None:
+        with self._lock:
+            slow: bool = self._random.random() < self.slow_rate
+        time.sleep(self.slow_latency_seconds if slow else self.latency_seconds)
+
+
+class SlowElasticRepository(ElasticRepository):
+    """ ElasticRepository whose requests block for latency_seconds. Every search matches the first matches articles """
+
+    def __init__(self, latency_seconds: float, matches: int) -> None:
+        self.latency_seconds = latency_seconds
+        self.matches = matches
+
+    def close(self) -> None:
+        pass
+
+    def count(self, filters: List[ElasticFilter]) -> int:
+        time.sleep(self.latency_seconds)
+        return self.matches
+
+    def get_contents(self, ids: List[int]) -> Dict[int, str]:
+        time.sleep(self.latency_seconds)
+        return {id: f'Content of article {id}' for id in ids if id <= self.matches}
+
+    def search(self, filters: List[ElasticFilter], with_content: bool = False, ids: Optional[List[int]] = None) -> Iterator[Any]:
+        time.sleep(self.latency_seconds)
+        found: List[int] = [id for id in ids if id <= self.matches] if ids is not None else list(range(1, self.matches + 1))
+        return iter([(id, f'Content of article {id}') for id in found] if with_content else found)
+
+    def search_profiled(self, stage: str, filters: List[ElasticFilter], ids: Optional[List[int]] = None) -> Tuple[List[int], ElasticQueryProfile]:
+        found: List[int] = list(self.search(filters, False, ids))
+        return found, ElasticQueryProfile(stage=stage, took=int(self.latency_seconds * 1000), hits=len(found))
+
+
+def _embedded_elastic(path: str, matches: int) -> EmbeddedElasticRepository:
+    """ Embedded index with 2 * matches articles. The first matches of them (by id) mention the benchmark """
+    repo: EmbeddedElasticRepository = EmbeddedElasticRepository(path, 'wikipedia')
+    with repo.bulk_indexer() as indexer:
+        for id in range(1, 2 * matches + 1):
+            topic: str = 'benchmark' if id <= matches else 'something else'
+            indexer.create_article(id, f'Article {id}', f'Content of article {id}, about {topic}', [])
+    return repo
+
+
+@dataclass
+class SearchBenchmarkResult:
+    requests: int = 0
+    failed: int = 0
+    seconds: float = 0
+    requests_per_second: float = 0
+    p50_ms: float = 0
+    p95_ms: float = 0
+    p99_ms: float = 0
+    max_ms: float = 0
+    # Latencia de un endpoint trivial mientras corren las busquedas
+    probe_p50_ms: float = 0
+    probe_p99_ms: float = 0
+    probe_max_ms: float = 0
+
+
+def _percentile(values: List[float], percentile: float) -> float:
+    if not values:
+        return 0
+    ordered: List[float] = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))] * 1000
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _search_query(page_size: int, with_content: bool) -> Dict[str, Any]:
+    return {
+        'return_type': QueryReturnTypes.NODE_WITH_CONTENT.value if with_content else QueryReturnTypes.ID.value,
+        'elastic_filter': [{'field': 'CONTENT', 'matches': ['benchmark']}],
+        'neo_filter': [{'source_node': CENTER_TITLE, 'dist': 2}],
+        'limit': page_size,
+    }
+
+
+async def _load(url: str, body: Dict[str, Any], requests: int, concurrency: int, probe_seconds: float) -> SearchBenchmarkResult:
+    latencies: List[float] = []
+    probes: List[float] = []
+    failed: int = 0
+    remaining: int = requests
+    done: asyncio.Event = asyncio.Event()
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency + 1)) as session:
+        async def worker() -> None:
+            nonlocal remaining, failed
+            while remaining > 0:
+                remaining -= 1
+                start: float = time.perf_counter()
+                async with session.get(f'{url}/api/search', json=body) as response:
+                    await response.read()
+                    if response.status != 200:
+                        failed += 1
+                latencies.append(time.perf_counter() - start)
+
+        async def probe() -> None:
+            while not done.is_set():
+                start: float = time.perf_counter()
+                async with session.get(f'{url}/api/import/jobs') as response:
+                    await response.read()
+                probes.append(time.perf_counter() - start)
+                await asyncio.sleep(probe_seconds)
+
+        start: float = time.perf_counter()
+        probe_task: asyncio.Task = asyncio.ensure_future(probe())
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        seconds: float = time.perf_counter() - start
+        done.set()
+        await probe_task
+
+    return SearchBenchmarkResult(
+        requests=len(latencies), failed=failed, seconds=seconds, requests_per_second=len(latencies) / seconds if seconds > 0 else 0,
+        p50_ms=_percentile(latencies, 50), p95_ms=_percentile(latencies, 95), p99_ms=_percentile(latencies, 99),
+        max_ms=_percentile(latencies, 100), probe_p50_ms=_percentile(probes, 50), probe_p99_ms=_percentile(probes, 99),
+        probe_max_ms=_percentile(probes, 100),
+    )
+
+
+def run_benchmark(requests: int, concurrency: int, neo_latency_seconds: float, es_latency_seconds: float, slow_rate: float = 0,
+                  slow_latency_seconds: float = 0, candidates: int = 500, matches: int = 5000, page_size: int = 100,
+                  with_content: bool = False, workers: Optional[int] = None, embedded_es: bool = False) -> SearchBenchmarkResult:
+    """
+    Sends requests searches, concurrency at a time, to the app served on a local port. The searches combine an elastic
+    filter (matches articles) and a distance filter (candidates articles), so both databases are queried.
+    """
+    import main  # La app registra los endpoints al importarse
+
+    if workers is not None:
+        settings.wiki_search_workers = workers
+    dependencies.databases.neo_attach(SlowNeo4jRepository(neo_latency_seconds, slow_rate, slow_latency_seconds, candidates, page_size))
+    embedded_path: Optional[str] = tempfile.mkdtemp(prefix='search_benchmark_') if embedded_es else None
+    dependencies.databases.es_attach(
+        _embedded_elastic(embedded_path, matches) if embedded_path is not None else SlowElasticRepository(es_latency_seconds, matches)
+    )
+
+    port: int = _free_port()
+    server: uvicorn.Server = uvicorn.Server(uvicorn.Config(main.app, host='127.0.0.1', port=port, log_level='warning'))
+    thread: threading.Thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+
+    try:
+        return asyncio.run(_load(f'http://127.0.0.1:{port}', _search_query(page_size, with_content), requests, concurrency, 0.01))
+    finally:
+        server.should_exit = True
+        thread.join()
+        dependencies.databases.close_all()
+        if embedded_path is not None:
+            shutil.rmtree(embedded_path)
+
+
+def _print_report(result: SearchBenchmarkResult) -> None:
+    print(f'Searches:                {result.requests} ({result.failed} failed)')
+    print(f'Seconds:                 {result.seconds:.2f}')
+    print(f'Searches/sec:            {result.requests_per_second:.1f}')
+    print(f'Search latency:          p50 {result.p50_ms:.1f} ms, p95 {result.p95_ms:.1f} ms, p99 {result.p99_ms:.1f} ms, '
+          f'max {result.max_ms:.1f} ms')
+    print(f'Probe latency:           p50 {result.probe_p50_ms:.1f} ms, p99 {result.probe_p99_ms:.1f} ms, max {result.probe_max_ms:.1f} ms')
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(description='Benchmarks concurrent searches against slow databases')
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--neo-latency', type=float, default=0.03, help='Seconds every Neo4j query takes')
+    parser.add_argument('--es-latency', type=float, default=0.02, help='Seconds every elastic request takes')
+    parser.add_argument('--slow-rate', type=float, default=0, help='Proportion of Neo4j queries that are slow')
+    parser.add_argument('--slow-latency', type=float, default=1, help='Seconds a slow Neo4j query takes')
+    parser.add_argument('--candidates', type=int, default=500, help='Articles matching the Neo4j filters')
+    parser.add_argument('--matches', type=int, default=5000, help='Articles matching the elastic filters')
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--with-content', action='store_true', help='Search NODE_WITH_CONTENT instead of ids')
+    parser.add_argument('--workers', type=int, default=None, help='Search executor size (WIKI_SEARCH_WORKERS)')
+    parser.add_argument('--embedded-es', action='store_true', help='Search the embedded index instead of a slow elastic')
+    parser.add_argument('--json', action='store_true', help='Print the result as json')
+    args = parser.parse_args(argv)
+
+    result: SearchBenchmarkResult = run_benchmark(
+        args.requests, args.concurrency, args.neo_latency, args.es_latency, args.slow_rate, args.slow_latency, args.candidates,
+        args.matches, args.page_size, args.with_content, args.workers, args.embedded_es
+    )
+
+    if args.json:
+        print(json.dumps(asdict(result)))
+    else:
+        _print_report(result)
+
+    return 1 if result.failed > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
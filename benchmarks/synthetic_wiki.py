@@ -0,0 +1,348 @@
+import asyncio
+import json
+import multiprocessing
+import random
+import urllib.request
+from collections import Counter, deque
+from dataclasses import dataclass, asdict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from aiohttp import web
+
+ARTICLE_PREFIX: str = 'Article '
+REDIRECT_PREFIX: str = 'Redirect to Article '
+MISSING_PREFIX: str = 'Missing article '
+CATEGORY_PREFIX: str = 'Topic '
+MAX_LIMIT: int = 500            # Limite de 'max' de la API para usuarios comunes
+FILLER: str = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore. '
+
+
+@dataclass
+class SyntheticWikiConfig:
+    articles: int = 5000
+    seed: int = 0
+    # Cantidad de links salientes: ley de potencias (Pareto) entre min_links y max_links
+    min_links: int = 5
+    max_links: int = 1000
+    power_law_alpha: float = 1.5
+    # Los links apuntan mas a los primeros articulos (los mas populares). Cuanto mas grande, mas concentrados.
+    popularity_skew: float = 2.0
+    categories: int = 20
+    categories_per_article: int = 2
+    # Proporcion de links que pasan por una redireccion o que apuntan a paginas que no existen
+    redirect_rate: float = 0.05
+    missing_rate: float = 0.02
+    disambiguation_rate: float = 0.01
+    content_bytes: int = 2000
+
+
+class SyntheticWiki:
+    """
+    Deterministic, seeded wiki with a power-law link graph.
+    Articles are 'Article <i>' (pageid i + 1), the most linked ones being the first. Every article has a few 'Topic <k>'
+    categories, some links go through 'Redirect to Article <i>' redirects or to missing pages, and some articles are
+    disambiguation pages. Nothing is stored: each article is generated from the seed when requested.
+    api() answers the MediaWiki API queries the importer makes, including limits and continuations.
+    """
+    config: SyntheticWikiConfig
+
+    def __init__(self, config: SyntheticWikiConfig) -> None:
+        self.config = config
+
+    def _rng(self, index: int) -> random.Random:
+        return random.Random(self.config.seed * 1_000_003 + index)
+
+    def _target(self, rng: random.Random) -> int:
+        return int(self.config.articles * rng.random() ** self.config.popularity_skew)
+
+    def article_title(self, index: int) -> str:
+        return f'{ARTICLE_PREFIX}{index}'
+
+    def article_index(self, title: str) -> Optional[int]:
+        if not title.startswith(ARTICLE_PREFIX):
+            return None
+        number: str = title[len(ARTICLE_PREFIX):]
+        if not number.isdigit() or str(int(number)) != number or int(number) >= self.config.articles:
+            return None
+        return int(number)
+
+    def is_disambiguation(self, index: int) -> bool:
+        # El centro nunca es una desambiguacion
+        return index != 0 and self._rng(-index - 1).random() < self.config.disambiguation_rate
+
+    def categories(self, index: int) -> List[str]:
+        rng: random.Random = self._rng(-index - 1)
+        rng.random()
+        amount: int = min(self.config.categories_per_article, self.config.categories)
+        chosen: Set[int] = set()
+        while len(chosen) < amount:
+            chosen.add(int(self.config.categories * rng.random() ** self.config.popularity_skew))
+        return sorted(f'{CATEGORY_PREFIX}{category}' for category in chosen)
+
+    def links(self, index: int) -> List[str]:
+        rng: random.Random = self._rng(index)
+        amount: int = min(self.config.max_links, int(self.config.min_links * rng.paretovariate(self.config.power_law_alpha)))
+
+        links: Set[str] = set()
+        for _ in range(amount):
+            kind: float = rng.random()
+            if kind < self.config.missing_rate:
+                links.add(f'{MISSING_PREFIX}{rng.randrange(self.config.articles * 10)}')
+            elif kind < self.config.missing_rate + self.config.redirect_rate:
+                links.add(f'{REDIRECT_PREFIX}{self._target(rng)}')
+            else:
+                links.add(self.article_title(self._target(rng)))
+        return sorted(links)
+
+    def wikitext(self, index: int) -> str:
+        title: str = self.article_title(index)
+        parts: List[str] = [f"'''{title}''' is a synthetic article.\n\n"]
+        size: int = len(parts[0])
+        for link in self.links(index):
+            sentence: str = f'See [[{link}]]. '
+            parts.append(sentence)
+            size += len(sentence)
+        while size < self.config.content_bytes:
+            parts.append(FILLER)
+            size += len(FILLER)
+        parts.extend(f'\n[[Category:{category}]]' for category in self.categories(index))
+        return ''.join(parts)
+
+    def resolve(self, title: str) -> Optional[int]:
+        """ The index of the article the title leads to, following redirects. None if it doesn't exist """
+        if title.startswith(REDIRECT_PREFIX):
+            title = ARTICLE_PREFIX + title[len(REDIRECT_PREFIX):]
+        return self.article_index(title)
+
+    def expected_import(self, radius: int, categories: List[str]) -> Tuple[Dict[int, int], Set[Tuple[int, int]]]:
+        """ The articles (with their distance to the center) and links a correct import from 'Article 0' should produce, as article indices """
+        wanted: Set[str] = set(categories)
+
+        def valid(index: int) -> bool:
+            return not self.is_disambiguation(index) and not wanted.isdisjoint(self.categories(index))
+
+        dists: Dict[int, int] = {0: 0}
+        queue: deque = deque([0])
+        while queue:
+            index: int = queue.popleft()
+            if dists[index] == radius:
+                continue
+            for link in self.links(index):
+                target: Optional[int] = self.resolve(link)
+                if target is not None and target not in dists and valid(target):
+                    dists[target] = dists[index] + 1
+                    queue.append(target)
+
+        links: Set[Tuple[int, int]] = set()
+        for index in dists:
+            for link in self.links(index):
+                target = self.resolve(link)
+                if target is not None and target != index and target in dists:
+                    links.add((index, target))
+        return dists, links
+
+    # API
+
+    def api(self, params: Dict[str, str]) -> Dict[str, Any]:
+        if params.get('action', 'query') != 'query':
+            return {'error': {'code': 'badvalue', 'info': f'Unsupported action {params["action"]}'}}
+
+        query: Dict[str, Any] = {}
+        response: Dict[str, Any] = {'batchcomplete': '', 'query': query}
+        if 'meta' in params:
+            self._siteinfo(params, query)
+        if 'titles' in params:
+            continues: Dict[str, str] = self._pages(params, query)
+            if continues:
+                del response['batchcomplete']
+                response['continue'] = {**continues, 'continue': '||'}
+        return response
+
+    @staticmethod
+    def _siteinfo(params: Dict[str, str], query: Dict[str, Any]) -> None:
+        props: Set[str] = set(params.get('siprop', 'general').split('|'))
+        if 'general' in props:
+            query['general'] = {'mainpage': 'Article 0', 'sitename': 'Synthetic', 'generator': 'MediaWiki 1.36.0', 'server': 'http://localhost', 'base': 'http://localhost/wiki/Article_0'}
+        if 'extensions' in props:
+            query['extensions'] = []
+        if 'namespaces' in props:
+            query['namespaces'] = {'0': {'id': 0, '*': ''}, '6': {'id': 6, '*': 'File'}, '14': {'id': 14, '*': 'Category'}}
+
+    def _pages(self, params: Dict[str, str], query: Dict[str, Any]) -> Dict[str, str]:
+        props: Set[str] = set(params.get('prop', '').split('|')) - {''}
+        # En una continuacion solo siguen los modulos que no terminaron
+        continuation: bool = 'continue' in params
+        pages: Dict[str, Dict[str, Any]] = {}
+        articles: List[Tuple[int, Dict[str, Any]]] = []
+        missing_id: int = -1
+
+        for title in params['titles'].split('|'):
+            normalized: str = title.replace('_', ' ')
+            normalized = normalized[:1].upper() + normalized[1:]
+            if normalized != title:
+                query.setdefault('normalized', []).append({'from': title, 'to': normalized})
+
+            if normalized.startswith(REDIRECT_PREFIX) and 'redirects' in params:
+                target: str = ARTICLE_PREFIX + normalized[len(REDIRECT_PREFIX):]
+                query.setdefault('redirects', []).append({'from': normalized, 'to': target})
+                normalized = target
+
+            index: Optional[int] = self.article_index(normalized)
+            if index is None:
+                pages[str(missing_id)] = {'ns': 0, 'title': normalized, 'missing': ''}
+                missing_id -= 1
+                continue
+
+            page: Dict[str, Any] = {'pageid': index + 1, 'ns': 0, 'title': normalized}
+            pages[str(index + 1)] = page
+            articles.append((index, page))
+
+            if not continuation and 'revisions' in props:
+                revision: Dict[str, Any] = {'revid': 1000 + index}
+                if 'content' in params.get('rvprop', ''):
+                    revision['slots'] = {'main': {'contentmodel': 'wikitext', 'contentformat': 'text/x-wiki', '*': self.wikitext(index)}}
+                page['revisions'] = [revision]
+            if not continuation and 'pageprops' in props and self.is_disambiguation(index):
+                page['pageprops'] = {'disambiguation': ''}
+
+        query['pages'] = pages
+
+        # Los links y las categorias tienen un limite por request, compartido entre todas las paginas
+        continues: Dict[str, str] = {}
+        articles.sort(key=lambda article: article[0])
+        if 'links' in props and (not continuation or 'plcontinue' in params):
+            wanted_links: List[Tuple[int, Dict[str, Any], List[str]]] = [(index, page, self.links(index)) for index, page in articles]
+            self._limited(wanted_links, 'links', params.get('pllimit', '10'), params.get('plcontinue'), 'plcontinue', continues)
+        if 'categories' in props and (not continuation or 'clcontinue' in params):
+            filter_categories: Optional[Set[str]] = None
+            if 'clcategories' in params:
+                filter_categories = {category.split(':', 1)[-1] for category in params['clcategories'].split('|')}
+            wanted_categories: List[Tuple[int, Dict[str, Any], List[str]]] = [
+                (index, page, ['Category:' + category for category in self.categories(index) if filter_categories is None or category in filter_categories])
+                for index, page in articles
+            ]
+            self._limited(wanted_categories, 'categories', params.get('cllimit', '10'), params.get('clcontinue'), 'clcontinue', continues)
+
+        return continues
+
+    @staticmethod
+    def _limited(items: List[Tuple[int, Dict[str, Any], List[str]]], key: str, limit_param: str, continue_from: Optional[str],
+                 continue_key: str, continues: Dict[str, str]) -> None:
+        limit: int = MAX_LIMIT if limit_param == 'max' else min(int(limit_param), MAX_LIMIT)
+        start_index, start_offset = (int(part) for part in continue_from.split('|')) if continue_from else (-1, 0)
+
+        emitted: int = 0
+        for index, page, values in items:
+            if index < start_index:
+                continue
+            offset: int = start_offset if index == start_index else 0
+            while offset < len(values):
+                if emitted == limit:
+                    continues[continue_key] = f'{index}|{offset}'
+                    return
+                page.setdefault(key, []).append({'ns': 14 if key == 'categories' else 0, 'title': values[offset]})
+                offset += 1
+                emitted += 1
+
+
+class FakeMediaWikiServer:
+    """
+    Serves a SyntheticWiki as a MediaWiki API over HTTP on localhost, in its own process, so the server doesn't count
+    towards the memory and CPU of the importer being measured.
+    Every request waits latency_seconds (plus up to latency_jitter_seconds), and a proportion error_rate of them fail with
+    a 503. Request counts by kind are available through stats().
+    """
+    config: SyntheticWikiConfig
+
+    def __init__(self, config: SyntheticWikiConfig, latency_seconds: float = 0, latency_jitter_seconds: float = 0, error_rate: float = 0) -> None:
+        self.config = config
+        self.latency_seconds = latency_seconds
+        self.latency_jitter_seconds = latency_jitter_seconds
+        self.error_rate = error_rate
+        self.port: Optional[int] = None
+        self._process: Optional[multiprocessing.Process] = None
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.port}'
+
+    @property
+    def api_url(self) -> str:
+        return f'{self.url}/w/api.php'
+
+    def start(self) -> None:
+        parent, child = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(
+            target=_serve, args=(asdict(self.config), self.latency_seconds, self.latency_jitter_seconds, self.error_rate, child),
+            name='fake-mediawiki', daemon=True
+        )
+        self._process.start()
+        self.port = parent.recv()
+
+    def stats(self) -> Dict[str, Any]:
+        with urllib.request.urlopen(f'{self.url}/stats') as response:
+            return json.load(response)
+
+    def reset_stats(self) -> None:
+        urllib.request.urlopen(urllib.request.Request(f'{self.url}/stats', method='DELETE')).close()
+
+    def stop(self) -> None:
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+    def __enter__(self) -> 'FakeMediaWikiServer':
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.stop()
+
+
+def _request_kind(params: Dict[str, str]) -> str:
+    if 'meta' in params:
+        return 'meta=' + params['meta']
+    if 'clcategories' in params:
+        return 'category_filter'
+    return 'prop=' + params.get('prop', '')
+
+def _serve(config: Dict[str, Any], latency_seconds: float, latency_jitter_seconds: float, error_rate: float, conn) -> None:
+    wiki: SyntheticWiki = SyntheticWiki(SyntheticWikiConfig(**config))
+    rng: random.Random = random.Random(config['seed'])
+    requests: Counter = Counter()
+    errors: Counter = Counter()
+
+    async def api(request: web.Request) -> web.Response:
+        params: Dict[str, str] = dict(request.query)
+        kind: str = _request_kind(params)
+        requests[kind] += 1
+
+        delay: float = latency_seconds + rng.uniform(0, latency_jitter_seconds)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if rng.random() < error_rate:
+            errors[kind] += 1
+            return web.Response(status=503, text='Service Unavailable')
+
+        return web.json_response(wiki.api(params))
+
+    async def stats(request: web.Request) -> web.Response:
+        if request.method == 'DELETE':
+            requests.clear()
+            errors.clear()
+        return web.json_response({'requests': requests, 'errors': errors})
+
+    async def start() -> None:
+        app: web.Application = web.Application()
+        app.router.add_get('/w/api.php', api)
+        app.router.add_route('*', '/stats', stats)
+        runner: web.AppRunner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site: web.TCPSite = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        conn.send(site._server.sockets[0].getsockname()[1])
+
+    loop: asyncio.AbstractEventLoop = asyncio.new_event_loop()
+    loop.run_until_complete(start())
+    loop.run_forever()
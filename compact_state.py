@@ -0,0 +1,214 @@
+import base64
+import itertools
+import tempfile
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, BinaryIO
+
+# Distancias de a un byte por titulo
+DIST_TYPECODE: str = 'b'
+MAX_DIST: int = 127
+UNKNOWN_DIST: int = -2
+TITLE_ID_TYPECODE: str = 'i'
+ARTICLE_ID_TYPECODE: str = 'q'
+
+
+def encode_array(values: array) -> str:
+    return base64.b64encode(values.tobytes()).decode('ascii')
+
+def decode_array(typecode: str, encoded: str) -> array:
+    values: array = array(typecode)
+    values.frombytes(base64.b64decode(encoded))
+    return values
+
+
+class TitleTable:
+    """
+    Interns titles to consecutive integer ids, so each distinct title is stored only once during an import.
+    Ids are never reused: title(intern(title)) == title.
+    """
+
+    def __init__(self, titles: Iterable[str] = ()) -> None:
+        self._titles: List[str] = []
+        self._ids: Dict[str, int] = {}
+        for title in titles:
+            self.intern(title)
+
+    def intern(self, title: str) -> int:
+        title_id: Optional[int] = self._ids.get(title, None)
+        if title_id is None:
+            title_id = len(self._titles)
+            self._titles.append(title)
+            self._ids[title] = title_id
+        return title_id
+
+    def intern_title(self, title: str) -> str:
+        """ The stored copy of the title """
+        return self._titles[self.intern(title)]
+
+    def id(self, title: str) -> Optional[int]:
+        return self._ids.get(title, None)
+
+    def title(self, title_id: int) -> str:
+        return self._titles[title_id]
+
+    def titles(self) -> List[str]:
+        return self._titles
+
+    def __len__(self) -> int:
+        return len(self._titles)
+
+
+class TitleDistances:
+    """
+    Distance to the center of every interned title, backed by a byte array indexed by title id.
+    Titles without a distance yet are UNKNOWN_DIST, so invalid links are just another value of the array.
+    """
+    titles: TitleTable
+
+    def __init__(self, titles: TitleTable, dists: Optional[array] = None) -> None:
+        self.titles = titles
+        self.dists: array = dists if dists is not None else array(DIST_TYPECODE)
+
+    def get(self, title: str, default: Optional[int] = None) -> Optional[int]:
+        title_id: Optional[int] = self.titles.id(title)
+        if title_id is None or title_id >= len(self.dists) or self.dists[title_id] == UNKNOWN_DIST:
+            return default
+        return self.dists[title_id]
+
+    def __setitem__(self, title: str, dist: int) -> None:
+        title_id: int = self.titles.intern(title)
+        if title_id >= len(self.dists):
+            self.dists.extend([UNKNOWN_DIST] * (title_id + 1 - len(self.dists)))
+        self.dists[title_id] = dist
+
+    def __contains__(self, title: str) -> bool:
+        return self.get(title) is not None
+
+    def items(self) -> Iterator[Tuple[str, int]]:
+        for title_id, dist in enumerate(self.dists):
+            if dist != UNKNOWN_DIST:
+                yield self.titles.title(title_id), dist
+
+
+class LinkStore:
+    """
+    Append-only list of title id arrays (the links of every node of a level).
+    Links are kept in memory until they take more than memory_bytes. From then on, they are spilled to a temporary file
+    every time the in-memory buffer fills up again, so memory usage is bounded no matter the size of the level.
+    """
+    memory_bytes: int
+
+    def __init__(self, memory_bytes: int) -> None:
+        self.memory_bytes = memory_bytes
+        self._buffer: array = array(TITLE_ID_TYPECODE)
+        # Posicion (en cantidad de ids) de inicio de cada entrada. La ultima es el final.
+        self._offsets: array = array('q', [0])
+        self._file: Optional[BinaryIO] = None
+        self._spilled: int = 0
+
+    def append(self, title_ids: Iterable[int]) -> None:
+        self._buffer.extend(title_ids)
+        self._offsets.append(self._spilled + len(self._buffer))
+        if len(self._buffer) * self._buffer.itemsize > self.memory_bytes:
+            self._spill()
+
+    def get(self, index: int) -> array:
+        start: int = self._offsets[index]
+        end: int = self._offsets[index + 1]
+
+        # Cada entrada se baja a disco entera, o esta en disco o esta en memoria
+        if start >= self._spilled:
+            return self._buffer[start - self._spilled:end - self._spilled]
+
+        title_ids: array = array(TITLE_ID_TYPECODE)
+        self._file.seek(start * title_ids.itemsize)
+        title_ids.fromfile(self._file, end - start)
+        return title_ids
+
+    @property
+    def spilled(self) -> bool:
+        return self._file is not None
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def _spill(self) -> None:
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(prefix='wiki_import_links_')
+        self._file.seek(0, 2)
+        self._buffer.tofile(self._file)
+        self._spilled += len(self._buffer)
+        self._buffer = array(TITLE_ID_TYPECODE)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class ImportLevel:
+    """
+    The nodes of a BFS level, in discovery order: article id, title and links of each one.
+    Titles and links are stored as ids of the import's TitleTable, and links in a LinkStore that spills to disk.
+    A link referenced more than once is stored once per reference, one after the other, so counts need no extra storage.
+    """
+    titles: TitleTable
+
+    def __init__(self, titles: TitleTable, links_memory_bytes: int) -> None:
+        self.titles = titles
+        self.article_ids: array = array(ARTICLE_ID_TYPECODE)
+        self.title_ids: array = array(TITLE_ID_TYPECODE)
+        self.links: LinkStore = LinkStore(links_memory_bytes)
+
+    def append(self, article_id: int, title: str, links: Iterable[str], link_counts: Optional[Dict[str, int]] = None) -> None:
+        """ link_counts has the amount of references of the links referenced more than once """
+        link_counts = link_counts or {}
+        self.article_ids.append(article_id)
+        self.title_ids.append(self.titles.intern(title))
+        self.links.append(itertools.chain.from_iterable(
+            itertools.repeat(self.titles.intern(link), link_counts.get(link, 1)) for link in links
+        ))
+
+    def article_id(self, index: int) -> int:
+        return self.article_ids[index]
+
+    def title(self, index: int) -> str:
+        return self.titles.title(self.title_ids[index])
+
+    def node_links(self, index: int) -> List[Tuple[str, int]]:
+        """ Each link of the node, with the amount of times the node references it """
+        return [(self.titles.title(title_id), len(list(group))) for title_id, group in itertools.groupby(self.links.get(index))]
+
+    def __len__(self) -> int:
+        return len(self.article_ids)
+
+    def close(self) -> None:
+        self.links.close()
+
+    def to_dict(self) -> Dict[str, str]:
+        links: array = array(TITLE_ID_TYPECODE)
+        lengths: array = array('q')
+        for i in range(len(self)):
+            node_links: array = self.links.get(i)
+            links.extend(node_links)
+            lengths.append(len(node_links))
+
+        return {
+            'article_ids': encode_array(self.article_ids),
+            'title_ids': encode_array(self.title_ids),
+            'link_lengths': encode_array(lengths),
+            'links': encode_array(links),
+        }
+
+    @staticmethod
+    def from_dict(data: Dict[str, str], titles: TitleTable, links_memory_bytes: int) -> 'ImportLevel':
+        level: ImportLevel = ImportLevel(titles, links_memory_bytes)
+        level.article_ids = decode_array(ARTICLE_ID_TYPECODE, data['article_ids'])
+        level.title_ids = decode_array(TITLE_ID_TYPECODE, data['title_ids'])
+
+        links: array = decode_array(TITLE_ID_TYPECODE, data['links'])
+        start: int = 0
+        for length in decode_array('q', data['link_lengths']):
+            level.links.append(links[start:start + length])
+            start += length
+        return level
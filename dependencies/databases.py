@@ -1,6 +1,7 @@
 from typing import Optional
 
 from repositories.elastic_repo import ElasticRepository
+from repositories.embedded_elastic_repo import EmbeddedElasticRepository
 from repositories.neo4j_repo import Neo4jRepository
 
 es: ElasticRepository
@@ -11,9 +12,16 @@ def es_instance() -> ElasticRepository:
         raise Exception('ElasticSearch instance not available')
     return es
 
-def es_open(ip: str, port: int, user: Optional[str], password: Optional[str], index: str) -> None:
+# Con embedded_path se usa el indice embebido en ese directorio en vez de un cluster de elastic
+def es_open(ip: str, port: int, user: Optional[str], password: Optional[str], index: str, embedded_path: Optional[str] = None) -> None:
     global es, _es_open
-    es = ElasticRepository(ip, port, user, password, index)
+    es = EmbeddedElasticRepository(embedded_path, index) if embedded_path is not None else ElasticRepository(ip, port, user, password, index)
+    _es_open = True
+
+# Para usar un repositorio ya creado (por ejemplo, uno en memoria)
+def es_attach(repo: ElasticRepository) -> None:
+    global es, _es_open
+    es = repo
     _es_open = True
 
 def es_close() -> None:
@@ -36,6 +44,14 @@ def neo_open(ip: str, port: int, user: Optional[str], password: Optional[str], i
     neo = Neo4jRepository(ip, port, user, password, index)
     _neo_open = True
 
+def neo_is_open() -> bool:
+    return _neo_open
+
+def neo_attach(repo: Neo4jRepository) -> None:
+    global neo, _neo_open
+    neo = repo
+    _neo_open = True
+
 def neo_close() -> None:
     global _neo_open
     if _neo_open:
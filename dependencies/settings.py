@@ -20,6 +20,35 @@ class Settings(BaseSettings):
     wiki_es_db: str = 'wikipedia'
     wiki_es_user: Optional[str] = None
     wiki_es_pass: Optional[str] = None
+    wiki_es_embedded_path: Optional[str] = None
+
+    # Import config
+    wiki_import_neo_batch_size: int = 1000
+    wiki_import_neo_flush_seconds: float = 5
+    wiki_import_es_chunk_size: int = 500
+    wiki_import_es_max_chunk_bytes: int = 10 * 1024 * 1024
+    wiki_import_cache_dir: Optional[str] = None
+    wiki_import_cache_max_bytes: int = 1024 * 1024 * 1024
+    wiki_import_offline: bool = False
+    wiki_import_checkpoint_file: Optional[str] = None
+    wiki_import_checkpoint_seconds: float = 60
+    wiki_import_dump_categorylinks: Optional[str] = None
+    wiki_import_dump_workers: Optional[int] = None
+    wiki_import_async: bool = False
+    wiki_import_max_in_flight: int = 64
+    wiki_import_connections_per_host: int = 16
+    wiki_import_api_url: Optional[str] = None
+    wiki_import_progress_seconds: float = 1
+    wiki_import_links_memory_bytes: int = 256 * 1024 * 1024
+    wiki_import_filter_concurrency: int = 16
+    wiki_import_resolve_concurrency: int = 16
+    wiki_import_neo_queue_size: int = 10000
+    wiki_import_es_queue_size: int = 1000
+
+    # Search config
+    wiki_search_workers: int = 16
+    wiki_graph_engine: bool = False
+    wiki_graph_engine_check_seconds: float = 1
 
     class Config:
         env_file = ".env"
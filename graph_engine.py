@@ -0,0 +1,407 @@
+import bisect
+import threading
+import traceback
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from dependencies.settings import settings
+from metrics import graph_engine_links, graph_engine_load_seconds, graph_engine_nodes, timed
+from models import ArticleCount, ArticleLink, ArticleNode, CategoriesFilter, DistanceFilterStrategy, GeneralFilter, IdsFilter, \
+    NeoDistanceFilter, NeoFilter, NeoLinksFilter, QueryReturnTypes, QuerySort, RelationDirection, SortByEnum, SortType, TitlesFilter
+from repositories.neo4j_repo import Neo4jRepository
+
+_EMPTY: np.ndarray = np.zeros(0, dtype=np.int32)
+
+
+class CsrGraph:
+    """
+    Snapshot of the Article/Link graph of Neo4j, in memory, to answer the Neo4j filters of a search without traversing
+    the graph in Cypher.
+    Nodes are numbered by article_id order. Links are kept as CSR adjacency arrays in both directions: the neighbors of
+    node i are targets[offsets[i]:offsets[i + 1]]. Traversals expand a whole BFS frontier at a time with NumPy.
+    Filters return boolean masks over the nodes, so combining them is a vectorized and.
+    """
+    version: int
+    stored_version: Optional[str]
+    ids: np.ndarray
+    titles: List[str]
+    categories: List[List[str]]
+    out_offsets: np.ndarray
+    out_targets: np.ndarray
+    in_offsets: np.ndarray
+    in_sources: np.ndarray
+    out_degree: np.ndarray
+    in_degree: np.ndarray
+
+    def __init__(self, version: int, ids: np.ndarray, titles: List[str], categories: List[List[str]], sources: np.ndarray,
+                 dests: np.ndarray, stored_version: Optional[str] = None) -> None:
+        """
+        Parameters:
+        version - graph_version of the repository when the graph started loading.
+        stored_version - stored_graph_version() of the repository when the graph started loading.
+        ids, titles, categories - Of every node, ordered by id.
+        sources, dests - Node indexes of the endpoints of every link.
+        """
+        self.version = version
+        self.stored_version = stored_version
+        self.ids = ids
+        self.titles = titles
+        self.categories = categories
+
+        count: int = len(ids)
+        self.out_offsets, self.out_targets = self._csr(sources, dests, count)
+        self.in_offsets, self.in_sources = self._csr(dests, sources, count)
+        self.out_degree = np.diff(self.out_offsets)
+        self.in_degree = np.diff(self.in_offsets)
+
+        self._title_index: Dict[str, int] = {title: i for i, title in enumerate(titles)}
+        self._category_nodes: Dict[str, List[int]] = {}
+        for i, node_categories in enumerate(categories):
+            for category in node_categories:
+                self._category_nodes.setdefault(category, []).append(i)
+
+        # Posicion de cada titulo en orden alfabetico, para ordenar por titulo
+        self._sorted_titles: List[str] = sorted(titles)
+        self._title_rank: np.ndarray = np.empty(count, dtype=np.int64)
+        self._title_rank[np.array(sorted(range(count), key=titles.__getitem__), dtype=np.int64)] = np.arange(count)
+
+    @staticmethod
+    def load(neo: Neo4jRepository) -> 'CsrGraph':
+        version: int = neo.graph_version
+        stored_version: Optional[str] = neo.stored_graph_version()
+
+        articles: List[Tuple[int, str, List[str]]] = sorted((record['id'], record['title'], record['categories'] or []) for record in neo.export_articles())
+        ids: np.ndarray = np.array([article[0] for article in articles], dtype=np.int64)
+
+        sources: List[int] = []
+        dests: List[int] = []
+        for record in neo.export_links():
+            sources.append(record['source'])
+            dests.append(record['dest'])
+
+        source_nodes: np.ndarray = CsrGraph._positions(ids, np.array(sources, dtype=np.int64))
+        dest_nodes: np.ndarray = CsrGraph._positions(ids, np.array(dests, dtype=np.int64))
+        # Links a articulos creados despues de leer los nodos: la version ya cambio, pero el grafo tiene que ser valido
+        valid: np.ndarray = (source_nodes >= 0) & (dest_nodes >= 0)
+
+        return CsrGraph(
+            version, ids, [article[1] for article in articles], [article[2] for article in articles],
+            source_nodes[valid], dest_nodes[valid], stored_version
+        )
+
+    @staticmethod
+    def _positions(ids: np.ndarray, wanted: np.ndarray) -> np.ndarray:
+        """ Node index of every wanted id, -1 for the ids that aren't nodes """
+        if len(ids) == 0:
+            return np.full(len(wanted), -1, dtype=np.int32)
+        positions: np.ndarray = np.minimum(np.searchsorted(ids, wanted), len(ids) - 1).astype(np.int32)
+        positions[ids[positions] != wanted] = -1
+        return positions
+
+    @staticmethod
+    def _csr(sources: np.ndarray, targets: np.ndarray, count: int) -> Tuple[np.ndarray, np.ndarray]:
+        order: np.ndarray = np.argsort(sources, kind='stable')
+        offsets: np.ndarray = np.zeros(count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=count), out=offsets[1:])
+        return offsets, targets[order].astype(np.int32)
+
+    @property
+    def node_count(self) -> int:
+        return len(self.ids)
+
+    # Traversals
+
+    @staticmethod
+    def _expand(offsets: np.ndarray, targets: np.ndarray, frontier: np.ndarray) -> np.ndarray:
+        """ Neighbors (with repetitions) of every node of the frontier """
+        starts: np.ndarray = offsets[frontier]
+        lengths: np.ndarray = offsets[frontier + 1] - starts
+        total: int = int(lengths.sum())
+        if total == 0:
+            return _EMPTY
+        # Posicion en targets de cada vecino: el inicio de su lista, mas su posicion dentro de ella
+        first: np.ndarray = np.cumsum(lengths) - lengths
+        return targets[np.repeat(starts - first, lengths) + np.arange(total)]
+
+    def neighbors(self, nodes: np.ndarray, direction: Optional[RelationDirection]) -> np.ndarray:
+        """ Neighbors of the nodes following the links in direction, or in both if it is None """
+        if direction == RelationDirection.OUTGOING:
+            return self._expand(self.out_offsets, self.out_targets, nodes)
+        if direction == RelationDirection.INGOING:
+            return self._expand(self.in_offsets, self.in_sources, nodes)
+        return np.concatenate((self._expand(self.out_offsets, self.out_targets, nodes), self._expand(self.in_offsets, self.in_sources, nodes)))
+
+    def distances(self, source: int, direction: Optional[RelationDirection], max_dist: int) -> np.ndarray:
+        """ Distance in links from source to every node, up to max_dist. -1 for the nodes farther away """
+        dist: np.ndarray = np.full(self.node_count, -1, dtype=np.int32)
+        dist[source] = 0
+        frontier: np.ndarray = np.array([source], dtype=np.int32)
+        for level in range(1, max_dist + 1):
+            reached: np.ndarray = self.neighbors(frontier, direction)
+            frontier = np.unique(reached[dist[reached] < 0])
+            if len(frontier) == 0:
+                break
+            dist[frontier] = level
+        return dist
+
+    # Filters
+
+    def filter(self, neo_filters: List[NeoFilter], general_filters: List[GeneralFilter]) -> np.ndarray:
+        """ Mask of the nodes matching every filter """
+        mask: np.ndarray = np.ones(self.node_count, dtype=bool)
+        for filter in neo_filters:
+            if type(filter) is NeoDistanceFilter:
+                mask &= self.distance_mask(filter)
+            elif type(filter) is NeoLinksFilter:
+                mask &= self.links_mask(filter)
+        for filter in general_filters:
+            mask &= self.general_mask(filter)
+        return mask
+
+    def distance_mask(self, filter: NeoDistanceFilter) -> np.ndarray:
+        source: Optional[int] = self._title_index.get(filter.source_node)
+        if source is None:
+            return np.zeros(self.node_count, dtype=bool)
+
+        dist: np.ndarray = self.distances(source, filter.direction, filter.dist)
+        if filter.strategy == DistanceFilterStrategy.AT_DIST:
+            return dist == filter.dist
+        return dist >= 0
+
+    def links_mask(self, filter: NeoLinksFilter) -> np.ndarray:
+        if filter.categories is None:
+            out_count: np.ndarray = self.out_degree
+            in_count: np.ndarray = self.in_degree
+        else:
+            # Links a articulos de alguna de las categorias, contando cada sentido por separado (como en Cypher)
+            in_categories: np.ndarray = self.categories_mask(filter.categories)
+            out_sources: np.ndarray = np.repeat(np.arange(self.node_count), self.out_degree)
+            in_targets: np.ndarray = np.repeat(np.arange(self.node_count), self.in_degree)
+            out_count = np.bincount(out_sources, weights=in_categories[self.out_targets], minlength=self.node_count)
+            in_count = np.bincount(in_targets, weights=in_categories[self.in_sources], minlength=self.node_count)
+
+        if filter.direction == RelationDirection.OUTGOING:
+            count: np.ndarray = out_count
+        elif filter.direction == RelationDirection.INGOING:
+            count = in_count
+        else:
+            count = out_count + in_count
+
+        mask: np.ndarray = count > filter.min_count
+        if filter.max_count is not None:
+            mask &= count < filter.max_count
+        return mask
+
+    def general_mask(self, filter: GeneralFilter) -> np.ndarray:
+        if type(filter) is IdsFilter:
+            return self.ids_mask(filter.ids)
+        elif type(filter) is TitlesFilter:
+            mask: np.ndarray = np.zeros(self.node_count, dtype=bool)
+            mask[[self._title_index[title] for title in filter.titles if title in self._title_index]] = True
+            return mask
+        elif type(filter) is CategoriesFilter:
+            return self.categories_mask(filter.categories)
+        raise ValueError(f'Invalid filter type {filter}')
+
+    def ids_mask(self, ids: List[int]) -> np.ndarray:
+        mask: np.ndarray = np.zeros(self.node_count, dtype=bool)
+        positions: np.ndarray = self._positions(self.ids, np.array(ids, dtype=np.int64))
+        mask[positions[positions >= 0]] = True
+        return mask
+
+    def categories_mask(self, categories: List[str]) -> np.ndarray:
+        mask: np.ndarray = np.zeros(self.node_count, dtype=bool)
+        for category in categories:
+            mask[self._category_nodes.get(category, [])] = True
+        return mask
+
+    def ids_of(self, mask: np.ndarray) -> List[int]:
+        return self.ids[mask].tolist()
+
+    # Results
+
+    def page(self, mask: np.ndarray, sort: Optional[QuerySort], after: Optional[Tuple[Any, int]], offset: Optional[int],
+             limit: Optional[int]) -> np.ndarray:
+        """
+        Nodes of the mask ordered by the sort key and then id, after the (key, id) of the previous page if given (keyset
+        pagination), skipping offset and keeping at most limit of them.
+        """
+        nodes: np.ndarray = np.flatnonzero(mask)
+        sort_by: SortByEnum = sort.sort_by if sort is not None else SortByEnum.ID
+        descending: bool = sort is not None and sort.type == SortType.DESC
+        keys: np.ndarray = self._sort_values(sort_by)[nodes]
+        ids: np.ndarray = self.ids[nodes]
+
+        if after is not None:
+            key, after_id = after
+            if sort_by == SortByEnum.TITLE:
+                # Los titulos se comparan por su posicion en orden alfabetico
+                position: int = bisect.bisect_left(self._sorted_titles, key)
+                exists: bool = position < len(self._sorted_titles) and self._sorted_titles[position] == key
+                key = position if exists else position - 0.5
+            if descending:
+                keep: np.ndarray = (keys < key) | ((keys == key) & (ids < after_id))
+            else:
+                keep = (keys > key) | ((keys == key) & (ids > after_id))
+            nodes, keys, ids = nodes[keep], keys[keep], ids[keep]
+
+        # Por clave y despues id. Descendente es el orden ascendente invertido (tambien en los empates, como en Cypher)
+        order: np.ndarray = np.lexsort((ids, keys))
+        if descending:
+            order = order[::-1]
+
+        start: int = offset or 0
+        end: Optional[int] = start + limit if limit is not None else None
+        return nodes[order][start:end]
+
+    def _sort_values(self, sort_by: SortByEnum) -> np.ndarray:
+        if sort_by == SortByEnum.LINK_COUNT:
+            return self.out_degree
+        elif sort_by == SortByEnum.TITLE:
+            return self._title_rank
+        return self.ids
+
+    def sort_key(self, node: int, sort_by: SortByEnum) -> Tuple[Any, int]:
+        """ (sort key, id) of the node, for the cursor of the next page """
+        if sort_by == SortByEnum.LINK_COUNT:
+            key: Any = int(self.out_degree[node])
+        elif sort_by == SortByEnum.TITLE:
+            key = self.titles[node]
+        else:
+            key = int(self.ids[node])
+        return key, int(self.ids[node])
+
+    def result(self, node: int, return_type: QueryReturnTypes) -> Any:
+        if return_type == QueryReturnTypes.ID:
+            return int(self.ids[node])
+        elif return_type == QueryReturnTypes.TITLE:
+            return self.titles[node]
+        return self.article(node, RelationDirection.OUTGOING)
+
+    def results(self, nodes: np.ndarray, return_type: QueryReturnTypes) -> Any:
+        if return_type == QueryReturnTypes.COUNT:
+            return ArticleCount(count=len(nodes))
+        return [self.result(int(node), return_type) for node in nodes]
+
+    def article(self, node: int, direction: Optional[RelationDirection]) -> ArticleNode:
+        links: List[ArticleLink] = [
+            ArticleLink(article_id=int(self.ids[neighbor]), title=self.titles[neighbor])
+            for neighbor in self.neighbors(np.array([node], dtype=np.int32), direction)
+        ]
+        return ArticleNode(id=int(self.ids[node]), title=self.titles[node], categories=self.categories[node], links=links)
+
+    def radius_search(self, center: str, titles: List[str], leaps: int) -> List[ArticleNode]:
+        """ Same as Neo4jRepository.radius_search: the titles at most leaps links away from center (in any direction), and center """
+        source: Optional[int] = self._title_index.get(center)
+        if source is None:
+            return []
+
+        dist: np.ndarray = self.distances(source, None, leaps)
+        nodes: List[int] = [self._title_index[title] for title in titles if title in self._title_index]
+        results: List[ArticleNode] = [self.article(node, RelationDirection.OUTGOING) for node in nodes if dist[node] > 0]
+        results.append(self.article(source, None))
+        return results
+
+
+@dataclass
+class GraphPage:
+    """ Result of a search solved with the graph engine: its nodes, in order """
+    graph: CsrGraph
+    nodes: np.ndarray
+    return_type: QueryReturnTypes
+
+    def results(self) -> Any:
+        return self.graph.results(self.nodes, self.return_type)
+
+    def rows(self, sort_by: Optional[SortByEnum]) -> Iterator[Tuple[Any, Optional[Tuple[Any, int]]]]:
+        """ (result, cursor key) of every row, as streamQuery would return them. The key is None if sort_by is None """
+        if self.return_type == QueryReturnTypes.COUNT:
+            yield self.results(), None
+            return
+        for node in self.nodes.tolist():
+            yield self.graph.result(node, self.return_type), self.graph.sort_key(node, sort_by) if sort_by is not None else None
+
+
+class GraphEngine:
+    """
+    Keeps a CsrGraph copy of Neo4j for the searches, if enabled. It is loaded in background (on startup and after every
+    import), so searches never wait for it: while it is loading, or if Neo4j was written since it was loaded, snapshot()
+    returns None and searches run in Cypher.
+    Writes of this process are seen at once (graph_version). Writes of other processes (other workers, or an import run
+    elsewhere) change the version stored in the database, which a watcher thread reads every wiki_graph_engine_check_seconds:
+    from then on the copy isn't used, and it is loaded again once the writes stop.
+    """
+
+    def __init__(self) -> None:
+        self._graph: Optional[CsrGraph] = None
+        self._loading: bool = False
+        # Se pidio otra carga mientras se cargaba
+        self._reload: bool = False
+        self._lock: threading.Lock = threading.Lock()
+        # Ultima version de la base que leyo el watcher
+        self._stored_version: Optional[str] = None
+        self._watcher: Optional[threading.Thread] = None
+        self._closed: threading.Event = threading.Event()
+
+    def snapshot(self, neo: Neo4jRepository) -> Optional[CsrGraph]:
+        graph: Optional[CsrGraph] = self._graph
+        if graph is None or graph.version != neo.graph_version or graph.stored_version != self._stored_version:
+            return None
+        return graph
+
+    def refresh(self, neo: Neo4jRepository) -> None:
+        """ Loads the graph again in background. Does nothing if the engine isn't enabled """
+        if not settings.wiki_graph_engine:
+            return
+        with self._lock:
+            if self._loading:
+                self._reload = True
+                return
+            self._loading = True
+            if self._watcher is None:
+                self._watcher = threading.Thread(target=self._watch, args=(neo,), name='graph-engine-watch', daemon=True)
+                self._watcher.start()
+        threading.Thread(target=self._load, args=(neo,), name='graph-engine-load', daemon=True).start()
+
+    def close(self) -> None:
+        """ Stops the watcher """
+        self._closed.set()
+
+    def _load(self, neo: Neo4jRepository) -> None:
+        while True:
+            try:
+                with timed(graph_engine_load_seconds):
+                    graph: CsrGraph = CsrGraph.load(neo)
+                # Hasta que el watcher vuelva a leerla, vale la version con la que se cargo
+                self._stored_version = graph.stored_version
+                self._graph = graph
+                graph_engine_nodes.set(self._graph.node_count)
+                graph_engine_links.set(len(self._graph.out_targets))
+            except Exception:
+                traceback.print_exc()
+            with self._lock:
+                if not self._reload:
+                    self._loading = False
+                    return
+                self._reload = False
+
+    def _watch(self, neo: Neo4jRepository) -> None:
+        previous: Optional[str] = None
+        while not self._closed.wait(settings.wiki_graph_engine_check_seconds):
+            try:
+                stored_version: Optional[str] = neo.stored_graph_version()
+            except Exception:
+                traceback.print_exc()
+                continue
+
+            self._stored_version = stored_version
+            graph: Optional[CsrGraph] = self._graph
+            # Otro proceso escribio: se recarga cuando deja de escribir (la version no cambio desde la lectura anterior)
+            if graph is not None and graph.stored_version != stored_version and stored_version == previous and not self._loading:
+                self.refresh(neo)
+            previous = stored_version
+
+
+graph_engine: GraphEngine = GraphEngine()
@@ -0,0 +1,190 @@
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Any, Callable, Set, Tuple
+
+from compact_state import TitleTable, TitleDistances, ImportLevel, DIST_TYPECODE, encode_array, decode_array
+from models import ImportFailure
+
+CHECKPOINT_VERSION: int = 4
+DEFAULT_LINKS_MEMORY_BYTES: int = 256 * 1024 * 1024
+
+
+@dataclass
+class ImportState:
+    """
+    Everything import_wiki needs to continue a BFS import.
+    Titles are interned in a TitleTable, and distances and levels reference them by id, so each title is kept only once.
+    Checkpoints are only taken after flushing every pending DB write, so every node in title_dists is already
+    persisted in both databases.
+    """
+    center_title: str
+    radius: int
+    categories: List[str]
+    lang: str
+    # Dump local de donde se importa. None si se usa la API de Wikipedia.
+    dump_path: Optional[str] = None
+    # Memoria maxima para los links de cada nivel, despues se bajan a disco. No se guarda en el checkpoint.
+    links_memory_bytes: int = DEFAULT_LINKS_MEMORY_BYTES
+    titles: TitleTable = field(default_factory=TitleTable)
+    # La distancia al centro de cada nodo. INVALID_LINK significa que es un nodo invalido.
+    title_dists: Optional[TitleDistances] = None
+    # Titulos de links que no son canonicos (redirecciones o normalizaciones) -> titulo canonico
+    title_alias_dict: Dict[str, str] = field(default_factory=dict)
+    # Nodos a distancia current_dist del centro
+    frontier: Optional[ImportLevel] = None
+    current_dist: int = 0
+    # Nodos a distancia current_dist + 1 ya creados
+    next_frontier: Optional[ImportLevel] = None
+    # Titulos del nivel actual que falta resolver -> indices de los nodos de la frontera que los referencian (ordenados,
+    # una vez por referencia).
+    # None si todavia no se calcularon los links del nivel.
+    title_linkers: Optional[Dict[str, List[int]]] = None
+    total_nodes: int = 0
+    total_relationships: int = 0
+    # Titulos que no existen o son desambiguaciones
+    missing_pages: int = 0
+    failed_documents: List[ImportFailure] = field(default_factory=list)
+    # Settings del indice de elastic previos al import, para restaurarlos al terminar
+    es_settings: Optional[Dict[str, Any]] = None
+    seconds_elapsed: float = 0
+    # Import incremental: titulo -> (id, revision) de los articulos que ya estaban en las db al empezar
+    incremental: bool = False
+    previous_articles: Dict[str, Tuple[int, Optional[int]]] = field(default_factory=dict)
+    # Articulos que no cambiaron desde el import anterior. No se vuelven a escribir.
+    unchanged_titles: Set[str] = field(default_factory=set)
+
+    def __post_init__(self) -> None:
+        if self.title_dists is None:
+            self.title_dists = TitleDistances(self.titles)
+        if self.frontier is None:
+            self.frontier = self.new_level()
+        if self.next_frontier is None:
+            self.next_frontier = self.new_level()
+
+    def new_level(self) -> ImportLevel:
+        return ImportLevel(self.titles, self.links_memory_bytes)
+
+    def advance_level(self) -> None:
+        # Los links del nivel anterior ya no se necesitan
+        self.frontier.close()
+        self.frontier = self.next_frontier
+        self.next_frontier = self.new_level()
+        self.title_linkers = None
+        self.current_dist += 1
+
+    def close(self) -> None:
+        self.frontier.close()
+        self.next_frontier.close()
+
+
+# Los alias y titulos se guardan como ids de la tabla de titulos
+def save_checkpoint(path: str, state: ImportState) -> None:
+    titles: TitleTable = state.titles
+    data: Dict[str, Any] = {
+        'version': CHECKPOINT_VERSION,
+        'center_title': state.center_title,
+        'radius': state.radius,
+        'categories': state.categories,
+        'lang': state.lang,
+        'dump_path': state.dump_path,
+        'titles': titles.titles(),
+        'title_dists': encode_array(state.title_dists.dists),
+        'title_aliases': [[titles.intern(alias), titles.intern(title)] for alias, title in state.title_alias_dict.items()],
+        'frontier': state.frontier.to_dict(),
+        'current_dist': state.current_dist,
+        'next_frontier': state.next_frontier.to_dict(),
+        'title_linkers': None if state.title_linkers is None else [[titles.intern(title), linkers] for title, linkers in state.title_linkers.items()],
+        'total_nodes': state.total_nodes,
+        'total_relationships': state.total_relationships,
+        'missing_pages': state.missing_pages,
+        'failed_documents': [failure.dict() for failure in state.failed_documents],
+        'es_settings': state.es_settings,
+        'seconds_elapsed': state.seconds_elapsed,
+        'incremental': state.incremental,
+        'previous_articles': state.previous_articles,
+        'unchanged_titles': list(state.unchanged_titles),
+    }
+
+    # Escritura atomica: si nos matan a mitad de camino, queda el checkpoint anterior
+    file: Path = Path(path)
+    tmp_file: Path = file.with_name(file.name + '.tmp')
+    with tmp_file.open('w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp_file, file)
+
+def _read_checkpoint(path: str) -> Dict[str, Any]:
+    with open(path, 'r', encoding='utf-8') as f:
+        data: Dict[str, Any] = json.load(f)
+
+    version: int = data.pop('version', None)
+    if version != CHECKPOINT_VERSION:
+        raise ValueError(f'Unsupported checkpoint version {version}')
+    return data
+
+# Solo el titulo del centro, sin armar el estado (ni los archivos temporales de sus links)
+def read_checkpoint_center(path: str) -> str:
+    return _read_checkpoint(path)['center_title']
+
+def load_checkpoint(path: str, links_memory_bytes: int = DEFAULT_LINKS_MEMORY_BYTES) -> ImportState:
+    data: Dict[str, Any] = _read_checkpoint(path)
+    titles: TitleTable = TitleTable(data.pop('titles'))
+    data['titles'] = titles
+    data['links_memory_bytes'] = links_memory_bytes
+    data['title_dists'] = TitleDistances(titles, decode_array(DIST_TYPECODE, data['title_dists']))
+    data['title_alias_dict'] = {titles.title(alias): titles.title(title) for alias, title in data.pop('title_aliases')}
+    data['frontier'] = ImportLevel.from_dict(data['frontier'], titles, links_memory_bytes)
+    data['next_frontier'] = ImportLevel.from_dict(data['next_frontier'], titles, links_memory_bytes)
+    if data['title_linkers'] is not None:
+        data['title_linkers'] = {titles.title(title): linkers for title, linkers in data['title_linkers']}
+    data['failed_documents'] = [ImportFailure(**failure) for failure in data['failed_documents']]
+    data['unchanged_titles'] = set(data['unchanged_titles'])
+    data['previous_articles'] = {title: tuple(article) for title, article in data['previous_articles'].items()}
+    return ImportState(**data)
+
+def delete_checkpoint(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class ImportCheckpointer:
+    """
+    Saves the import state to path every interval_seconds.
+    Before saving, flush is called so the checkpoint never references writes that only exist in memory.
+    With no path, checkpointing is disabled.
+    """
+    path: Optional[str]
+    interval_seconds: float
+
+    def __init__(self, path: Optional[str], interval_seconds: float, flush: Callable[[], None], elapsed_before: float = 0) -> None:
+        self.path = path
+        self.interval_seconds = interval_seconds
+        self._flush = flush
+        self._run_start: float = time.time()
+        self._elapsed_before: float = elapsed_before
+        self._last_checkpoint: float = time.monotonic()
+
+    def maybe_checkpoint(self, state: ImportState) -> None:
+        if self.path is not None and time.monotonic() - self._last_checkpoint >= self.interval_seconds:
+            self.checkpoint(state)
+
+    def checkpoint(self, state: ImportState) -> None:
+        if self.path is None:
+            return
+
+        self._flush()
+        self.update_elapsed(state)
+        save_checkpoint(self.path, state)
+        self._last_checkpoint = time.monotonic()
+
+    def update_elapsed(self, state: ImportState) -> None:
+        # El tiempo transcurrido incluye el de las ejecuciones anteriores
+        state.seconds_elapsed = self._elapsed_before + time.time() - self._run_start
+
+    def finish(self) -> None:
+        if self.path is not None:
+            delete_checkpoint(self.path)
@@ -0,0 +1,141 @@
+import asyncio
+import concurrent.futures
+import threading
+import traceback
+import uuid
+from collections import OrderedDict
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+from import_progress import ImportMonitor, ImportCancelledError
+from models import ImportJobInfo, ImportJobStatus, ImportProgress, ImportSummary
+
+MAX_FINISHED_JOBS: int = 100
+FINISHED_STATUSES = (ImportJobStatus.COMPLETED, ImportJobStatus.FAILED, ImportJobStatus.CANCELLED)
+
+
+class ImportJob(ImportMonitor):
+    """
+    An import running (or waiting to run) in the background.
+    It is the ImportMonitor of its import: published progress is kept, together with a version number that changes on every
+    update, so status requests and event streams can read it from other threads.
+    """
+    id: str
+    center_title: str
+    status: ImportJobStatus
+    summary: Optional[ImportSummary]
+    error: Optional[str]
+
+    def __init__(self, center_title: str, interval_seconds: float) -> None:
+        super().__init__(interval_seconds)
+        self.id = uuid.uuid4().hex
+        self.center_title = center_title
+        self.status = ImportJobStatus.PENDING
+        self.summary = None
+        self.error = None
+        self.version: int = 0
+        self._lock: threading.Lock = threading.Lock()
+
+    def publish(self, progress: ImportProgress) -> None:
+        with self._lock:
+            self.version += 1
+
+    def set_status(self, status: ImportJobStatus, summary: Optional[ImportSummary] = None, error: Optional[str] = None) -> None:
+        with self._lock:
+            self.status = status
+            self.summary = summary
+            self.error = error
+            self.version += 1
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED_STATUSES
+
+    def info(self) -> ImportJobInfo:
+        with self._lock:
+            return ImportJobInfo(
+                job_id=self.id, status=self.status, center_page=self.center_title, progress=self.progress,
+                summary=self.summary, error=self.error
+            )
+
+    async def events(self) -> AsyncIterator[str]:
+        """ Server-sent events stream with the job info, on every update, until the job finishes """
+        last_version: int = -1
+        while True:
+            # Leemos la version antes que el estado, para no perdernos una actualizacion
+            version: int = self.version
+            finished: bool = self.finished
+            if version != last_version:
+                last_version = version
+                yield f'event: progress\ndata: {self.info().json()}\n\n'
+            if finished:
+                return
+            await asyncio.sleep(self.interval_seconds)
+
+
+ImportRunner = Callable[[ImportJob], ImportSummary]
+
+
+class ImportJobManager:
+    """
+    Runs imports in a dedicated worker thread, one at a time, since every import writes to the same databases.
+    Jobs wait in order until the worker is free. Finished jobs are kept (up to MAX_FINISHED_JOBS) so their result can be queried.
+    """
+
+    def __init__(self) -> None:
+        self._executor: concurrent.futures.ThreadPoolExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='wiki-import')
+        self._jobs: Dict[str, ImportJob] = OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+
+    def submit(self, center_title: str, interval_seconds: float, runner: ImportRunner) -> ImportJob:
+        """ Queues the import. runner receives the job, which it has to use as the monitor of the import """
+        job: ImportJob = ImportJob(center_title, interval_seconds)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._forget_finished()
+        self._executor.submit(self._run, job, runner)
+        return job
+
+    def get(self, job_id: str) -> Optional[ImportJob]:
+        with self._lock:
+            return self._jobs.get(job_id, None)
+
+    def list(self) -> List[ImportJob]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def cancel(self, job_id: str) -> Optional[ImportJob]:
+        job: Optional[ImportJob] = self.get(job_id)
+        if job is not None and not job.finished:
+            job.cancel()
+        return job
+
+    def shutdown(self) -> None:
+        for job in self.list():
+            job.cancel()
+        self._executor.shutdown(wait=True)
+
+    @staticmethod
+    def _run(job: ImportJob, runner: ImportRunner) -> None:
+        # Se pudo haber cancelado mientras esperaba
+        if job.cancelled:
+            job.set_status(ImportJobStatus.CANCELLED)
+            return
+
+        job.set_status(ImportJobStatus.RUNNING)
+        try:
+            summary: ImportSummary = runner(job)
+        except ImportCancelledError:
+            job.set_status(ImportJobStatus.CANCELLED)
+        except Exception as e:
+            traceback.print_exc()
+            job.set_status(ImportJobStatus.FAILED, error=f'{type(e).__name__}: {e}')
+        else:
+            job.set_status(ImportJobStatus.COMPLETED, summary=summary)
+
+    def _forget_finished(self) -> None:
+        finished: List[str] = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+
+
+job_manager: ImportJobManager = ImportJobManager()
@@ -0,0 +1,249 @@
+import concurrent.futures
+import queue
+import threading
+import time
+from typing import Any, Callable, List, Optional, Set, Tuple
+
+from models import ImportStageStats
+from repositories.elastic_repo import ElasticBulkIndexer
+from repositories.neo4j_repo import Neo4jBulkWriter
+
+# (escritura, argumentos, items que cuenta). Una escritura None detiene el stage.
+_QueuedWrite = Tuple[Optional[Callable[..., Any]], Tuple[Any, ...], int]
+
+
+class StageCounter:
+    """
+    Throughput counters of an import pipeline stage.
+    Workers add the items they processed and how long it took. The import thread adds the time it spent blocked on the
+    stage, either waiting for room (backpressure) or for results. The stage that keeps the import waiting is the bottleneck.
+    """
+    name: str
+    items: int
+    seconds_busy: float
+    seconds_waiting: float
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.items = 0
+        self.seconds_busy = 0
+        self.seconds_waiting = 0
+        self._lock: threading.Lock = threading.Lock()
+
+    def add_work(self, items: int, seconds: float) -> None:
+        with self._lock:
+            self.items += items
+            self.seconds_busy += seconds
+
+    def add_wait(self, seconds: float) -> None:
+        with self._lock:
+            self.seconds_waiting += seconds
+
+    def stats(self) -> ImportStageStats:
+        with self._lock:
+            return ImportStageStats(
+                items=self.items,
+                seconds_busy=round(self.seconds_busy, 3),
+                seconds_waiting=round(self.seconds_waiting, 3),
+                items_per_second=round(self.items / self.seconds_busy, 2) if self.seconds_busy > 0 else 0,
+            )
+
+
+class FetchStage:
+    """
+    Runs the requests of a pipeline stage in the executor, with at most concurrency of them running at the same time.
+    Requests that already run elsewhere (the async client's event loop) are added with submit_request(), without a thread.
+    Both block while the stage is full. Results are collected, in completion order, with completed().
+    """
+    counter: StageCounter
+    concurrency: int
+
+    def __init__(self, name: str, executor: concurrent.futures.Executor, concurrency: int) -> None:
+        if concurrency <= 0:
+            raise ValueError(f'Invalid concurrency {concurrency} for stage {name}')
+
+        self.counter = StageCounter(name)
+        self.concurrency = concurrency
+        self._executor: concurrent.futures.Executor = executor
+        self._futures: Set[concurrent.futures.Future] = set()
+
+    @property
+    def pending(self) -> int:
+        """ Submitted requests whose result wasn't collected yet """
+        return len(self._futures)
+
+    def submit(self, items: int, work: Callable[..., Any], *args) -> None:
+        self._wait_for_room()
+        self._futures.add(self._executor.submit(self._run, items, work, *args))
+
+    def submit_request(self, items: int, request: Callable[[], concurrent.futures.Future], parse: Callable[..., Any], *args) -> None:
+        """
+        Starts request(), which returns the future of a request running elsewhere. No thread waits for it: when it
+        finishes, parse(result, *args) runs on the thread that completed it and its result is the one collected.
+        """
+        self._wait_for_room()
+        start: float = time.perf_counter()
+        parsed: concurrent.futures.Future = concurrent.futures.Future()
+        requested: concurrent.futures.Future = request()
+
+        def parse_result(done: concurrent.futures.Future) -> None:
+            # Si se cancelo el stage no hace falta parsear
+            if not parsed.set_running_or_notify_cancel():
+                return
+            try:
+                parsed.set_result(parse(done.result(), *args))
+            except BaseException as e:
+                parsed.set_exception(e)
+            finally:
+                self.counter.add_work(items, time.perf_counter() - start)
+
+        # Cancelar el resultado cancela el request
+        parsed.add_done_callback(lambda future: requested.cancel() if future.cancelled() else None)
+        requested.add_done_callback(parse_result)
+        self._futures.add(parsed)
+
+    def completed(self, wait: bool = False) -> List[concurrent.futures.Future]:
+        """ Finished requests. If wait is True and there are pending ones, waits until at least one finishes """
+        if wait and self._futures and not any(future.done() for future in self._futures):
+            start: float = time.perf_counter()
+            concurrent.futures.wait(self._futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            self.counter.add_wait(time.perf_counter() - start)
+
+        done: List[concurrent.futures.Future] = [future for future in self._futures if future.done()]
+        self._futures.difference_update(done)
+        return done
+
+    def cancel(self) -> None:
+        for future in self._futures:
+            future.cancel()
+        self._futures.clear()
+
+    def _wait_for_room(self) -> None:
+        running: List[concurrent.futures.Future] = [future for future in self._futures if not future.done()]
+        if len(running) >= self.concurrency:
+            start: float = time.perf_counter()
+            concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            self.counter.add_wait(time.perf_counter() - start)
+
+    def _run(self, items: int, work: Callable[..., Any], *args) -> Any:
+        start: float = time.perf_counter()
+        try:
+            return work(*args)
+        finally:
+            self.counter.add_work(items, time.perf_counter() - start)
+
+
+class WriterStage:
+    """
+    Applies writes in order on its own thread, taking them from a queue of at most queue_size writes.
+    submit() blocks while the queue is full, so a slow database slows the import down instead of piling up writes in memory.
+    If a write fails the following ones are discarded, and the error is raised by the next submit() or wait().
+    """
+    counter: StageCounter
+
+    def __init__(self, name: str, queue_size: int) -> None:
+        if queue_size <= 0:
+            raise ValueError(f'Invalid queue size {queue_size} for stage {name}')
+
+        self.counter = StageCounter(name)
+        self._queue: 'queue.Queue[_QueuedWrite]' = queue.Queue(queue_size)
+        self._error: Optional[BaseException] = None
+        self._discard: bool = False
+        self._thread: threading.Thread = threading.Thread(target=self._run, name=f'import-{name}', daemon=True)
+        self._thread.start()
+
+    def submit(self, write: Callable[..., Any], *args, items: int = 1) -> None:
+        self._raise_error()
+        queued: _QueuedWrite = (write, args, items)
+        try:
+            self._queue.put_nowait(queued)
+        except queue.Full:
+            start: float = time.perf_counter()
+            self._queue.put(queued)
+            self.counter.add_wait(time.perf_counter() - start)
+
+    def wait(self) -> None:
+        """ Waits until every submitted write is applied """
+        start: float = time.perf_counter()
+        self._queue.join()
+        self.counter.add_wait(time.perf_counter() - start)
+        self._raise_error()
+
+    def close(self, discard: bool = False) -> None:
+        """ Stops the stage once the queued writes are applied or, if discard is True, without applying them """
+        self._discard = self._discard or discard
+        self._queue.put((None, (), 0))
+        self._thread.join()
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            raise self._error
+
+    def _run(self) -> None:
+        while True:
+            write, args, items = self._queue.get()
+            try:
+                if write is None:
+                    return
+                if self._error is None and not self._discard:
+                    start: float = time.perf_counter()
+                    write(*args)
+                    self.counter.add_work(items, time.perf_counter() - start)
+            except BaseException as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+
+class ImportWriters:
+    """
+    The Neo4j and Elasticsearch writer stages of the import, each one on its own thread, so neither the fetches nor the
+    other database wait for a slow write.
+    Writes to Neo4j keep their order, so nodes are still written before the links that reference them.
+    flush() waits for both queues and writes the buffered batches. On exit, if there was no error, everything is flushed.
+    Otherwise the queued writes are discarded.
+    """
+    neo: WriterStage
+    es: WriterStage
+
+    def __init__(self, neo_writer: Neo4jBulkWriter, es_indexer: ElasticBulkIndexer, neo_queue_size: int, es_queue_size: int) -> None:
+        self.neo_writer = neo_writer
+        self.es_indexer = es_indexer
+        self.neo = WriterStage('neo4j_writer', neo_queue_size)
+        try:
+            self.es = WriterStage('es_writer', es_queue_size)
+        except BaseException:
+            self.neo.close(discard=True)
+            raise
+
+    def __enter__(self) -> 'ImportWriters':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            self.neo.close(discard=exc_type is not None)
+            self.es.close(discard=exc_type is not None)
+
+    def create_article(self, id: int, title: str, content: str, categories: List[str], revision_id: Optional[int], relink: bool,
+                       center_dist: int) -> None:
+        self.neo.submit(self.neo_writer.create_article, id, title, categories, revision_id, relink, center_dist)
+        self.es.submit(self.es_indexer.create_article, id, title, content, categories, revision_id)
+
+    def set_center_dist(self, id: int, center_dist: int) -> None:
+        self.neo.submit(self.neo_writer.set_center_dist, id, center_dist)
+
+    def link_article(self, source_id: int, dest_title: str, count: int = 1) -> None:
+        self.neo.submit(self.neo_writer.link_article, source_id, dest_title, count)
+
+    def flush(self) -> None:
+        # Las dos bases escriben en paralelo
+        self.neo.submit(self.neo_writer.flush, items=0)
+        self.es.submit(self.es_indexer.flush, items=0)
+        self.neo.wait()
+        self.es.wait()
+
+    def counters(self) -> List[StageCounter]:
+        return [self.neo.counter, self.es.counter]
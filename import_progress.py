@@ -0,0 +1,83 @@
+import threading
+import time
+from typing import Optional
+
+from import_checkpoint import ImportState
+from metrics import import_missing_pages_total, import_nodes_per_second
+from models import ImportProgress
+
+
+class ImportCancelledError(Exception):
+    """ The import was cancelled through its ImportMonitor """
+
+
+class ImportMonitor:
+    """
+    Receives the progress of an import and tells it when to stop.
+    report() is called by the importer after every resolved page, but progress is only published (publish()) at most every
+    interval_seconds, unless forced. The default publish() writes a line to stdout.
+    Linked titles that don't exist are reported with missing_page(), counted in the progress instead of logged one by one.
+    Cancellation is cooperative: cancel() can be called from any thread, and the importer calls check_cancelled() between
+    pages, where its state is consistent, so a cancelled import can be resumed from its checkpoint.
+    """
+    interval_seconds: float
+    progress: ImportProgress
+
+    def __init__(self, interval_seconds: float) -> None:
+        self.interval_seconds = interval_seconds
+        self.progress = ImportProgress()
+        self._cancelled: threading.Event = threading.Event()
+        self._run_start: float = time.monotonic()
+        self._elapsed_before: float = 0
+        self._last_report: Optional[float] = None
+        self._last_report_nodes: int = 0
+
+    def start(self, state: ImportState) -> None:
+        # Al continuar un import, el tiempo transcurrido incluye el de las ejecuciones anteriores
+        self._run_start = time.monotonic()
+        self._elapsed_before = state.seconds_elapsed
+        self._last_report = self._run_start
+        self._last_report_nodes = state.total_nodes
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def check_cancelled(self) -> None:
+        if self._cancelled.is_set():
+            raise ImportCancelledError()
+
+    def missing_page(self, title: str) -> None:
+        import_missing_pages_total.inc()
+
+    def report(self, state: ImportState, queue_depth: int, force: bool = False) -> None:
+        now: float = time.monotonic()
+        if not force and self._last_report is not None and now - self._last_report < self.interval_seconds:
+            return
+
+        # Velocidad desde el ultimo reporte, no desde el inicio
+        nodes_per_second: float = 0
+        if self._last_report is not None and now > self._last_report:
+            nodes_per_second = (state.total_nodes - self._last_report_nodes) / (now - self._last_report)
+
+        self._last_report = now
+        self._last_report_nodes = state.total_nodes
+        import_nodes_per_second.set(nodes_per_second)
+        self.progress = ImportProgress(
+            current_dist=state.current_dist,
+            total_nodes=state.total_nodes,
+            total_relationships=state.total_relationships,
+            nodes_per_second=round(nodes_per_second, 2),
+            queue_depth=queue_depth,
+            missing_pages=state.missing_pages,
+            seconds_elapsed=int(self._elapsed_before + now - self._run_start),
+        )
+        self.publish(self.progress)
+
+    def publish(self, progress: ImportProgress) -> None:
+        print(f'Total time: {progress.seconds_elapsed}. Level: {progress.current_dist}. Total nodes: {progress.total_nodes}. '
+              f'Total relations: {progress.total_relationships}. Nodes/sec: {progress.nodes_per_second}. Pending: {progress.queue_depth}. '
+              f'Missing pages: {progress.missing_pages}')
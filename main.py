@@ -1,10 +1,11 @@
 import json
 from json import JSONDecodeError
 from pathlib import Path
-from typing import Dict, List
+from typing import Any, Callable, Dict, List, Optional
 
 import uvicorn
-from fastapi import FastAPI, Form
+from fastapi import FastAPI, Form, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from mediawiki import mediawiki
@@ -13,9 +14,13 @@ from starlette.requests import Request
 
 from dependencies import databases
 from dependencies.settings import settings
-from models import ArticleNode, ArticleQuery, ImportSummary, QueryReturnTypes
-from querys import strict_search_query, process_query
-from wikipedia_import import import_wiki
+from graph_engine import graph_engine
+from import_checkpoint import read_checkpoint_center
+from import_jobs import ImportJob, job_manager
+from metrics import registry, search_seconds, search_stage_seconds, timed
+from models import ArticleNode, ArticleQuery, ImportJobInfo, QueryReturnTypes
+from querys import InvalidCursorException, strict_search_query, process_query, stream_query
+from wikipedia_import import import_wiki, resume_import
 
 app = FastAPI()
 templates = Jinja2Templates(directory="templates/")
@@ -29,10 +34,15 @@ app.mount(
 def startup_event():
     if settings.wiki_open_dbs_on_startup:
         databases.neo_open(settings.wiki_neo_ip, settings.wiki_neo_port, settings.wiki_neo_user, settings.wiki_neo_pass, settings.wiki_neo_db)
-        databases.es_open(settings.wiki_es_ip, settings.wiki_es_port, settings.wiki_es_user, settings.wiki_es_pass, settings.wiki_es_db)
+        databases.es_open(settings.wiki_es_ip, settings.wiki_es_port, settings.wiki_es_user, settings.wiki_es_pass, settings.wiki_es_db,
+                          settings.wiki_es_embedded_path)
+        graph_engine.refresh(databases.neo_instance())
 
 @app.on_event("shutdown")
 def shutdown_event():
+    # Los imports en curso se cancelan (y quedan checkpointeados) antes de cerrar las bases
+    job_manager.shutdown()
+    graph_engine.close()
     databases.close_all()
 
 class WikipediaImportRequest(BaseModel):
@@ -40,24 +50,78 @@ class WikipediaImportRequest(BaseModel):
     radius: int = Field(..., gt=0, title='Centro', description='Distancia maxima a la cual un nodo puede estar de la pagina centro durante la importacion. Requerido.')
     categories: List[str] = Field(..., title='Categorias', description='Solo importar articulos dentro de estas categorias. Requerido.')
     lang: str = Field('en', title='Idioma de Wikipedia', description='El idioma de la wikipedia a usar. Es opcional, defaultea a Ingles.')
+    dump_path: Optional[str] = Field(None, title='Dump de Wikipedia', description='Path local a un dump pages-articles.xml(.bz2) del cual importar en vez de usar la API de Wikipedia. Es opcional.')
+    incremental: bool = Field(False, title='Incremental', description='No truncar las bases: solo se actualizan los articulos que cambiaron de revision y se borran los que quedaron afuera. Es opcional, defaultea a falso.')
 
 # Api
 
-@app.post("/api/import", response_model=ImportSummary)
+# Los imports corren en background. Se devuelve el job, cuyo progreso se puede consultar o seguir por server-sent events.
+@app.post("/api/import", response_model=ImportJobInfo)
 def wikipedia_import(import_request: WikipediaImportRequest):
-    return import_wiki(import_request.center_page, import_request.radius, import_request.categories, import_request.lang)
+    return submit_import(import_request)
+
+@app.post("/api/import/resume", response_model=ImportJobInfo)
+def wikipedia_import_resume():
+    if settings.wiki_import_checkpoint_file is None:
+        raise HTTPException(status_code=400, detail='No import checkpoint file configured')
+    if not Path(settings.wiki_import_checkpoint_file).exists():
+        raise HTTPException(status_code=404, detail='There is no import to resume')
+
+    center_title: str = read_checkpoint_center(settings.wiki_import_checkpoint_file)
+    job: ImportJob = job_manager.submit(center_title, settings.wiki_import_progress_seconds, refresh_graph_after(lambda job: resume_import(monitor=job)))
+    return job.info()
+
+@app.get("/api/import/jobs", response_model=List[ImportJobInfo])
+def import_jobs():
+    return [job.info() for job in job_manager.list()]
+
+@app.get("/api/import/jobs/{job_id}", response_model=ImportJobInfo)
+def import_job(job_id: str):
+    return get_import_job(job_id).info()
+
+@app.get("/api/import/jobs/{job_id}/events")
+def import_job_events(job_id: str):
+    return StreamingResponse(get_import_job(job_id).events(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+@app.post("/api/import/jobs/{job_id}/cancel", response_model=ImportJobInfo)
+def import_job_cancel(job_id: str):
+    job: Optional[ImportJob] = job_manager.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f'Import job {job_id} not found')
+    return job.info()
 
 @app.get("/api/simple_search")
 def strict_search(source: str, string: str, leaps: int):
-    return strict_search_query(source, string, leaps)
+    with timed(search_seconds, endpoint='simple_search'):
+        return strict_search_query(source, string, leaps)
 
 @app.get("/api/search")
 async def search(query: ArticleQuery):
-    return await process_query(query)
+    try:
+        with timed(search_seconds, endpoint='search'):
+            return await process_query(query)
+    except InvalidCursorException as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# Un resultado por linea (NDJSON), a medida que llegan de Neo4j, sin armar la respuesta completa en memoria
+@app.get("/api/search/stream")
+async def search_stream(query: ArticleQuery):
+    try:
+        lines = await stream_query(query)
+    except InvalidCursorException as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return StreamingResponse(lines, media_type='application/x-ndjson')
+
+# Metricas en el formato de texto de Prometheus: latencias por etapa de las busquedas, del import y de las bases
+@app.get("/metrics", response_class=PlainTextResponse)
+def export_metrics():
+    return PlainTextResponse(registry.render(), media_type='text/plain; version=0.0.4')
 
 @app.get("/reset")
 def reset():
     databases.truncate_dbs()
+    if databases.neo_is_open():
+        graph_engine.refresh(databases.neo_instance())
 
 # Webpage
 
@@ -72,7 +136,7 @@ def import_get(request: Request):
 @app.post("/import")
 def import_post(center_page: str = Form(...), radius: int = Form(...), categories: List[str] = Form(...), lang: str = Form('en')):
     categories = [category for category in categories if len(category) > 0]
-    return import_wiki(center_page, radius, categories, lang)
+    return submit_import(WikipediaImportRequest(center_page=center_page, radius=radius, categories=categories, lang=lang))
 
 @app.get("/search")
 def search_get(request: Request):
@@ -88,12 +152,39 @@ async def search_post(request: Request, query: str = Form(...)):
     query = ArticleQuery(**data)
     search_response = await search(query)
 
-    if query.return_type == QueryReturnTypes.NODE or query.return_type == QueryReturnTypes.NODE_WITH_CONTENT:
-        result = article_node_to_graph(search_response.result)
-        return templates.TemplateResponse('graph.html', context={'request': request, 'result': result})
-    else:
-        is_list: bool = query.return_type == QueryReturnTypes.TITLE or query.return_type == QueryReturnTypes.ID
-        return templates.TemplateResponse('normalResponse.html', context={'request': request, 'result': search_response.result, 'is_list': is_list})
+    # TemplateResponse renderiza el template al crearse
+    with timed(search_stage_seconds, stage='render'):
+        if query.return_type == QueryReturnTypes.NODE or query.return_type == QueryReturnTypes.NODE_WITH_CONTENT:
+            result = article_node_to_graph(search_response.result)
+            return templates.TemplateResponse('graph.html', context={'request': request, 'result': result})
+        else:
+            is_list: bool = query.return_type == QueryReturnTypes.TITLE or query.return_type == QueryReturnTypes.ID
+            return templates.TemplateResponse('normalResponse.html', context={'request': request, 'result': search_response.result, 'is_list': is_list})
+
+def submit_import(import_request: WikipediaImportRequest) -> ImportJobInfo:
+    def run(job: ImportJob):
+        return import_wiki(
+            import_request.center_page, import_request.radius, import_request.categories, import_request.lang,
+            import_request.incremental, import_request.dump_path, monitor=job
+        )
+
+    return job_manager.submit(import_request.center_page, settings.wiki_import_progress_seconds, refresh_graph_after(run)).info()
+
+def refresh_graph_after(run: Callable[[ImportJob], Any]) -> Callable[[ImportJob], Any]:
+    # Cuando termina el import (bien o no) se recarga la copia del grafo del graph engine
+    def run_and_refresh(job: ImportJob) -> Any:
+        try:
+            return run(job)
+        finally:
+            if databases.neo_is_open():
+                graph_engine.refresh(databases.neo_instance())
+    return run_and_refresh
+
+def get_import_job(job_id: str) -> ImportJob:
+    job: Optional[ImportJob] = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f'Import job {job_id} not found')
+    return job
 
 def article_node_to_graph(nodes: List[ArticleNode]) -> Dict[str, List]:
     
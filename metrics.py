@@ -0,0 +1,275 @@
+import bisect
+import functools
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar
+
+T = TypeVar('T')
+
+# Valores de las labels, en el orden de labelnames
+_LabelValues = Tuple[str, ...]
+
+# Buckets por defecto de los histogramas de latencia, en segundos
+DEFAULT_BUCKETS: Tuple[float, ...] = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: _LabelValues, extra: str = '') -> str:
+    pairs: List[str] = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    """ A named metric with labels. Every combination of label values is a separate series """
+    type: str = 'untyped'
+    name: str
+    help: str
+    labelnames: Tuple[str, ...]
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._lock: threading.Lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> _LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'Metric {self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError()
+
+    def render(self) -> str:
+        return f'# HELP {self.name} {self.help}\n# TYPE {self.name} {self.type}\n' + ''.join(line + '\n' for line in self.samples())
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> None:
+        super().__init__(name, help, labelnames)
+        self._values: Dict[_LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key: _LabelValues = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values: List[Tuple[_LabelValues, float]] = sorted(self._values.items())
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}' for key, value in values]
+
+
+class Gauge(Metric):
+    """ A value that goes up and down. A series can also be a function, evaluated on every scrape """
+    type = 'gauge'
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> None:
+        super().__init__(name, help, labelnames)
+        self._values: Dict[_LabelValues, float] = {}
+        self._functions: Dict[_LabelValues, Callable[[], float]] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        key: _LabelValues = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key: _LabelValues = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: Callable[[], float], **labels: str) -> None:
+        key: _LabelValues = self._key(labels)
+        with self._lock:
+            self._functions[key] = function
+
+    def value(self, **labels: str) -> float:
+        key: _LabelValues = self._key(labels)
+        function: Optional[Callable[[], float]] = self._functions.get(key)
+        return function() if function is not None else self._values.get(key, 0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values: Dict[_LabelValues, float] = dict(self._values)
+            functions: Dict[_LabelValues, Callable[[], float]] = dict(self._functions)
+        for key, function in functions.items():
+            try:
+                values[key] = function()
+            except Exception:
+                # Una base cerrada no tiene que romper el scrape
+                values.pop(key, None)
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}' for key, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    """ Observations counted in cumulative buckets (le), with their sum and count, as Prometheus expects them """
+    type = 'histogram'
+    buckets: Tuple[float, ...]
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Por serie: cuenta de cada bucket (no acumulada, el ultimo es +Inf), suma y cantidad
+        self._series: Dict[_LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key: _LabelValues = self._key(labels)
+        bucket: int = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._series.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[bucket] += 1
+            total[0] += value
+
+    def count(self, **labels: str) -> int:
+        series: Optional[Tuple[List[int], List[float]]] = self._series.get(self._key(labels))
+        return sum(series[0]) if series is not None else 0
+
+    def sum(self, **labels: str) -> float:
+        series: Optional[Tuple[List[int], List[float]]] = self._series.get(self._key(labels))
+        return series[1][0] if series is not None else 0
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            series: List[Tuple[_LabelValues, List[int], float]] = [(key, list(counts), total[0]) for key, (counts, total) in sorted(self._series.items())]
+
+        lines: List[str] = []
+        for key, counts, total in series:
+            cumulative: int = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le: str = 'le="' + _format_value(bound) + '"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}')
+        return lines
+
+
+class Timer:
+    """
+    Observes the seconds spent in a block (as a context manager) or in every call of a function (as a decorator) in a
+    histogram.
+    """
+    histogram: Histogram
+    labels: Dict[str, str]
+    # Duracion del ultimo bloque medido
+    seconds: float
+
+    def __init__(self, histogram: Histogram, labels: Dict[str, str]) -> None:
+        self.histogram = histogram
+        self.labels = labels
+        self.seconds = 0
+        self._start: float = 0
+
+    def __enter__(self) -> 'Timer':
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.seconds = time.perf_counter() - self._start
+        self.histogram.observe(self.seconds, **self.labels)
+
+    def __call__(self, function: Callable[..., T]) -> Callable[..., T]:
+        @functools.wraps(function)
+        def timed_function(*args, **kwargs) -> T:
+            # Un timer por llamada: el decorador se comparte entre threads
+            with Timer(self.histogram, self.labels):
+                return function(*args, **kwargs)
+        return timed_function
+
+
+def timed(histogram: Histogram, **labels: str) -> Timer:
+    """
+    with timed(search_stage_seconds, stage='es_search'): ...
+    or
+    @timed(import_api_request_seconds, client='sync')
+    """
+    return Timer(histogram, labels)
+
+
+class MetricsRegistry:
+    """ The metrics of the application, rendered in the Prometheus text format by /metrics """
+
+    def __init__(self) -> None:
+        self._metrics: Dict[str, Metric] = {}
+        self._lock: threading.Lock = threading.Lock()
+
+    def _register(self, metric: Metric) -> Any:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'Metric {metric.name} is already registered')
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> Gauge:
+        return self._register(Gauge(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics: List[Metric] = list(self._metrics.values())
+        return ''.join(metric.render() for metric in metrics)
+
+
+registry: MetricsRegistry = MetricsRegistry()
+
+# Busquedas
+search_seconds: Histogram = registry.histogram('wiki_search_seconds', 'Duration of search requests', ('endpoint',))
+search_stage_seconds: Histogram = registry.histogram('wiki_search_stage_seconds', 'Duration of each stage of a search', ('stage',))
+search_executor_wait_seconds: Histogram = registry.histogram(
+    'wiki_search_executor_wait_seconds', 'Time search database calls wait for a thread of the search executor'
+)
+search_neo4j_seconds: Histogram = registry.histogram(
+    'wiki_search_neo4j_seconds', 'Time of the Neo4j queries of a search, split in running the Cypher and mapping the records', ('phase',)
+)
+
+# Import
+import_api_request_seconds: Histogram = registry.histogram(
+    'wiki_import_api_request_seconds', 'Duration of each HTTP request to the wiki source (every continuation is a request of its own)', ('client',)
+)
+import_api_errors_total: Counter = registry.counter('wiki_import_api_errors_total', 'Failed requests to the wiki source', ('client',))
+import_nodes_total: Counter = registry.counter('wiki_import_nodes_total', 'Articles imported')
+import_missing_pages_total: Counter = registry.counter(
+    'wiki_import_missing_pages_total', "Linked titles that don't exist or are disambiguations, ignored by the import"
+)
+import_nodes_per_second: Gauge = registry.gauge('wiki_import_nodes_per_second', 'Articles imported per second since the last progress report')
+import_write_batch_seconds: Histogram = registry.histogram(
+    'wiki_import_write_batch_seconds', 'Duration of the batched writes of the import', ('db', 'operation')
+)
+
+# Graph engine
+graph_engine_load_seconds: Histogram = registry.histogram('wiki_graph_engine_load_seconds', 'Duration of the loads of the graph engine copy of Neo4j')
+graph_engine_nodes: Gauge = registry.gauge('wiki_graph_engine_nodes', 'Articles in the last graph engine copy')
+graph_engine_links: Gauge = registry.gauge('wiki_graph_engine_links', 'Links in the last graph engine copy')
+
+# Bases
+db_transaction_retries_total: Counter = registry.counter(
+    'wiki_db_transaction_retries_total', 'Transactions the Neo4j driver retried after a transient error', ('db',)
+)
+db_pool_acquire_seconds: Histogram = registry.histogram('wiki_db_pool_acquire_seconds', 'Time waiting for a pooled connection', ('db',))
+db_pool_in_use: Gauge = registry.gauge('wiki_db_pool_in_use', 'Pooled connections in use (requests in flight for elastic)', ('db',))
+es_request_seconds: Histogram = registry.histogram('wiki_es_request_seconds', 'Duration of the requests to elastic', ('endpoint',))
@@ -1,19 +1,71 @@
 from dataclasses import dataclass, field
 from enum import Enum
-from typing import List, Union, Optional
+from typing import Any, Dict, List, Union, Optional
 
 from pydantic.main import BaseModel
 
 @dataclass
-class ImportArticleNode:
-    id: int
+class WikiPage:
+    """ The attributes of a MediaWikiPage the importer uses, for sources other than pymediawiki """
+    pageid: int
     title: str
+    revision_id: int
+    content: str
     links: List[str] = field(default_factory=list)
+    categories: List[str] = field(default_factory=list)
+    # Cantidad de referencias de los links que aparecen mas de una vez en el contenido
+    link_counts: Dict[str, int] = field(default_factory=dict)
+
+class ImportFailure(BaseModel):
+    article_id: int
+    reason: str
+
+class ImportStageStats(BaseModel):
+    # Links filtrados, titulos resueltos u operaciones de escritura
+    items: int = 0
+    # Tiempo trabajando, sumado entre los workers del stage
+    seconds_busy: float = 0
+    # Tiempo que el import estuvo esperando al stage (lugar en la cola o resultados)
+    seconds_waiting: float = 0
+    items_per_second: float = 0
 
 class ImportSummary(BaseModel):
     total_nodes: int
     total_relationships: int
     seconds_elapsed: int
+    failed_documents: List[ImportFailure] = []
+    # Links a paginas que no existen o son desambiguaciones
+    missing_pages: int = 0
+    unchanged_nodes: int = 0
+    deleted_nodes: int = 0
+    # Contadores de cada stage del pipeline de import, de esta ejecucion
+    stages: Dict[str, ImportStageStats] = {}
+
+class ImportJobStatus(str, Enum):
+    PENDING = 'PENDING'
+    RUNNING = 'RUNNING'
+    COMPLETED = 'COMPLETED'
+    FAILED = 'FAILED'
+    CANCELLED = 'CANCELLED'
+
+class ImportProgress(BaseModel):
+    current_dist: int = 0
+    total_nodes: int = 0
+    total_relationships: int = 0
+    nodes_per_second: float = 0
+    # Titulos del nivel actual que todavia falta resolver
+    queue_depth: int = 0
+    # Links a paginas que no existen o son desambiguaciones, ignorados
+    missing_pages: int = 0
+    seconds_elapsed: int = 0
+
+class ImportJobInfo(BaseModel):
+    job_id: str
+    status: ImportJobStatus
+    center_page: str
+    progress: ImportProgress
+    summary: Optional[ImportSummary] = None
+    error: Optional[str] = None
 
 class ArticleLink(BaseModel):
     article_id: int
@@ -103,7 +155,7 @@ GeneralFilter = Union[IdsFilter, TitlesFilter, CategoriesFilter]
 ElasticFilter = Union[ElasticTextSearchFilter]
 NeoFilter = Union[NeoDistanceFilter, NeoLinksFilter]
 
-# Primero se ejecuta elastic siempre - No hay ors
+# El orden entre elastic y Neo4j lo elige el planner (querys.plan_query) - No hay ors
 class ArticleQuery(BaseModel):
     return_type: QueryReturnTypes = QueryReturnTypes.NODE
     elastic_filter: Optional[List[ElasticFilter]] = None
@@ -112,9 +164,81 @@ class ArticleQuery(BaseModel):
     sort: Optional[QuerySort] = None
     limit: Optional[int] = None
     offset: Optional[int] = None
+    # next_cursor de la pagina anterior. Con limit y sin offset se pagina por keyset, sin recorrer las paginas anteriores
+    cursor: Optional[str] = None
+    # Devuelve, junto con el resultado, el detalle de lo que costo la busqueda en cada base (ver QueryProfile)
+    profile: bool = False
 
 
 SearchResult = Union[List[Union[ArticleNode, int, str]], ArticleCount]
 
+# Query Plan
+class QueryPlanOrder(str, Enum):
+    # Solo Neo4j filtra, no hay filtros de elastic. Si se pidio el contenido, se trae de elastic solo para el resultado.
+    NEO4J_ONLY = 'NEO4J_ONLY'
+    # Los ids que matchean en elastic se filtran en Neo4j
+    ES_FIRST = 'ES_FIRST'
+    # Los ids candidatos de Neo4j se filtran en elastic (terms) antes de la query final
+    NEO4J_FIRST = 'NEO4J_FIRST'
+
+class QueryPlan(BaseModel):
+    order: QueryPlanOrder
+    # Documentos que matchean los filtros de elastic (count)
+    es_estimate: Optional[int] = None
+    # Cota superior de los nodos que matchean los filtros de Neo4j, segun indices y grados (exacta con el graph engine)
+    neo_estimate: Optional[int] = None
+    # Ids que se pasaron de una base a la otra
+    transferred_ids: Optional[int] = None
+    # Los filtros de Neo4j se resolvieron con la copia del grafo en memoria en vez de Cypher
+    graph_engine: bool = False
+
+# Query Profile
+class Neo4jOperatorProfile(BaseModel):
+    """ An operator of the plan Neo4j executed, as reported by PROFILE """
+    operator: str
+    details: Optional[str] = None
+    rows: int = 0
+    db_hits: int = 0
+    children: List['Neo4jOperatorProfile'] = []
+
+Neo4jOperatorProfile.update_forward_refs()
+
+class Neo4jQueryProfile(BaseModel):
+    # Etapa de la busqueda que corrio la query (neo4j_candidates, execute)
+    stage: str
+    cypher: str
+    # Las listas largas (ids) se recortan
+    parameters: Dict[str, Any] = {}
+    # Hasta tener todas las filas, y mapeandolas a resultados
+    seconds: float = 0
+    mapping_seconds: float = 0
+    rows: int = 0
+    # Sumados entre todos los operadores
+    db_hits: int = 0
+    plan: Optional[Neo4jOperatorProfile] = None
+
+class ElasticQueryProfile(BaseModel):
+    stage: str
+    # Milisegundos, segun elastic, de una corrida perfilada de la misma query
+    took: int = 0
+    hits: int = 0
+    # profile.shards de la respuesta de elastic (segmentos, con el indice embebido)
+    profile: List[Dict[str, Any]] = []
+
+class QueryProfile(BaseModel):
+    # Segundos de cada etapa de la busqueda. Las etapas que corren en paralelo se solapan.
+    stages: Dict[str, float] = {}
+    neo4j: List[Neo4jQueryProfile] = []
+    elastic: List[ElasticQueryProfile] = []
+    # Ids pasados entre las bases: neo4j_to_es, es_to_neo4j, y es_contents (los nodos a los que se les trae el contenido)
+    transferred_ids: Dict[str, int] = {}
+    # Segundos armando los resultados, desde los registros de Neo4j o la copia del grafo
+    mapping_seconds: float = 0
+
 class SearchResponse(BaseModel):
     result: SearchResult
+    plan: Optional[QueryPlan] = None
+    # Cursor de la pagina siguiente, si la pagina esta completa
+    next_cursor: Optional[str] = None
+    # Solo si la query pidio profile
+    profile: Optional[QueryProfile] = None
@@ -1,35 +1,417 @@
-from typing import List, Optional, Dict
+import asyncio
+import base64
+import concurrent.futures
+import json
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Iterator, List, Optional, Dict, Tuple, TypeVar
 
-from models import ArticleNode, ArticleQuery, IdsFilter, NeoDistanceFilter, NeoLinksFilter, QueryReturnTypes, SearchResponse
+import numpy as np
+from neo4j.data import Record
+from pydantic import BaseModel
+
+from models import ArticleNode, ArticleQuery, ElasticFilter, IdsFilter, NeoDistanceFilter, NeoLinksFilter, Neo4jQueryProfile, QueryPlan, \
+    QueryPlanOrder, QueryProfile, QueryReturnTypes, QuerySort, SearchResponse, SearchResult, SortByEnum
 from dependencies.databases import neo_instance, es_instance
-from repositories.neo4j_repo import mapper
+from dependencies.settings import settings
+from graph_engine import CsrGraph, GraphPage, graph_engine
+from metrics import Timer, search_executor_wait_seconds, search_neo4j_seconds, search_seconds, search_stage_seconds, timed
+from repositories.elastic_repo import ElasticRepository
+from repositories.neo4j_repo import Neo4jFilterBuilder, Neo4jFinalBuilder, Neo4jRepository, mapper
+
+T = TypeVar('T')
+
+# Nodos por mget de contenido al streamear NODE_WITH_CONTENT
+CONTENT_BATCH_SIZE: int = 100
+
+# Los clientes de Neo4j y elastic son bloqueantes: las busquedas los usan desde este pool, no desde el event loop
+_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+
+class InvalidCursorException(ValueError):
+    pass
+
+
+@dataclass
+class PreparedQuery:
+    """ A search with its elastic part already run: what is left is the final Neo4j query, or the page of the graph engine """
+    plan: QueryPlan
+    neo_query: Optional[Neo4jFinalBuilder]
+    # Si se pidio NODE_WITH_CONTENT: el contenido se trae de elastic solo para los nodos del resultado
+    with_content: bool
+    # Orden de la paginacion por keyset, si se pagina con cursores
+    keyset: Optional[QuerySort]
+    limit: Optional[int]
+    # Si la busqueda se resolvio con el graph engine, no queda query de Neo4j
+    graph_page: Optional[GraphPage] = None
+    # Si la query pidio profile, lo que se va midiendo de la busqueda
+    profile: Optional[QueryProfile] = None
+    # Filas de la pagina segun el paso de keyset, antes de proyectarlas. Las completa _rows
+    keyset_rows: int = 0
+
+
+def search_executor() -> concurrent.futures.ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(settings.wiki_search_workers, thread_name_prefix='search')
+    return _executor
+
+
+async def _offload(stage: str, work: Callable[..., T], *args, profile: Optional[QueryProfile] = None) -> T:
+    """
+    Runs a blocking database call in the search executor, so the event loop keeps serving other requests. Its duration is
+    measured as the given stage of the search, apart from the time it waits for a thread, and added to the profile if given.
+    """
+    submitted: float = time.perf_counter()
+
+    def run() -> T:
+        search_executor_wait_seconds.observe(time.perf_counter() - submitted)
+        timer: Timer = timed(search_stage_seconds, stage=stage)
+        try:
+            with timer:
+                return work(*args)
+        finally:
+            if profile is not None:
+                profile.stages[stage] = profile.stages.get(stage, 0) + timer.seconds
+
+    return await asyncio.get_running_loop().run_in_executor(search_executor(), run)
 
 
 async def process_query(query: ArticleQuery) -> SearchResponse:
-    es = es_instance()
     neo = neo_instance()
+    prepared: PreparedQuery = await prepare_query(query)
+
+    results, next_cursor = await _offload('execute', _execute, neo, prepared, profile=prepared.profile)
+
+    # Agrego el content, solo de la pagina
+    if prepared.with_content:
+        if prepared.profile is not None:
+            prepared.profile.transferred_ids['es_contents'] = len(results)
+        await _offload('hydrate', _hydrate, es_instance(), results, profile=prepared.profile)
+
+    return SearchResponse(result=results, plan=prepared.plan, next_cursor=next_cursor, profile=prepared.profile)
 
-    neoBuilder = neo.buildQuery()
 
-    id_content_map: Optional[Dict[int, str]] = None
+def _execute(neo: Neo4jRepository, prepared: PreparedQuery) -> Tuple[SearchResult, Optional[str]]:
+    if prepared.keyset is None:
+        if prepared.graph_page is not None:
+            start: float = time.perf_counter()
+            results: SearchResult = prepared.graph_page.results()
+            if prepared.profile is not None:
+                prepared.profile.mapping_seconds += time.perf_counter() - start
+            return results, None
+        if prepared.profile is None:
+            return neo.executeQuery(prepared.neo_query), None
 
-    if query.elastic_filter is not None or query.return_type == QueryReturnTypes.NODE_WITH_CONTENT:
-        ids: List[int]
+        neo_profile: Neo4jQueryProfile = prepared.neo_query.profile('execute')
+        results = neo.executeQuery(prepared.neo_query, neo_profile)
+        prepared.profile.neo4j.append(neo_profile)
+        prepared.profile.mapping_seconds += neo_profile.mapping_seconds
+        return results, None
 
-        if query.elastic_filter is None:
-            query.elastic_filter = []
+    results = []
+    last: Optional[Tuple[Any, int]] = None
+    for result, key in _rows(neo, prepared):
+        results.append(result)
+        last = key
+    return results, _next_cursor(prepared, last)
 
-        # With or without content from elastic
-        if query.return_type == QueryReturnTypes.NODE_WITH_CONTENT:
-            id_content_map = {}
-            for (id, content) in es.search(query.elastic_filter, True):
-                id_content_map[id] = content
-            ids = list(id_content_map.keys())
+
+def _rows(neo: Neo4jRepository, prepared: PreparedQuery) -> Iterator[Tuple[Any, Optional[Tuple[Any, int]]]]:
+    """ (result, cursor key) of every row of the page, as they arrive. The key is None without keyset pagination """
+    sort_by: Optional[SortByEnum] = prepared.keyset.sort_by if prepared.keyset is not None else None
+    profile: Optional[QueryProfile] = prepared.profile
+    if prepared.graph_page is not None:
+        prepared.keyset_rows = len(prepared.graph_page.nodes)
+        if profile is None:
+            yield from prepared.graph_page.rows(sort_by)
+            return
+        rows: Iterator[Tuple[Any, Optional[Tuple[Any, int]]]] = prepared.graph_page.rows(sort_by)
+        while True:
+            start: float = time.perf_counter()
+            row: Optional[Tuple[Any, Optional[Tuple[Any, int]]]] = next(rows, None)
+            profile.mapping_seconds += time.perf_counter() - start
+            if row is None:
+                return
+            yield row
+
+    # Se mide por separado la espera de las filas y su mapeo, sin contar lo que tarda quien las consume
+    cypher_seconds: float = 0
+    mapping_seconds: float = 0
+    count: int = 0
+    neo_profile: Optional[Neo4jQueryProfile] = prepared.neo_query.profile('execute') if profile is not None else None
+    records: Iterator[Record] = neo.streamQuery(prepared.neo_query, neo_profile)
+    while True:
+        start: float = time.perf_counter()
+        record: Optional[Record] = next(records, None)
+        if record is None:
+            break
+        fetched: float = time.perf_counter()
+        result: Any = prepared.neo_query.map_record(record)
+        cypher_seconds += fetched - start
+        mapping_seconds += time.perf_counter() - fetched
+        count += 1
+        if sort_by is None:
+            yield result, None
         else:
-            ids = list(es.search(query.elastic_filter, False))
+            prepared.keyset_rows = record['page_rows']
+            yield result, (record['sort_key'], record['sort_id'])
+
+    cypher_seconds += time.perf_counter() - start
+    search_neo4j_seconds.observe(cypher_seconds, phase='cypher')
+    search_neo4j_seconds.observe(mapping_seconds, phase='mapping')
 
+    if neo_profile is not None:
+        neo_profile.rows = count
+        neo_profile.seconds = cypher_seconds
+        neo_profile.mapping_seconds = mapping_seconds
+        profile.neo4j.append(neo_profile)
+        profile.mapping_seconds += mapping_seconds
+
+
+async def stream_query(query: ArticleQuery) -> Iterator[str]:
+    """
+    The results of the search as NDJSON lines, as they arrive from Neo4j. If the page is full, the next line is
+    {"next_cursor": ...}, and with profile the last one is {"profile": ...}. The query is prepared (and validated) before
+    returning, so errors aren't raised mid-response.
+    The lines are produced with blocking calls: iterate them outside the event loop.
+    """
+    started: float = time.perf_counter()
+    neo = neo_instance()
+    prepared: PreparedQuery = await prepare_query(query)
+    return _stream_lines(neo, es_instance() if prepared.with_content else None, prepared, started)
+
+
+def _stream_lines(neo: Neo4jRepository, es: Optional[ElasticRepository], prepared: PreparedQuery, started: float) -> Iterator[str]:
+    # Etapa stream del profile: todo el stream, incluyendo lo que tarda el cliente en leerlo
+    executed: float = time.perf_counter()
+    last: Optional[Tuple[Any, int]] = None
+    # Con contenido, los nodos se mandan de a tandas: un mget por tanda
+    batch: List[Any] = []
+    for result, key in _rows(neo, prepared):
+        batch.append(result)
+        last = key
+        if es is None or len(batch) >= CONTENT_BATCH_SIZE:
+            yield from _ndjson_lines(es, batch, prepared.profile)
+            batch = []
+    yield from _ndjson_lines(es, batch, prepared.profile)
+
+    next_cursor: Optional[str] = _next_cursor(prepared, last)
+    if next_cursor is not None:
+        yield json.dumps({'next_cursor': next_cursor}) + '\n'
+
+    if prepared.profile is not None:
+        prepared.profile.stages['stream'] = time.perf_counter() - executed
+        yield json.dumps({'profile': prepared.profile.dict()}) + '\n'
+
+    search_seconds.observe(time.perf_counter() - started, endpoint='stream')
+
+
+async def prepare_query(query: ArticleQuery) -> PreparedQuery:
+    es = es_instance()
+    neo = neo_instance()
+
+    keyset: Optional[QuerySort] = _keyset_sort(query)
+    after: Optional[Tuple[Any, int]] = _decode_cursor(query.cursor, keyset) if query.cursor is not None else None
+    profile: Optional[QueryProfile] = QueryProfile() if query.profile else None
+
+    # Con la copia del grafo al dia no hace falta Cypher
+    graph: Optional[CsrGraph] = graph_engine.snapshot(neo)
+    if graph is not None:
+        return await _prepare_graph_query(query, es, graph, keyset, after, profile)
+
+    # El builder base busca el centro del import (cacheado), independiente del plan
+    plan, baseBuilder = await asyncio.gather(plan_query(query, es, neo, profile), _offload('neo4j_builder', neo.buildQuery, profile=profile))
+    with_content: bool = query.return_type == QueryReturnTypes.NODE_WITH_CONTENT
+    elastic_filter: List[ElasticFilter] = query.elastic_filter if query.elastic_filter is not None else []
+
+    ids: Optional[List[int]] = None
+
+    # Solo se resuelven ids: el contenido se trae despues, para la pagina que devuelve Neo4j
+    if plan.order == QueryPlanOrder.NEO4J_FIRST:
+        # Candidatos de Neo4j, que elastic filtra por id. La query final solo ordena y pagina esos ids.
+        candidatesQuery: Neo4jFinalBuilder = _add_filters(baseBuilder, query).returnType(QueryReturnTypes.ID)
+        candidates_profile: Optional[Neo4jQueryProfile] = candidatesQuery.profile('neo4j_candidates') if profile is not None else None
+        candidates: List[int] = await _offload('neo4j_candidates', neo.executeQuery, candidatesQuery, candidates_profile, profile=profile)
+        plan.transferred_ids = len(candidates)
+        ids = await _search_ids_profiled(es, elastic_filter, candidates, profile)
+    elif plan.order == QueryPlanOrder.ES_FIRST:
+        ids = await _search_ids_profiled(es, elastic_filter, None, profile)
+        plan.transferred_ids = len(ids)
+
+    if profile is not None:
+        if plan.order == QueryPlanOrder.NEO4J_FIRST:
+            profile.neo4j.append(candidates_profile)
+            profile.mapping_seconds += candidates_profile.mapping_seconds
+            profile.transferred_ids['neo4j_to_es'] = len(candidates)
+        if ids is not None:
+            profile.transferred_ids['es_to_neo4j'] = len(ids)
+
+    neoBuilder = baseBuilder
+
+    if ids is not None:
         neoBuilder = neoBuilder.generalFilter(IdsFilter(ids=ids))
 
+    if plan.order != QueryPlanOrder.NEO4J_FIRST:
+        neoBuilder = _add_filters(neoBuilder, query)
+
+    return_type: QueryReturnTypes = QueryReturnTypes.NODE if with_content else query.return_type
+
+    if keyset is not None:
+        neoBuilder = neoBuilder.keyset(keyset, after, query.limit).returnType(return_type)
+    else:
+        if query.sort is not None:
+            neoBuilder = neoBuilder.sortBy(query.sort)
+
+        neoBuilder = neoBuilder.returnType(return_type)
+
+        if query.offset is not None:
+            neoBuilder = neoBuilder.skip(query.offset)
+
+        if query.limit is not None:
+            neoBuilder = neoBuilder.limit(query.limit)
+
+    return PreparedQuery(plan=plan, neo_query=neoBuilder, with_content=with_content, keyset=keyset, limit=query.limit, profile=profile)
+
+
+async def _prepare_graph_query(query: ArticleQuery, es: ElasticRepository, graph: CsrGraph, keyset: Optional[QuerySort],
+                               after: Optional[Tuple[Any, int]], profile: Optional[QueryProfile]) -> PreparedQuery:
+    """
+    prepare_query with the Neo4j filters, sort and pagination solved by the graph engine. The plan is the same, but the
+    Neo4j count is exact and nothing is left for Neo4j.
+    """
+    with_content: bool = query.return_type == QueryReturnTypes.NODE_WITH_CONTENT
+    filtered: bool = bool(query.neo_filter) or bool(query.general_filters)
+    masking = _offload('graph_filter', graph.filter, query.neo_filter or [], query.general_filters or [], profile=profile)
+
+    mask: np.ndarray
+    if query.elastic_filter is None:
+        mask = await masking
+        plan: QueryPlan = QueryPlan(order=QueryPlanOrder.NEO4J_ONLY, neo_estimate=int(mask.sum()), graph_engine=True)
+    elif not filtered:
+        mask, ids = await asyncio.gather(masking, _search_ids_profiled(es, query.elastic_filter, None, profile))
+        mask &= graph.ids_mask(ids)
+        plan = QueryPlan(order=QueryPlanOrder.ES_FIRST, transferred_ids=len(ids), graph_engine=True)
+    else:
+        mask, es_estimate = await asyncio.gather(masking, _offload('plan_es_count', es.count, query.elastic_filter, profile=profile))
+        neo_count: int = int(mask.sum())
+        plan = QueryPlan(order=QueryPlanOrder.ES_FIRST, es_estimate=es_estimate, neo_estimate=neo_count, graph_engine=True)
+        if neo_count < es_estimate:
+            plan.order = QueryPlanOrder.NEO4J_FIRST
+            plan.transferred_ids = neo_count
+            if profile is not None:
+                profile.transferred_ids['neo4j_to_es'] = neo_count
+            ids = await _search_ids_profiled(es, query.elastic_filter, graph.ids_of(mask), profile)
+        else:
+            ids = await _search_ids_profiled(es, query.elastic_filter, None, profile)
+            plan.transferred_ids = len(ids)
+        mask &= graph.ids_mask(ids)
+
+    return_type: QueryReturnTypes = QueryReturnTypes.NODE if with_content else query.return_type
+    if return_type == QueryReturnTypes.COUNT:
+        nodes: np.ndarray = np.flatnonzero(mask)
+    else:
+        nodes = await _offload(
+            'graph_page', graph.page, mask, keyset if keyset is not None else query.sort, after, query.offset, query.limit, profile=profile
+        )
+
+    # Con la copia del grafo los ids de elastic no se pasan a Neo4j, pero igual se cruzan con los del grafo
+    if profile is not None and query.elastic_filter is not None:
+        profile.transferred_ids['es_to_neo4j'] = len(ids)
+
+    return PreparedQuery(
+        plan=plan, neo_query=None, with_content=with_content, keyset=keyset, limit=query.limit,
+        graph_page=GraphPage(graph, nodes, return_type), profile=profile
+    )
+
+
+def _search_ids(es: ElasticRepository, filters: List[ElasticFilter], ids: Optional[List[int]]) -> List[int]:
+    return list(es.search(filters, False, ids=ids))
+
+
+async def _search_ids_profiled(es: ElasticRepository, filters: List[ElasticFilter], ids: Optional[List[int]],
+                               profile: Optional[QueryProfile]) -> List[int]:
+    """ _search_ids in the es_search stage. With profile, the ids come from the profiled search (search_profiled) """
+    if profile is None:
+        return await _offload('es_search', _search_ids, es, filters, ids)
+
+    found, es_profile = await _offload('es_search', es.search_profiled, 'es_search', filters, ids, profile=profile)
+    profile.elastic.append(es_profile)
+    return found
+
+
+def _hydrate(es: ElasticRepository, nodes: List[ArticleNode]) -> None:
+    contents: Dict[int, str] = es.get_contents([node.id for node in nodes])
+    for node in nodes:
+        node.content = contents.get(node.id)
+
+
+def _ndjson_lines(es: Optional[ElasticRepository], items: List[Any], profile: Optional[QueryProfile] = None) -> Iterator[str]:
+    if es is not None:
+        with timed(search_stage_seconds, stage='hydrate') as timer:
+            _hydrate(es, items)
+        if profile is not None:
+            profile.stages['hydrate'] = profile.stages.get('hydrate', 0) + timer.seconds
+            profile.transferred_ids['es_contents'] = profile.transferred_ids.get('es_contents', 0) + len(items)
+    for item in items:
+        yield (item.json() if isinstance(item, BaseModel) else json.dumps(item)) + '\n'
+
+
+def _keyset_sort(query: ArticleQuery) -> Optional[QuerySort]:
+    """ Order of the keyset pagination, or None if the query is paginated with offset or isn't paginated """
+    if query.limit is None or query.offset is not None or query.return_type == QueryReturnTypes.COUNT:
+        if query.cursor is not None:
+            raise InvalidCursorException('A cursor requires a limit, no offset and a list return type')
+        return None
+
+    # Sin orden pedido, se pagina por id
+    return query.sort if query.sort is not None else QuerySort(sort_by=SortByEnum.ID)
+
+
+def _next_cursor(prepared: PreparedQuery, last: Optional[Tuple[Any, int]]) -> Optional[str]:
+    """ Cursor of the page after the one whose last row has the key last (sort key, article_id) """
+    # Una pagina incompleta es la ultima. Se cuentan las filas del paso de keyset, no las que quedaron al proyectarlas
+    if prepared.keyset is None or last is None or prepared.keyset_rows < prepared.limit:
+        return None
+
+    data: str = json.dumps([prepared.keyset.sort_by.value, prepared.keyset.type.value, last[0], last[1]])
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+
+def _decode_cursor(cursor: str, sort: QuerySort) -> Tuple[Any, int]:
+    try:
+        sort_by, sort_type, key, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise InvalidCursorException(f'Invalid cursor {cursor}')
+
+    if sort_by != sort.sort_by.value or sort_type != sort.type.value:
+        raise InvalidCursorException('The cursor belongs to a query with a different sort')
+    return key, id
+
+
+async def plan_query(query: ArticleQuery, es: ElasticRepository, neo: Neo4jRepository, profile: Optional[QueryProfile] = None) -> QueryPlan:
+    """
+    Chooses which database filters first, from cheap estimates of how many articles each one matches: an elastic count and
+    an upper bound from the Neo4j indexes and degrees. The most selective one goes first and passes its ids to the other.
+    """
+    if query.elastic_filter is None:
+        return QueryPlan(order=QueryPlanOrder.NEO4J_ONLY)
+
+    # Sin filtros de Neo4j no hay nada que estimar: Neo4j matchea todo
+    if not query.neo_filter and not query.general_filters:
+        return QueryPlan(order=QueryPlanOrder.ES_FIRST)
+
+    es_estimate, neo_estimate = await asyncio.gather(
+        _offload('plan_es_count', es.count, query.elastic_filter, profile=profile),
+        _offload('plan_neo4j_estimate', neo.estimate_cardinality, query.neo_filter or [], query.general_filters or [], profile=profile)
+    )
+
+    # Neo4j primero cuesta una query mas, solo conviene si achica lo que se transfiere
+    order: QueryPlanOrder = QueryPlanOrder.NEO4J_FIRST if neo_estimate < es_estimate else QueryPlanOrder.ES_FIRST
+    return QueryPlan(order=order, es_estimate=es_estimate, neo_estimate=neo_estimate)
+
+
+def _add_filters(neoBuilder: Neo4jFilterBuilder, query: ArticleQuery) -> Neo4jFilterBuilder:
     if query.neo_filter is not None:
         for filter in query.neo_filter:
             if type(filter) is NeoDistanceFilter:
@@ -41,45 +423,18 @@ async def process_query(query: ArticleQuery) -> SearchResponse:
         for filter in query.general_filters:
             neoBuilder = neoBuilder.generalFilter(filter)
 
-    if query.sort is not None:
-        neoBuilder = neoBuilder.sortBy(query.sort)
-
-    if query.return_type == QueryReturnTypes.NODE_WITH_CONTENT:
-        neoBuilder = neoBuilder.returnType(QueryReturnTypes.NODE)
-    else:
-        neoBuilder = neoBuilder.returnType(query.return_type)
-
-    if query.offset is not None:
-        neoBuilder = neoBuilder.skip(query.offset)
-
-    if query.limit is not None:
-        neoBuilder = neoBuilder.limit(query.limit)
-    
-    results = neo.executeQuery(neoBuilder)
-
-    # Agrego el content si aplica
-    if query.return_type == QueryReturnTypes.NODE_WITH_CONTENT:
-        if id_content_map is None:
-            raise AssertionError('id_content_map must not be None')
-
-        for node in results:
-            node.content = id_content_map[node.id]
-
-    return SearchResponse(result=results)
+    return neoBuilder
 
     
 def strict_search_query(center: str, string: str, leaps: int) -> List[ArticleNode]:
     es = es_instance()
     neo = neo_instance()
-    
-    articles = es.strict_search_query(string)
-    results: List[ArticleNode] = []
-    for h in articles:
-        if h.title != center:
-            record = neo.radius_search(center, h.title, leaps)
-            if record is not None:
-                results.append(mapper(record[0]))
-    
-    results.append(mapper(neo.get_connections(center)[0]))
-    
-    return results
\ No newline at end of file
+
+    # Todos los titulos que matchean, sin repetir, y una sola query a Neo4j para todos
+    with timed(search_stage_seconds, stage='es_strict_search'):
+        titles: List[str] = list(dict.fromkeys(es.strict_search_query(string)))
+    with timed(search_stage_seconds, stage='radius_search'):
+        graph: Optional[CsrGraph] = graph_engine.snapshot(neo)
+        if graph is not None:
+            return graph.radius_search(center, titles, leaps)
+        return [mapper(record[0]) for record in neo.radius_search(center, titles, leaps)]
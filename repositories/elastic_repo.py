@@ -1,9 +1,13 @@
+import itertools
 from typing import Optional, List, Dict, Any, Iterator, Union, Tuple, overload, Literal
 
-from elasticsearch_dsl import Index, Document, Text, Keyword, Search, Q, response, analyzer
+from elasticsearch import Elasticsearch, Urllib3HttpConnection
+from elasticsearch.helpers import streaming_bulk
+from elasticsearch_dsl import Index, Document, Text, Keyword, Long, Search, Q, analyzer
 from elasticsearch_dsl.connections import connections
 
-from models import ElasticFilter, BoolOp, TextSearchField
+from metrics import db_pool_in_use, es_request_seconds, import_write_batch_seconds, timed
+from models import ElasticFilter, ElasticQueryProfile, BoolOp, TextSearchField, ImportFailure
 
 _content_analyzer = analyzer(
     'folding_analyzer',
@@ -11,15 +15,34 @@ _content_analyzer = analyzer(
     filter=["lowercase", "asciifolding"]
 )
 
+class InstrumentedConnection(Urllib3HttpConnection):
+    """ Transport connection that measures every request to elastic, by endpoint (_search, _bulk, ...), and counts the ones in flight """
+
+    def perform_request(self, method, url, params=None, body=None, timeout=None, ignore=(), headers=None):
+        # El primer segmento del path que empieza con '_' es el endpoint: las labels no dependen del indice ni del id
+        endpoint: str = next((part for part in url.split('?')[0].split('/') if part.startswith('_')), 'index')
+        db_pool_in_use.inc(db='elasticsearch')
+        try:
+            with timed(es_request_seconds, endpoint=endpoint):
+                return super().perform_request(method, url, params, body, timeout, ignore, headers)
+        finally:
+            db_pool_in_use.dec(db='elasticsearch')
+
+
 class ElasticArticle(Document):
     article_id: int = Keyword()
     title: str = Text()
     content: str = Text(analyzer=_content_analyzer)
     categories: str = Keyword()
+    revision_id: int = Long()
 
 class ElasticRepository:
 
     __repo_counter: int = 0
+    # index.max_terms_count por defecto: mas ids en un filtro terms hacen fallar la busqueda
+    MAX_TERMS: int = 65536
+    # Hits por request de search_profiled (index.max_result_window por defecto)
+    PROFILE_PAGE_SIZE: int = 10000
 
     def __init__(self, ip: str, port: int, user: Optional[str], password: Optional[str], index: str) -> None:
         self.__repo_counter += 1
@@ -27,7 +50,7 @@ class ElasticRepository:
 
         auth: str = f'{user}:{password}' if user and password else None
         # Crea una conexion global con el nombre 'repo_id'
-        connections.create_connection(self.repo_id, hosts=[f'{ip}:{port}'], http_auth=auth)
+        connections.create_connection(self.repo_id, hosts=[f'{ip}:{port}'], http_auth=auth, connection_class=InstrumentedConnection)
 
         # Creamos el indice
         self.index: Index = Index(index, using=self.repo_id)
@@ -41,20 +64,103 @@ class ElasticRepository:
         self.index.delete()
         self.index.create()
 
-    def create_article(self, id: int, title: str, content: str, categories: List[str]) -> ElasticArticle:
-        article: ElasticArticle = ElasticArticle(article_id=id, title=title, content=content, categories=categories)
+    def create_article(self, id: int, title: str, content: str, categories: List[str], revision_id: Optional[int] = None) -> ElasticArticle:
+        # El id del documento es el id del articulo
+        article: ElasticArticle = ElasticArticle(meta={'id': id}, article_id=id, title=title, content=content, categories=categories, revision_id=revision_id)
         article.save()
         return article
 
+    def delete_articles(self, ids: List[int]) -> int:
+        actions = ({'_op_type': 'delete', '_index': self.index._name, '_id': id} for id in ids)
+        deleted: int = 0
+        for ok, _ in streaming_bulk(self.client(), actions, raise_on_error=False):
+            deleted += ok
+        return deleted
+
+    def bulk_indexer(self, chunk_size: int = 500, max_chunk_bytes: int = 10 * 1024 * 1024,
+                     original_settings: Optional[Dict[str, Any]] = None) -> 'ElasticBulkIndexer':
+        """
+        Parameters:
+        chunk_size - Max amount of documents sent in a single bulk request.
+        max_chunk_bytes - Max size in bytes of a single bulk request. Also caps the documents buffered in memory.
+        original_settings - Index settings to restore on close. By default, the ones the index has when opening the indexer.
+            Needed when resuming an import, as the index still has the import settings.
+        """
+        return ElasticBulkIndexer(self, chunk_size, max_chunk_bytes, original_settings)
+
+    def get_import_settings(self) -> Dict[str, Any]:
+        index_settings: Dict[str, Any] = next(iter(self.index.get_settings().values()))['settings']['index']
+        return {key: index_settings.get(key, None) for key in ('refresh_interval', 'number_of_replicas')}
+
+    def put_import_settings(self, refresh_interval: Optional[str], number_of_replicas: Optional[Union[str, int]]) -> None:
+        # None vuelve el setting a su valor por defecto
+        self.index.put_settings(body={'index': {'refresh_interval': refresh_interval, 'number_of_replicas': number_of_replicas}})
+
+    def refresh(self) -> None:
+        self.index.refresh()
+
     @overload
-    def search(self, filters: List[ElasticFilter], with_content: Literal[True] = True) -> Iterator[Tuple[int, str]]:
+    def search(self, filters: List[ElasticFilter], with_content: Literal[True] = True, ids: Optional[List[int]] = None) -> Iterator[Tuple[int, str]]:
         pass
 
     @overload
-    def search(self, filters: List[ElasticFilter], with_content: Literal[False] = False) -> Iterator[int]:
+    def search(self, filters: List[ElasticFilter], with_content: Literal[False] = False, ids: Optional[List[int]] = None) -> Iterator[int]:
         pass
 
-    def search(self, filters: List[ElasticFilter], with_content: bool = False) -> Iterator[Union[int, Tuple[int, str]]]:
+    def search(self, filters: List[ElasticFilter], with_content: bool = False, ids: Optional[List[int]] = None) -> Iterator[Union[int, Tuple[int, str]]]:
+        """
+        Parameters:
+        ids - If given, only these articles are searched (terms filter). Used when Neo4j is more selective than the filters.
+            Split in as many searches as needed to respect the index's max_terms_count.
+        """
+        # Projection
+        include: List[str] = ['article_id']
+        if with_content:
+            include.append('content')
+
+        if ids is None:
+            hits = self._build_search(filters).source(include=include).scan()
+        else:
+            chunks = (ids[i:i + self.MAX_TERMS] for i in range(0, len(ids), self.MAX_TERMS))
+            hits = itertools.chain.from_iterable(self._build_search(filters, chunk).source(include=include).scan() for chunk in chunks)
+
+        return map(self._id_content_mapper if with_content else self._id_mapper, hits)
+
+    def get_contents(self, ids: List[int]) -> Dict[int, str]:
+        """ Content of the given articles, with a single mget. Articles that aren't indexed are left out """
+        if not ids:
+            return {}
+        response: Dict[str, Any] = self.client().mget(body={'ids': ids}, index=self.index._name, _source_includes=['content'])
+        return {int(doc['_id']): doc['_source'].get('content') for doc in response['docs'] if doc.get('found')}
+
+    def count(self, filters: List[ElasticFilter]) -> int:
+        """ Amount of articles matching the filters, without fetching them """
+        return self._build_search(filters).count()
+
+    def search_profiled(self, stage: str, filters: List[ElasticFilter], ids: Optional[List[int]] = None) -> Tuple[List[int], ElasticQueryProfile]:
+        """
+        The ids of search(), with the took, hits and profile of the same requests that found them. Scroll doesn't report
+        them per page, so the hits are paged with search_after instead, by article_id (unique). One profile per request.
+        """
+        profile: ElasticQueryProfile = ElasticQueryProfile(stage=stage)
+        found: List[int] = []
+        chunks = [None] if ids is None else (ids[i:i + self.MAX_TERMS] for i in range(0, len(ids), self.MAX_TERMS))
+        for chunk in chunks:
+            s = self._build_search(filters, chunk).source(include=['article_id']).sort('article_id') \
+                .extra(size=self.PROFILE_PAGE_SIZE, profile=True, track_total_hits=True)
+            while True:
+                response: Dict[str, Any] = s.execute().to_dict()
+                hits: List[Dict[str, Any]] = response['hits']['hits']
+                profile.took += response['took']
+                profile.profile.extend(response.get('profile', {}).get('shards', []))
+                found.extend(hit['_source']['article_id'] for hit in hits)
+                if len(hits) < self.PROFILE_PAGE_SIZE:
+                    break
+                s = s.extra(search_after=hits[-1]['sort'])
+            profile.hits += response['hits']['total']['value']
+        return found, profile
+
+    def _build_search(self, filters: List[ElasticFilter], ids: Optional[List[int]] = None) -> Search:
         must: List[Q] = []
         should: List[Q] = []
 
@@ -72,18 +178,15 @@ class ElasticRepository:
 
                 op.append(Q(query_type, **query_params))
 
-        # Projection
-        include: List[str] = ['article_id']
-        if with_content:
-            include.append('content')
-
         # Prepare search
         s = Search(using=connections.get_connection(self.repo_id), index=self.index._name)
-        if filters:
+        if ids is not None:
+            # Filter context: no afecta el score y se puede cachear. La query de texto queda anidada, porque con un
+            # filter al lado los should dejarian de ser obligatorios.
+            s = s.query('bool', must=[Q('bool', must=must, should=should)] if filters else [], filter=[Q('terms', article_id=ids)])
+        elif filters:
             s = s.query('bool', must=must, should=should)
-        s = s.source(include=include)
-
-        return map(self._id_content_mapper if with_content else self._id_mapper, s.scan())
+        return s
 
     @staticmethod
     def _id_mapper(hit):
@@ -93,8 +196,100 @@ class ElasticRepository:
     def _id_content_mapper(hit):
         return hit.article_id, hit.content
 
-    def strict_search_query(self, string: str) -> response:
-        s = Search(using=self.repo_id)
+    def client(self) -> Elasticsearch:
+        return connections.get_connection(self.repo_id)
+
+    def strict_search_query(self, string: str) -> Iterator[str]:
+        """ Titles of every article matching the query string. Hits are paged with scroll, not just the first page """
+        s = Search(using=connections.get_connection(self.repo_id), index=self.index._name)
         s = s.query('query_string', **{'query': string, 'default_field': 'content'})
-        # s = s.query("query_string", query=string, fields=['content'])
-        return s.execute()
+        s = s.source(include=['title'])
+        return (hit.title for hit in s.scan())
+
+
+class ElasticBulkIndexer:
+    """
+    Buffers articles and indexes them with the bulk API, chunk_size documents or max_chunk_bytes per request.
+    While open, the index doesn't refresh and has no replicas. On close, the original settings are restored and the
+    index is refreshed once.
+    Documents that fail to index don't abort the import: they are collected in failures.
+    """
+    repo: ElasticRepository
+    chunk_size: int
+    max_chunk_bytes: int
+    failures: List[ImportFailure]
+    indexed: int
+
+    def __init__(self, repo: ElasticRepository, chunk_size: int, max_chunk_bytes: int, original_settings: Optional[Dict[str, Any]] = None) -> None:
+        if chunk_size <= 0 or max_chunk_bytes <= 0:
+            raise ValueError(f'Invalid chunk size {chunk_size} or max chunk bytes {max_chunk_bytes}')
+
+        self.repo = repo
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.failures = []
+        self.indexed = 0
+
+        self._buffer: List[Dict[str, Any]] = []
+        self._buffer_bytes: int = 0
+        self.original_settings: Optional[Dict[str, Any]] = original_settings
+        self._open: bool = False
+
+    def __enter__(self) -> 'ElasticBulkIndexer':
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        # Si hubo un error no escribimos el batch parcial, pero si restauramos el indice
+        if exc_type is None:
+            self.flush()
+        self._restore()
+
+    def open(self) -> None:
+        if self.original_settings is None:
+            self.original_settings = self.repo.get_import_settings()
+        self.repo.put_import_settings('-1', 0)
+        self._open = True
+
+    def create_article(self, id: int, title: str, content: str, categories: List[str], revision_id: Optional[int] = None) -> None:
+        self._buffer.append({
+            '_index': self.repo.index._name,
+            '_id': id,
+            '_source': {'article_id': id, 'title': title, 'content': content, 'categories': categories, 'revision_id': revision_id},
+        })
+        # Estimacion del tamaño del documento. El contenido es lo que domina.
+        self._buffer_bytes += len(content.encode()) + len(title.encode())
+
+        if len(self._buffer) >= self.chunk_size or self._buffer_bytes >= self.max_chunk_bytes:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._buffer:
+            return
+
+        results = streaming_bulk(
+            self.repo.client(), self._buffer, chunk_size=self.chunk_size, max_chunk_bytes=self.max_chunk_bytes,
+            raise_on_error=False, raise_on_exception=False
+        )
+        with timed(import_write_batch_seconds, db='elasticsearch', operation='bulk'):
+            for ok, item in results:
+                if ok:
+                    self.indexed += 1
+                else:
+                    info: Dict[str, Any] = next(iter(item.values()))
+                    self.failures.append(ImportFailure(article_id=int(info.get('_id', -1)), reason=str(info.get('error', info.get('exception', 'unknown')))))
+
+        self._buffer = []
+        self._buffer_bytes = 0
+
+    def close(self) -> None:
+        self.flush()
+        self._restore()
+
+    def _restore(self) -> None:
+        if not self._open:
+            return
+
+        self.repo.put_import_settings(**self.original_settings)
+        self.repo.refresh()
+        self._open = False
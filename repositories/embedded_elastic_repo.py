@@ -0,0 +1,618 @@
+import contextlib
+import fnmatch
+import json
+import mmap
+import os
+import re
+import shutil
+import threading
+import time
+import unicodedata
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple, Union
+
+import numpy as np
+from elasticsearch_dsl import Index
+
+from metrics import import_write_batch_seconds, timed
+from models import BoolOp, ElasticFilter, ElasticQueryProfile, TextSearchField
+from repositories.elastic_repo import ElasticArticle, ElasticBulkIndexer, ElasticRepository
+
+# Tokens del tokenizer standard: letras y numeros, incluyendo apostrofes y puntos entre ellos ("don't", "3.14")
+_TOKEN = re.compile(r"\w+(?:['’.]\w+)*")
+# Letras que NFKD no descompone y asciifolding si pliega
+_FOLDING = str.maketrans({'ß': 'ss', 'æ': 'ae', 'Æ': 'AE', 'ø': 'o', 'Ø': 'O', 'œ': 'oe', 'Œ': 'OE', 'đ': 'd', 'Đ': 'D', 'ł': 'l', 'Ł': 'L',
+                          'þ': 'th', 'Þ': 'TH', 'ı': 'i'})
+
+
+def standard_analyzer(text: str) -> List[str]:
+    """ Same tokens as elastic's standard analyzer (the one of title): standard tokenizer and lowercase """
+    return _TOKEN.findall(text.lower())
+
+
+def folding_analyzer(text: str) -> List[str]:
+    """ Same tokens as _content_analyzer (the one of content): standard tokenizer, lowercase and asciifolding """
+    decomposed: str = unicodedata.normalize('NFKD', text.translate(_FOLDING))
+    return standard_analyzer(''.join(char for char in decomposed if not unicodedata.combining(char)))
+
+
+_ANALYZERS: Dict[str, Callable[[str], List[str]]] = {'title': standard_analyzer, 'content': folding_analyzer}
+
+# Como en elastic: fuzziness 2 y a lo sumo 50 terminos por palabra
+FUZZINESS: int = 2
+MAX_EXPANSIONS: int = 50
+FUZZY_CACHE_SIZE: int = 1024
+
+
+def edit_distance(a: str, b: str, max_distance: int) -> int:
+    """ Damerau-Levenshtein distance (with adjacent transpositions, like elastic's fuzzy), or max_distance + 1 if it is larger """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+
+    previous: Optional[List[int]] = None
+    current: List[int] = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        before, previous, current = previous, current, [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost: int = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if before is not None and i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], before[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+    return current[-1]
+
+
+class _FieldPostings:
+    """
+    Postings of a field of a segment. Terms are sorted, and the postings of term t are the docs (ordinals in the segment,
+    ascending) docs[term_offsets[t]:term_offsets[t + 1]]. The positions of posting p are positions[pos_offsets[p]:pos_offsets[p + 1]].
+    The arrays are memory mapped: only the term dictionary is loaded in memory.
+    """
+
+    def __init__(self, path: str, field: str) -> None:
+        with open(os.path.join(path, f'{field}.terms'), encoding='utf-8') as file:
+            self.terms: List[str] = file.read().split('\n') if os.path.getsize(file.name) > 0 else []
+        self.term_index: Dict[str, int] = {term: i for i, term in enumerate(self.terms)}
+        self.term_offsets: np.ndarray = np.load(os.path.join(path, f'{field}.term_offsets.npy'), mmap_mode='r')
+        self.docs: np.ndarray = np.load(os.path.join(path, f'{field}.docs.npy'), mmap_mode='r')
+        self.pos_offsets: np.ndarray = np.load(os.path.join(path, f'{field}.pos_offsets.npy'), mmap_mode='r')
+        self.positions: np.ndarray = np.load(os.path.join(path, f'{field}.positions.npy'), mmap_mode='r')
+        # Expandir un termino fuzzy recorre todo el diccionario: el segmento no cambia, asi que se cachea
+        self._fuzzy_cache: Dict[str, List[str]] = {}
+
+    def close(self) -> None:
+        # np.memmap no tiene close: el archivo se desmapea al liberar el ultimo array que lo referencia
+        del self.term_offsets, self.docs, self.pos_offsets, self.positions
+
+    @staticmethod
+    def write(path: str, field: str, postings: Dict[str, List[Tuple[int, List[int]]]]) -> None:
+        terms: List[str] = sorted(postings)
+        term_offsets: List[int] = [0]
+        docs: List[int] = []
+        pos_offsets: List[int] = [0]
+        positions: List[int] = []
+        for term in terms:
+            for doc, doc_positions in postings[term]:
+                docs.append(doc)
+                positions.extend(doc_positions)
+                pos_offsets.append(len(positions))
+            term_offsets.append(len(docs))
+
+        with open(os.path.join(path, f'{field}.terms'), 'w', encoding='utf-8') as file:
+            file.write('\n'.join(terms))
+        np.save(os.path.join(path, f'{field}.term_offsets.npy'), np.array(term_offsets, dtype=np.int64))
+        np.save(os.path.join(path, f'{field}.docs.npy'), np.array(docs, dtype=np.int32))
+        np.save(os.path.join(path, f'{field}.pos_offsets.npy'), np.array(pos_offsets, dtype=np.int64))
+        np.save(os.path.join(path, f'{field}.positions.npy'), np.array(positions, dtype=np.int32))
+
+    def term_range(self, term: str) -> Optional[Tuple[int, int]]:
+        """ Range of the postings of term, None if it isn't in the segment """
+        index: Optional[int] = self.term_index.get(term)
+        if index is None:
+            return None
+        return int(self.term_offsets[index]), int(self.term_offsets[index + 1])
+
+    def docs_of(self, term: str) -> np.ndarray:
+        postings: Optional[Tuple[int, int]] = self.term_range(term)
+        if postings is None:
+            return np.zeros(0, dtype=np.int32)
+        return self.docs[postings[0]:postings[1]]
+
+    def positions_of(self, term: str, doc: int) -> np.ndarray:
+        """ Positions of term in doc, empty if it doesn't appear """
+        start, end = self.term_range(term) or (0, 0)
+        posting: int = start + int(np.searchsorted(self.docs[start:end], doc))
+        if posting >= end or self.docs[posting] != doc:
+            return np.zeros(0, dtype=np.int32)
+        return self.positions[self.pos_offsets[posting]:self.pos_offsets[posting + 1]]
+
+    def fuzzy_terms(self, term: str) -> List[str]:
+        """ Up to MAX_EXPANSIONS terms at most FUZZINESS edits away from term, the closest first """
+        expansions: Optional[List[str]] = self._fuzzy_cache.get(term)
+        if expansions is None:
+            candidates: List[Tuple[int, str]] = []
+            for other in self.terms:
+                distance: int = edit_distance(term, other, FUZZINESS)
+                if distance <= FUZZINESS:
+                    candidates.append((distance, other))
+            expansions = [other for _, other in sorted(candidates)[:MAX_EXPANSIONS]]
+            if len(self._fuzzy_cache) >= FUZZY_CACHE_SIZE:
+                self._fuzzy_cache.clear()
+            self._fuzzy_cache[term] = expansions
+        return expansions
+
+    def matching_terms(self, pattern: str) -> List[str]:
+        """ Terms matching a wildcard pattern (* and ?) """
+        regex: re.Pattern = re.compile(fnmatch.translate(pattern))
+        return [term for term in self.terms if regex.match(term)]
+
+
+class _Segment:
+    """
+    Immutable set of indexed documents, in its own directory. Documents are numbered by article_id order. Their source
+    is kept as json in store.bin, memory mapped, for the contents and titles of the results.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path: str = path
+        self.name: str = os.path.basename(path)
+        self.ids: np.ndarray = np.load(os.path.join(path, 'ids.npy'), mmap_mode='r')
+        self.store_offsets: np.ndarray = np.load(os.path.join(path, 'store_offsets.npy'), mmap_mode='r')
+        self._store_file = open(os.path.join(path, 'store.bin'), 'rb')
+        # mmap no acepta archivos vacios
+        self._store: Union[mmap.mmap, bytes] = mmap.mmap(self._store_file.fileno(), 0, access=mmap.ACCESS_READ) if self.store_offsets[-1] > 0 else b''
+        self.fields: Dict[str, _FieldPostings] = {field: _FieldPostings(path, field) for field in _ANALYZERS}
+
+    @staticmethod
+    def write(path: str, documents: List[Tuple[int, Dict[str, Any]]]) -> '_Segment':
+        os.makedirs(path)
+        documents = sorted(documents, key=lambda document: document[0])
+
+        sources: List[bytes] = [json.dumps(source).encode() for _, source in documents]
+        with open(os.path.join(path, 'store.bin'), 'wb') as file:
+            for source in sources:
+                file.write(source)
+        np.save(os.path.join(path, 'ids.npy'), np.array([id for id, _ in documents], dtype=np.int64))
+        np.save(os.path.join(path, 'store_offsets.npy'), np.cumsum([0] + [len(source) for source in sources], dtype=np.int64))
+
+        for field, analyze in _ANALYZERS.items():
+            postings: Dict[str, List[Tuple[int, List[int]]]] = {}
+            for doc, (_, source) in enumerate(documents):
+                term_positions: Dict[str, List[int]] = {}
+                for position, token in enumerate(analyze(source.get(field) or '')):
+                    term_positions.setdefault(token, []).append(position)
+                for term, positions in term_positions.items():
+                    postings.setdefault(term, []).append((doc, positions))
+            _FieldPostings.write(path, field, postings)
+
+        return _Segment(path)
+
+    def close(self) -> None:
+        if isinstance(self._store, mmap.mmap):
+            self._store.close()
+        self._store_file.close()
+        del self.ids, self.store_offsets
+        for postings in self.fields.values():
+            postings.close()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def source(self, doc: int) -> Dict[str, Any]:
+        return json.loads(self._store[self.store_offsets[doc]:self.store_offsets[doc + 1]])
+
+    def ordinals(self, ids: np.ndarray) -> np.ndarray:
+        """ Ordinal of every id, -1 for the ones that aren't in the segment """
+        if len(self.ids) == 0:
+            return np.full(len(ids), -1, dtype=np.int64)
+        positions: np.ndarray = np.minimum(np.searchsorted(self.ids, ids), len(self.ids) - 1)
+        return np.where(self.ids[positions] == ids, positions, -1)
+
+    def mask(self, docs: np.ndarray) -> np.ndarray:
+        mask: np.ndarray = np.zeros(len(self), dtype=bool)
+        mask[docs] = True
+        return mask
+
+    # Queries
+
+    def match(self, field: str, text: str, fuzzy: bool) -> np.ndarray:
+        """ match query: documents with any of the tokens of text (or, if fuzzy, of the terms similar to them) """
+        postings: _FieldPostings = self.fields[field]
+        mask: np.ndarray = np.zeros(len(self), dtype=bool)
+        for token in _ANALYZERS[field](text):
+            for term in postings.fuzzy_terms(token) if fuzzy else [token]:
+                mask[postings.docs_of(term)] = True
+        return mask
+
+    def match_phrase(self, field: str, text: str) -> np.ndarray:
+        """ match_phrase query: documents with the tokens of text in consecutive positions """
+        postings: _FieldPostings = self.fields[field]
+        tokens: List[str] = _ANALYZERS[field](text)
+        mask: np.ndarray = np.zeros(len(self), dtype=bool)
+        if not tokens:
+            return mask
+
+        # Candidatos: los que tienen todos los tokens. Despues se verifican las posiciones de cada uno.
+        candidates: np.ndarray = postings.docs_of(tokens[0])
+        for token in tokens[1:]:
+            candidates = np.intersect1d(candidates, postings.docs_of(token), assume_unique=True)
+        for doc in candidates.tolist():
+            # Posiciones donde podria empezar la frase
+            starts: np.ndarray = postings.positions_of(tokens[0], doc)
+            for offset, token in enumerate(tokens[1:], 1):
+                starts = np.intersect1d(starts, postings.positions_of(token, doc) - offset, assume_unique=True)
+            mask[doc] = len(starts) > 0
+        return mask
+
+    def wildcard(self, field: str, pattern: str) -> np.ndarray:
+        postings: _FieldPostings = self.fields[field]
+        mask: np.ndarray = np.zeros(len(self), dtype=bool)
+        for term in postings.matching_terms(pattern.lower()):
+            mask[postings.docs_of(term)] = True
+        return mask
+
+
+class _QueryStringParser:
+    """
+    Subset of the query_string syntax that strict_search_query uses: terms, "phrases", wildcards (* and ?), field:
+    prefixes, AND/&&, OR/||, NOT/!, + and - modifiers and parentheses. Like elastic, terms without operator are OR'ed,
+    and NOT excludes from the clauses around it.
+    The result is a function from a segment to the mask of its matching documents.
+    """
+    _TOKENS: re.Pattern = re.compile(r'\s*(?:(\()|(\))|("(?:[^"\\]|\\.)*")|(&&|\|\||!)|([+-])?((?:\w+:)?)("(?:[^"\\]|\\.)*"|[^\s()"]+))')
+
+    def __init__(self, query: str, default_field: str) -> None:
+        self.default_field: str = default_field
+        self.tokens: List[Tuple[str, str]] = self._tokenize(query)
+        self.position: int = 0
+
+    def _tokenize(self, query: str) -> List[Tuple[str, str]]:
+        tokens: List[Tuple[str, str]] = []
+        for match in self._TOKENS.finditer(query):
+            open_paren, close_paren, phrase, operator, modifier, field, text = match.groups()
+            if open_paren or close_paren:
+                tokens.append(('paren', open_paren or close_paren))
+            elif phrase:
+                tokens.append(('term', phrase))
+            elif operator:
+                tokens.append(('op', {'&&': 'AND', '||': 'OR', '!': 'NOT'}[operator]))
+            elif text in ('AND', 'OR', 'NOT') and not modifier and not field:
+                tokens.append(('op', text))
+            else:
+                if modifier:
+                    tokens.append(('op', 'MUST' if modifier == '+' else 'NOT'))
+                tokens.append(('term', field + text))
+        return tokens
+
+    def parse(self) -> Callable[[_Segment], np.ndarray]:
+        clauses: List[Tuple[str, Callable[[_Segment], np.ndarray]]] = []
+        conjunction: bool = False
+        while self.position < len(self.tokens) and self.tokens[self.position] != ('paren', ')'):
+            kind, value = self.tokens[self.position]
+            self.position += 1
+            if kind == 'op' and value in ('AND', 'OR'):
+                # a AND b: los dos lados pasan a ser obligatorios
+                conjunction = value == 'AND'
+                if conjunction and clauses and clauses[-1][0] == 'should':
+                    clauses[-1] = ('must', clauses[-1][1])
+                continue
+
+            occur: str = 'must' if conjunction else 'should'
+            if kind == 'op':
+                occur = 'must_not' if value == 'NOT' else 'must'
+                if self.position >= len(self.tokens):
+                    break
+                kind, value = self.tokens[self.position]
+                self.position += 1
+            clauses.append((occur, self._primary(kind, value)))
+            conjunction = False
+
+        return lambda segment: self._evaluate(segment, clauses)
+
+    def _primary(self, kind: str, value: str) -> Callable[[_Segment], np.ndarray]:
+        if kind == 'paren' and value == '(':
+            group: Callable[[_Segment], np.ndarray] = self.parse()
+            self.position += 1  # El ')'
+            return group
+
+        field: str = self.default_field
+        prefix, separator, rest = value.partition(':')
+        if separator and prefix in _ANALYZERS and not value.startswith('"'):
+            field, value = prefix, rest
+
+        if value.startswith('"'):
+            phrase: str = value.strip('"').replace('\\"', '"')
+            return lambda segment: segment.match_phrase(field, phrase)
+        if '*' in value or '?' in value:
+            return lambda segment: segment.wildcard(field, value)
+        return lambda segment: segment.match(field, value, False)
+
+    @staticmethod
+    def _evaluate(segment: _Segment, clauses: List[Tuple[str, Callable[[_Segment], np.ndarray]]]) -> np.ndarray:
+        must: List[np.ndarray] = [query(segment) for occur, query in clauses if occur == 'must']
+        should: List[np.ndarray] = [query(segment) for occur, query in clauses if occur == 'should']
+        mask: np.ndarray = np.ones(len(segment), dtype=bool)
+        if must:
+            for clause in must:
+                mask &= clause
+        elif should:
+            mask = np.logical_or.reduce(should)
+        elif not any(occur == 'must_not' for occur, _ in clauses):
+            mask[:] = False
+        for occur, query in clauses:
+            if occur == 'must_not':
+                mask &= ~query(segment)
+        return mask
+
+
+class EmbeddedElasticRepository(ElasticRepository):
+    """
+    ElasticRepository over an embedded inverted index, in the process, instead of an Elasticsearch cluster. Searches
+    have the same semantics: match (with fuzziness 2 if fuzzy) and match_phrase over title and content, analyzed like
+    their elastic mappings.
+    The index is a list of immutable segments persisted in path/<index>, whose postings (with positions) are memory
+    mapped. Like elastic, writes become searchable on refresh(): each one writes the pending documents as a new segment
+    and marks the replaced and deleted ones. With the import settings (refresh_interval -1) that happens once, when the
+    bulk indexer closes. Past MAX_SEGMENTS they are merged into one.
+    Segments replaced by a refresh or a merge are closed (unmapped) as soon as no search is reading them.
+    """
+    MAX_SEGMENTS: int = 8
+
+    def __init__(self, path: str, index: str) -> None:
+        self.repo_id = f'wiki_es_embedded_{index}'
+        # El indice solo se usa por su nombre
+        self.index = Index(index)
+        self.path: str = os.path.join(path, index)
+        os.makedirs(self.path, exist_ok=True)
+
+        # (segmento, borrados) de la ultima version del indice. Se reemplaza entera, asi las busquedas no necesitan el lock.
+        self._segments: List[Tuple[_Segment, np.ndarray]] = []
+        # Documentos escritos desde el ultimo refresh: None si se borro
+        self._pending: Dict[int, Optional[Dict[str, Any]]] = {}
+        self._settings: Dict[str, Any] = {'refresh_interval': None, 'number_of_replicas': None}
+        self._generation: int = 0
+        self._lock: threading.Lock = threading.Lock()
+        # Busquedas en curso y segmentos reemplazados que alguna todavia puede estar leyendo
+        self._readers: int = 0
+        self._retired: List[_Segment] = []
+        self._readers_lock: threading.Lock = threading.Lock()
+        self._load()
+
+    def _load(self) -> None:
+        commit_path: str = os.path.join(self.path, 'segments.json')
+        if not os.path.exists(commit_path):
+            return
+        with open(commit_path) as file:
+            commit: Dict[str, Any] = json.load(file)
+        self._generation = commit['generation']
+        for name, deleted_file in commit['segments']:
+            segment: _Segment = _Segment(os.path.join(self.path, name))
+            deleted: np.ndarray = np.load(os.path.join(self.path, deleted_file)) if deleted_file else np.zeros(len(segment), dtype=bool)
+            self._segments.append((segment, deleted))
+
+    def close(self) -> None:
+        self.refresh()
+        with self._readers_lock:
+            for segment in self._retired + [segment for segment, _ in self._segments]:
+                segment.close()
+            self._retired = []
+
+    def truncate_db(self) -> None:
+        with self._lock:
+            self._pending.clear()
+            self._commit([])
+
+    def create_article(self, id: int, title: str, content: str, categories: List[str], revision_id: Optional[int] = None) -> ElasticArticle:
+        self.put(id, {'article_id': id, 'title': title, 'content': content, 'categories': categories, 'revision_id': revision_id})
+        self._auto_refresh()
+        return ElasticArticle(meta={'id': id}, article_id=id, title=title, content=content, categories=categories, revision_id=revision_id)
+
+    def delete_articles(self, ids: List[int]) -> int:
+        existing: List[int] = [id for id in ids if self._exists(id)]
+        with self._lock:
+            for id in ids:
+                self._pending[id] = None
+        self._auto_refresh()
+        return len(existing)
+
+    def put(self, id: int, source: Dict[str, Any]) -> None:
+        with self._lock:
+            self._pending[id] = source
+
+    def bulk_indexer(self, chunk_size: int = 500, max_chunk_bytes: int = 10 * 1024 * 1024,
+                     original_settings: Optional[Dict[str, Any]] = None) -> 'EmbeddedBulkIndexer':
+        return EmbeddedBulkIndexer(self, chunk_size, max_chunk_bytes, original_settings)
+
+    def get_import_settings(self) -> Dict[str, Any]:
+        return dict(self._settings)
+
+    def put_import_settings(self, refresh_interval: Optional[str], number_of_replicas: Optional[Union[str, int]]) -> None:
+        self._settings = {'refresh_interval': refresh_interval, 'number_of_replicas': number_of_replicas}
+
+    def _auto_refresh(self) -> None:
+        # Sin los settings del import, elastic refresca solo: aca se refresca en cada escritura
+        if self._settings['refresh_interval'] != '-1':
+            self.refresh()
+
+    def refresh(self) -> None:
+        with self._lock:
+            if not self._pending:
+                return
+            pending: Dict[int, Optional[Dict[str, Any]]] = self._pending
+            self._pending = {}
+
+            changed: np.ndarray = np.array(sorted(pending), dtype=np.int64)
+            segments: List[Tuple[_Segment, np.ndarray]] = []
+            for segment, deleted in self._segments:
+                ordinals: np.ndarray = segment.ordinals(changed)
+                if (ordinals >= 0).any():
+                    deleted = deleted.copy()
+                    deleted[ordinals[ordinals >= 0]] = True
+                segments.append((segment, deleted))
+
+            documents: List[Tuple[int, Dict[str, Any]]] = [(id, source) for id, source in pending.items() if source is not None]
+            if len(segments) + 1 > self.MAX_SEGMENTS:
+                # Merge: todos los documentos vivos en un solo segmento
+                documents += [
+                    (int(segment.ids[doc]), segment.source(doc)) for segment, deleted in segments for doc in np.flatnonzero(~deleted).tolist()
+                ]
+                segments = []
+            if documents:
+                segments.append((_Segment.write(self._next_path('segment'), documents), np.zeros(len(documents), dtype=bool)))
+            self._commit(segments)
+
+    def _next_path(self, prefix: str) -> str:
+        self._generation += 1
+        return os.path.join(self.path, f'{prefix}_{self._generation}')
+
+    def _commit(self, segments: List[Tuple[_Segment, np.ndarray]]) -> None:
+        """ Persists the new list of segments, atomically, and removes the files no longer used """
+        entries: List[Tuple[str, Optional[str]]] = []
+        for segment, deleted in segments:
+            deleted_file: Optional[str] = None
+            if deleted.any():
+                deleted_file = os.path.basename(self._next_path('deleted')) + '.npy'
+                np.save(os.path.join(self.path, deleted_file), deleted)
+            entries.append((segment.name, deleted_file))
+
+        commit_path: str = os.path.join(self.path, 'segments.json')
+        with open(commit_path + '.tmp', 'w') as file:
+            json.dump({'generation': self._generation, 'segments': entries}, file)
+        os.replace(commit_path + '.tmp', commit_path)
+
+        # Las busquedas en curso siguen leyendo los segmentos viejos: se cierran cuando terminan
+        with self._readers_lock:
+            kept: Set[int] = {id(segment) for segment, _ in segments}
+            self._retired.extend(segment for segment, _ in self._segments if id(segment) not in kept)
+            self._segments = segments
+            self._close_retired()
+
+        used: Set[str] = {name for entry in entries for name in entry if name is not None}
+        for name in os.listdir(self.path):
+            if name != 'segments.json' and name not in used:
+                path: str = os.path.join(self.path, name)
+                try:
+                    shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+                except OSError:
+                    # Algunas plataformas no borran archivos mapeados: quedan para el proximo commit
+                    pass
+
+    # Con _readers_lock tomado
+    def _close_retired(self) -> None:
+        if self._readers == 0:
+            for segment in self._retired:
+                segment.close()
+            self._retired = []
+
+    @contextlib.contextmanager
+    def _reading(self) -> Iterator[List[Tuple[_Segment, np.ndarray]]]:
+        """ The current segments, which aren't closed until the block ends even if a refresh replaces them """
+        with self._readers_lock:
+            self._readers += 1
+            segments: List[Tuple[_Segment, np.ndarray]] = self._segments
+        try:
+            yield segments
+        finally:
+            with self._readers_lock:
+                self._readers -= 1
+                self._close_retired()
+
+    def _exists(self, id: int) -> bool:
+        with self._reading() as segments:
+            for segment, deleted in segments:
+                ordinal: int = int(segment.ordinals(np.array([id], dtype=np.int64))[0])
+                if ordinal >= 0 and not deleted[ordinal]:
+                    return True
+        return False
+
+    # Busquedas
+
+    def search(self, filters: List[ElasticFilter], with_content: bool = False, ids: Optional[List[int]] = None) -> Iterator[Union[int, Tuple[int, str]]]:
+        """ Same as ElasticRepository.search. Results are ordered by article_id """
+        with self._reading() as segments:
+            matches: List[Tuple[_Segment, np.ndarray]] = self._matches(segments, self._filter_query(filters), ids)
+            if not with_content:
+                return iter(sorted(int(id) for segment, docs in matches for id in segment.ids[docs]))
+            return iter(sorted((int(segment.ids[doc]), segment.source(doc).get('content')) for segment, docs in matches for doc in docs.tolist()))
+
+    def count(self, filters: List[ElasticFilter]) -> int:
+        with self._reading() as segments:
+            return sum(len(docs) for _, docs in self._matches(segments, self._filter_query(filters), None))
+
+    def search_profiled(self, stage: str, filters: List[ElasticFilter], ids: Optional[List[int]] = None) -> Tuple[List[int], ElasticQueryProfile]:
+        """ Same as ElasticRepository.search_profiled. The profile has the hits of each segment """
+        start: float = time.perf_counter()
+        with self._reading() as segments:
+            matches: List[Tuple[_Segment, np.ndarray]] = self._matches(segments, self._filter_query(filters), ids)
+            found: List[int] = sorted(int(id) for segment, docs in matches for id in segment.ids[docs])
+        return found, ElasticQueryProfile(
+            stage=stage, took=int((time.perf_counter() - start) * 1000), hits=len(found),
+            profile=[{'segment': segment.name, 'hits': len(docs)} for segment, docs in matches]
+        )
+
+    def get_contents(self, ids: List[int]) -> Dict[int, str]:
+        wanted: np.ndarray = np.array(ids, dtype=np.int64)
+        contents: Dict[int, str] = {}
+        with self._reading() as segments:
+            for segment, deleted in segments:
+                ordinals: np.ndarray = segment.ordinals(wanted)
+                for doc in ordinals[ordinals >= 0].tolist():
+                    if not deleted[doc]:
+                        contents[int(segment.ids[doc])] = segment.source(doc).get('content')
+        return contents
+
+    def strict_search_query(self, string: str) -> Iterator[str]:
+        query: Callable[[_Segment], np.ndarray] = _QueryStringParser(string, 'content').parse()
+        # Los titulos se leen antes de soltar los segmentos
+        with self._reading() as segments:
+            return iter([segment.source(doc)['title'] for segment, docs in self._matches(segments, query, None) for doc in docs.tolist()])
+
+    @staticmethod
+    def _matches(segments: List[Tuple[_Segment, np.ndarray]], query: Callable[[_Segment], np.ndarray],
+                 ids: Optional[List[int]]) -> List[Tuple[_Segment, np.ndarray]]:
+        """ Live documents of every segment matching the query, and ids if given """
+        matches: List[Tuple[_Segment, np.ndarray]] = []
+        for segment, deleted in segments:
+            mask: np.ndarray = query(segment) & ~deleted
+            if ids is not None:
+                mask &= np.isin(segment.ids, np.array(ids, dtype=np.int64))
+            matches.append((segment, np.flatnonzero(mask)))
+        return matches
+
+    @staticmethod
+    def _filter_query(filters: List[ElasticFilter]) -> Callable[[_Segment], np.ndarray]:
+        """ The bool query of ElasticRepository._build_search """
+
+        def query(segment: _Segment) -> np.ndarray:
+            must: List[np.ndarray] = []
+            should: List[np.ndarray] = []
+            for filter in filters:
+                op: List[np.ndarray] = must if filter.bool_op == BoolOp.AND else should
+                field: str = 'title' if filter.field == TextSearchField.TITLE else 'content'
+                for match in filter.matches:
+                    # Solo se puede aplicar fuzzy si no es una frase
+                    op.append(segment.match_phrase(field, match) if ' ' in match else segment.match(field, match, filter.fuzzy))
+
+            # Con algun must los should no son obligatorios. Sin ninguno, matchea todo.
+            mask: np.ndarray = np.ones(len(segment), dtype=bool)
+            for clause in must:
+                mask &= clause
+            if should and not must:
+                mask = np.logical_or.reduce(should)
+            return mask
+
+        return query
+
+
+class EmbeddedBulkIndexer(ElasticBulkIndexer):
+    """ ElasticBulkIndexer for the embedded index: the buffered documents are written to the repository, no requests """
+    repo: EmbeddedElasticRepository
+
+    def flush(self) -> None:
+        with timed(import_write_batch_seconds, db='elasticsearch', operation='bulk'):
+            for action in self._buffer:
+                self.repo.put(int(action['_id']), action['_source'])
+                self.indexed += 1
+
+        self._buffer = []
+        self._buffer_bytes = 0
@@ -1,16 +1,25 @@
 from abc import abstractmethod
-import itertools
+import functools
+import time
 
 from neo4j.work.transaction import Transaction
+from metrics import db_pool_acquire_seconds, db_pool_in_use, db_transaction_retries_total, import_write_batch_seconds, search_neo4j_seconds, timed
 from models import ArticleNode, CategoriesFilter, DistanceFilterStrategy, GeneralFilter, IdsFilter, NeoDistanceFilter, \
-    NeoLinksFilter, QueryReturnTypes, QuerySort, RelationDirection, SortByEnum, TitlesFilter, SearchResult, ArticleCount, ArticleLink
-from typing import Any, List, Optional, Tuple, final, Dict
+    NeoFilter, NeoLinksFilter, Neo4jOperatorProfile, Neo4jQueryProfile, QueryReturnTypes, QuerySort, RelationDirection, SortByEnum, SortType, TitlesFilter, SearchResult, ArticleCount, \
+    ArticleLink
+from typing import Any, Callable, Hashable, Iterator, List, Optional, Tuple, final, Dict
 
 import neo4j
 from neo4j import GraphDatabase, Session, Result, ResultSummary
 from neo4j.data import Record
 
 class Neo4jRepository:
+    # Titulo del centro del ultimo import (el articulo con center_dist 0), cacheado
+    _center_title: Optional[str] = None
+    _center_loaded: bool = False
+    # Cambia cada vez que el import escribe, para saber si una copia del grafo quedo vieja. Solo ve las escrituras de este
+    # proceso: las de cualquiera cambian stored_graph_version()
+    graph_version: int = 0
 
     @staticmethod
     def _create_id_constraint(tx) -> None:
@@ -22,12 +31,40 @@ class Neo4jRepository:
         name_result: Result = tx.run('CREATE CONSTRAINT article_unique_title IF NOT EXISTS ON (a:Article) ASSERT a.title IS UNIQUE')
         name_result.consume()
 
+    @staticmethod
+    def _create_graph_version_constraint(tx) -> None:
+        tx.run('CREATE CONSTRAINT graph_version_unique_name IF NOT EXISTS ON (v:GraphVersion) ASSERT v.name IS UNIQUE').consume()
+
+    @staticmethod
+    def _change_graph_version(tx) -> None:
+        # Un solo nodo, fuera de los Article. Se escribe en la misma transaccion que los cambios del grafo.
+        tx.run("MERGE (v:GraphVersion {name: 'articles'}) SET v.version = randomUUID()").consume()
+
+    @staticmethod
+    def _create_degree_indexes(tx) -> None:
+        tx.run('CREATE INDEX article_out_degree IF NOT EXISTS FOR (a:Article) ON (a.out_degree)').consume()
+        tx.run('CREATE INDEX article_in_degree IF NOT EXISTS FOR (a:Article) ON (a.in_degree)').consume()
+
+    @staticmethod
+    def _create_center_dist_index(tx) -> None:
+        tx.run('CREATE INDEX article_center_dist IF NOT EXISTS FOR (a:Article) ON (a.center_dist)').consume()
+
+    @staticmethod
+    def _materialize_degrees(tx) -> None:
+        # Articulos importados antes de que se guardaran los grados
+        result: Result = tx.run(
+            'MATCH (a:Article) WHERE a.out_degree IS NULL OR a.in_degree IS NULL '
+            'SET a.out_degree = size((a)-[:Link]->()), a.in_degree = size((a)<-[:Link]-())'
+        )
+        result.consume()
+
     def __init__(self, ip: str, port: int, user: Optional[str], password: Optional[str],
                  database: Optional[str] = None) -> None:
         auth: Optional[Tuple[str, str]] = (user, password) if user and password else None
 
         self.driver = GraphDatabase.driver(f"neo4j://{ip}:{port}", auth=auth)
         self.db = database if database else neo4j.DEFAULT_DATABASE
+        self._instrument_pool()
 
         with self.session() as session:
             # id constraint
@@ -36,13 +73,32 @@ class Neo4jRepository:
             # name constraint
             session.write_transaction(self._create_name_constraint)
 
+            # graph version node constraint
+            session.write_transaction(self._create_graph_version_constraint)
+
+            # out_degree and in_degree indexes, and their values for articles imported without them
+            session.write_transaction(self._create_degree_indexes)
+            session.write_transaction(self._materialize_degrees)
+
+            # center_dist index
+            session.write_transaction(self._create_center_dist_index)
+
     def session(self) -> Session:
         return self.driver.session(database=self.db)
 
+    def _instrument_pool(self) -> None:
+        # El driver no expone metricas de su pool: se mide cuanto tarda acquire y se cuentan las conexiones en uso
+        pool = self.driver._pool
+        pool.acquire = timed(db_pool_acquire_seconds, db='neo4j')(pool.acquire)
+        db_pool_in_use.set_function(
+            lambda: sum(connection.in_use for connections in list(pool.connections.values()) for connection in list(connections)), db='neo4j'
+        )
+
     def close(self):
         self.driver.close()
 
     def truncate_db(self, session: Optional[Session] = None):
+        self.forget_center()
         if session:
             return session.write_transaction(self._truncate_db)
         else:
@@ -53,6 +109,7 @@ class Neo4jRepository:
     def _truncate_db(tx) -> None:
         name_result: Result = tx.run('MATCH (n) DETACH DELETE n')
         name_result.consume()
+        Neo4jRepository._change_graph_version(tx)
 
     def create_article(self, id: int, title: str, categories: List[str], session: Optional[Session] = None) -> bool:
         """
@@ -74,7 +131,9 @@ class Neo4jRepository:
             id=id, title=title, categories=categories
         )
 
-        return result.consume().counters.nodes_created == 1
+        created: bool = result.consume().counters.nodes_created == 1
+        Neo4jRepository._change_graph_version(tx)
+        return created
 
     def create_and_link_article(self, source_id: int, dest_id: int, dest_title: str, dest_categories: List[str], session: Optional[Session] = None) -> bool:
         """
@@ -98,6 +157,7 @@ class Neo4jRepository:
             source_id=source_id, dest_id=dest_id, dest_title=dest_title, dest_categories=dest_categories
         )
         summary: ResultSummary = result.consume()
+        Neo4jRepository._change_graph_version(tx)
 
         if summary.counters.relationships_created == 0:
             print(f'Relationship from node {source_id} to node {dest_id} wasn\'t created. Summary counters: {repr(summary.counters)}')
@@ -128,29 +188,264 @@ class Neo4jRepository:
 
         if result.consume().counters.relationships_created == 0:
             raise Neo4jWriteException(f'Tried to create duplicated relationship from node {source_id} to node `{dest_title}`')
+        Neo4jRepository._change_graph_version(tx)
+
+    def bulk_writer(self, session: Optional[Session] = None, batch_size: int = 1000, flush_seconds: float = 5) -> 'Neo4jBulkWriter':
+        """
+        Parameters:
+        session - Session used by the writer. If none is given, the writer opens its own and closes it on close().
+        batch_size - Amount of buffered nodes or relationships that triggers a flush.
+        flush_seconds - Max seconds a buffered write can wait before being flushed.
+        """
+        return Neo4jBulkWriter(self, session, batch_size, flush_seconds)
+
+    def center_title(self) -> Optional[str]:
+        """
+        Returns the title of the center of the import, the article with center_dist 0.
+        None if the articles were imported without center_dist.
+        """
+        if not self._center_loaded:
+            with self.session() as session:
+                self._center_title = session.read_transaction(self._get_center_title)
+            self._center_loaded = True
+        return self._center_title
+
+    def forget_center(self) -> None:
+        """ Discards the cached center title and changes graph_version. Called whenever the import writes """
+        self._center_loaded = False
+        self.graph_version += 1
+
+    def stored_graph_version(self) -> Optional[str]:
+        """
+        The version of the graph stored in the database, which every write transaction (of any process) changes.
+        None if nothing was written since it was created.
+        """
+        with self.session() as session:
+            return session.read_transaction(self._get_stored_graph_version)
+
+    @staticmethod
+    def _get_stored_graph_version(tx) -> Optional[str]:
+        record: Optional[Record] = tx.run("MATCH (v:GraphVersion {name: 'articles'}) RETURN v.version AS version").single()
+        return record['version'] if record is not None else None
+
+    @staticmethod
+    def _get_center_title(tx) -> Optional[str]:
+        record: Optional[Record] = tx.run('MATCH (a:Article) WHERE a.center_dist = 0 RETURN a.title AS title LIMIT 1').single()
+        return record['title'] if record is not None else None
+
+    @staticmethod
+    def _create_articles(tx, rows: List[Dict[str, Any]]) -> int:
+        # Si el articulo cambio (relink), sus links salientes se vuelven a crear. Los grados se mantienen al borrarlos.
+        result: Result = tx.run(
+            'UNWIND $rows AS row '
+            'MERGE (a:Article {article_id: row.id}) '
+            'ON CREATE SET a.out_degree = 0, a.in_degree = 0 '
+            'SET a.title = row.title, a.categories = row.categories, a.revision_id = row.revision_id, a.center_dist = row.center_dist '
+            'WITH a, row WHERE row.relink '
+            'FOREACH (dest IN [(a)-[:Link]->(m) | m] | SET dest.in_degree = dest.in_degree - 1) '
+            'FOREACH (link IN [(a)-[r:Link]->() | r] | DELETE link) '
+            'SET a.out_degree = 0',
+            rows=rows
+        )
+        created: int = result.consume().counters.nodes_created
+        Neo4jRepository._change_graph_version(tx)
+        return created
+
+    @staticmethod
+    def _set_center_dists(tx, rows: List[Dict[str, Any]]) -> None:
+        result: Result = tx.run(
+            'UNWIND $rows AS row '
+            'MATCH (a:Article {article_id: row.id}) '
+            'SET a.center_dist = row.center_dist',
+            rows=rows
+        )
+        result.consume()
+        Neo4jRepository._change_graph_version(tx)
 
-    def radius_search(self, center: str, string: str, leaps: int) -> Record:
+    def get_article_revisions(self) -> Dict[str, Tuple[int, Optional[int]]]:
+        """
+        Returns title -> (article id, revision id) of every article. Revision id is None if the article was imported without it.
+        """
         with self.session() as session:
-            return session.write_transaction(self._radius_search, center, string, leaps)
+            return session.read_transaction(self._get_article_revisions)
 
     @staticmethod
-    def _radius_search(tx: Transaction, center: str, string: str, leaps: int) -> Record:
+    def _get_article_revisions(tx) -> Dict[str, Tuple[int, Optional[int]]]:
+        result: Result = tx.run('MATCH (a:Article) RETURN a.title AS title, a.article_id AS id, a.revision_id AS revision_id')
+        return {record['title']: (record['id'], record['revision_id']) for record in result}
+
+    def delete_articles(self, articles: List[Tuple[int, str]], session: Optional[Session] = None) -> List[int]:
+        """
+        Parameters:
+        articles - (id, title) of the articles to delete. Both have to match, so articles renamed since are kept.
+        Returns the ids of the deleted articles.
+        """
+        rows: List[Dict[str, Any]] = [{'id': id, 'title': title} for id, title in articles]
+        self.forget_center()
+        if session:
+            return session.write_transaction(self._delete_articles, rows)
+        else:
+            with self.session() as session:
+                return session.write_transaction(self._delete_articles, rows)
+
+    @staticmethod
+    def _delete_articles(tx, rows: List[Dict[str, Any]]) -> List[int]:
+        result: Result = tx.run(
+            'UNWIND $rows AS row '
+            'MATCH (a:Article {article_id: row.id, title: row.title}) '
+            'FOREACH (dest IN [(a)-[:Link]->(m) | m] | SET dest.in_degree = dest.in_degree - 1) '
+            'FOREACH (source IN [(m)-[:Link]->(a) | m] | SET source.out_degree = source.out_degree - 1) '
+            'DETACH DELETE a '
+            'RETURN row.id AS id',
+            rows=rows
+        )
+        deleted: List[int] = [record['id'] for record in result]
+        Neo4jRepository._change_graph_version(tx)
+        return deleted
+
+    @staticmethod
+    def _link_articles(tx, rows: List[Dict[str, Any]]) -> int:
+        # count son las veces que el articulo referencia al otro. Si la relacion ya existia (llegamos por otro alias, o
+        # se reintenta la escritura) nos quedamos con la mayor, asi reescribir es idempotente.
+        result: Result = tx.run(
+            'UNWIND $rows AS row '
+            'MATCH (n:Article {article_id: row.source_id}) '
+            'MATCH (v:Article {title: row.dest_title}) '
+            'MERGE (n)-[r:Link]->(v) '
+            'ON CREATE SET r.count = row.count, n.out_degree = coalesce(n.out_degree, 0) + 1, v.in_degree = coalesce(v.in_degree, 0) + 1 '
+            'ON MATCH SET r.count = CASE WHEN coalesce(r.count, 0) < row.count THEN row.count ELSE r.count END',
+            rows=rows
+        )
+        created: int = result.consume().counters.relationships_created
+        Neo4jRepository._change_graph_version(tx)
+        return created
+
+    def radius_search(self, center: str, titles: List[str], leaps: int) -> List[Record]:
+        """
+        Returns the articles in titles that are at most leaps links away (in any direction) from center, and then center
+        itself, each one with its links, even if it has none (as the searches and the graph engine). Everything in a single
+        query, whatever the amount of titles.
+        """
+        with self.session() as session:
+            return session.read_transaction(self._radius_search, center, titles, leaps)
+
+    @staticmethod
+    def _radius_search(tx: Transaction, center: str, titles: List[str], leaps: int) -> List[Record]:
+        # La longitud maxima de un camino variable no puede ser un parametro
         result = tx.run(
-            "MATCH (center:Article {title: $center_title}), (exterior:Article {title: $ext_title}), "
-            "p = shortestPath((center)-[*1.." + str(leaps) + "]-(exterior)) "
-                                                             "MATCH (exterior)-[]->(m) "
-                                                             "RETURN {article_id: exterior.article_id, title: exterior.title, categories: exterior.categories, "
-                                                             "links: collect({article_id: m.article_id, title: m.title})}",
-            center_title=center, ext_title=string
+            "MATCH (center:Article {title: $center_title}) "
+            "UNWIND $titles AS title "
+            "MATCH (exterior:Article {title: title}) "
+            "WHERE exterior <> center "
+            "MATCH p = shortestPath((center)-[*1.." + str(int(leaps)) + "]-(exterior)) "
+            "RETURN {article_id: exterior.article_id, title: exterior.title, categories: exterior.categories, "
+            "links: [(exterior)-[]->(m) | {article_id: m.article_id, title: m.title}]} AS article "
+            "UNION ALL "
+            "MATCH (n:Article {title: $center_title}) "
+            "RETURN {article_id: n.article_id, title: n.title, categories: n.categories, "
+            "links: [(n)-[]-(m) | {article_id: m.article_id, title: m.title}]} AS article",
+            center_title=center, titles=titles
         )
-        return result.single()
+        return list(result)
 
     def buildQuery(self) -> 'Neo4jFilterBuilder':
-        return Neo4jFilterBuilder()
+        return Neo4jFilterBuilder(center=self.center_title())
+
+    def executeQuery(self, query: 'Neo4jFinalBuilder', profile: Optional[Neo4jQueryProfile] = None) -> SearchResult:
+        """ If a profile (query.profile()) is given, the query runs with PROFILE and its plan and timings are filled in it """
+        with self.session() as session:
+            return session.write_transaction(query.execute, profile)
+
+    def streamQuery(self, query: 'Neo4jFinalBuilder', profile: Optional[Neo4jQueryProfile] = None) -> Iterator[Record]:
+        """
+        Records of the query as they arrive from the server, without collecting them. Map them with query.map_record().
+        The session is kept open until the iterator is exhausted or closed.
+        With a profile, the plan is filled once the iterator is exhausted. Rows and timings are left to the caller.
+        """
+        with self.session() as session:
+            with session.begin_transaction() as tx:
+                result: Result = query.run(tx, profile is not None)
+                yield from result
+                if profile is not None:
+                    fill_profile(profile, result.consume())
+
+    def estimate_cardinality(self, neo_filters: List[NeoFilter], general_filters: List[GeneralFilter]) -> int:
+        """
+        Upper bound of the amount of articles matching every filter, without running the query.
+        Only counts over indexes (center_dist, degrees) and the count store are used. A distance filter from a source other
+        than the center is bounded by the source's degree times the mean degree for each extra hop.
+        Filters that can't be estimated cheaply (categories) bound nothing.
+        """
+        with self.session() as session:
+            return session.read_transaction(self._estimate_cardinality, neo_filters, general_filters, self.center_title())
+
+    @staticmethod
+    def _estimate_cardinality(tx, neo_filters: List[NeoFilter], general_filters: List[GeneralFilter], center: Optional[str]) -> int:
+        # Los dos counts salen del count store, no recorren nada
+        total: int = tx.run('MATCH (a:Article) RETURN count(a) AS count').single()['count']
+        relationships: int = tx.run('MATCH ()-[r:Link]->() RETURN count(r) AS count').single()['count']
+        mean_degree: float = relationships / total if total > 0 else 0
+        estimate: int = total
+
+        for filter in general_filters:
+            if type(filter) is IdsFilter:
+                estimate = min(estimate, len(filter.ids))
+            elif type(filter) is TitlesFilter:
+                estimate = min(estimate, len(filter.titles))
+
+        for filter in neo_filters:
+            if type(filter) is NeoDistanceFilter:
+                operator: str = '=' if filter.strategy == DistanceFilterStrategy.AT_DIST else '<='
+                if filter.source_node == center and filter.direction == RelationDirection.OUTGOING:
+                    count: int = tx.run(
+                        f'MATCH (a:Article) WHERE a.center_dist {operator} $dist RETURN count(a) AS count', dist=filter.dist
+                    ).single()['count']
+                else:
+                    source: Optional[Record] = tx.run(
+                        'MATCH (s:Article {title: $title}) RETURN s.out_degree AS out_degree, s.in_degree AS in_degree',
+                        title=filter.source_node
+                    ).single()
+                    if source is None:
+                        count = 0
+                    else:
+                        if filter.direction == RelationDirection.OUTGOING:
+                            degree: int = source['out_degree'] or 0
+                        elif filter.direction == RelationDirection.INGOING:
+                            degree = source['in_degree'] or 0
+                        else:
+                            degree = (source['out_degree'] or 0) + (source['in_degree'] or 0)
+                        # Nodos a cada distancia: el primer salto es el grado de la fuente, los siguientes el grado medio
+                        at_dist: List[float] = [1] + [degree * mean_degree ** (dist - 1) for dist in range(1, filter.dist + 1)]
+                        count = int(min(at_dist[-1] if filter.strategy == DistanceFilterStrategy.AT_DIST else sum(at_dist), total))
+                estimate = min(estimate, count)
+            elif type(filter) is NeoLinksFilter:
+                # La suma de los grados no esta indexada. Con categorias, el grado igual acota la cantidad de links.
+                if filter.direction == RelationDirection.OUTGOING:
+                    degree_field: str = 'out_degree'
+                elif filter.direction == RelationDirection.INGOING:
+                    degree_field = 'in_degree'
+                else:
+                    continue
+                bounds: str = f'a.{degree_field} > $min_count' + \
+                              (f' AND a.{degree_field} < $max_count' if filter.max_count is not None and filter.categories is None else '')
+                count = tx.run(
+                    f'MATCH (a:Article) WHERE {bounds} RETURN count(a) AS count', min_count=filter.min_count, max_count=filter.max_count
+                ).single()['count']
+                estimate = min(estimate, count)
+
+        return estimate
+
+    def export_articles(self) -> Iterator[Record]:
+        """ article_id, title and categories of every article, as they arrive from the server """
+        with self.session() as session:
+            with session.begin_transaction() as tx:
+                yield from tx.run('MATCH (a:Article) RETURN a.article_id AS id, a.title AS title, a.categories AS categories')
 
-    def executeQuery(self, query: 'Neo4jFinalBuilder') -> SearchResult:
+    def export_links(self) -> Iterator[Record]:
+        """ (source article_id, destination article_id) of every link, as they arrive from the server """
         with self.session() as session:
-            return session.write_transaction(query.execute)
+            with session.begin_transaction() as tx:
+                yield from tx.run('MATCH (a:Article)-[:Link]->(b:Article) RETURN a.article_id AS source, b.article_id AS dest')
 
     def get_connections(self, node_title: str) -> Record:
         with self.session() as session:
@@ -165,6 +460,29 @@ class Neo4jRepository:
         return result.single()
 
 
+def fill_profile(profile: Neo4jQueryProfile, summary: ResultSummary) -> None:
+    """ Plan and db hits of a query run with PROFILE """
+    if summary.profile is None:
+        return
+    profile.plan = operator_profile(summary.profile)
+
+    def db_hits(operator: Neo4jOperatorProfile) -> int:
+        return operator.db_hits + sum(db_hits(child) for child in operator.children)
+    profile.db_hits = db_hits(profile.plan)
+
+
+def operator_profile(plan: Dict[str, Any]) -> Neo4jOperatorProfile:
+    # Segun la version del servidor, rows y dbHits vienen en el operador o en sus args
+    args: Dict[str, Any] = plan.get('args', {})
+    return Neo4jOperatorProfile(
+        operator=plan.get('operatorType', ''),
+        details=args.get('Details'),
+        rows=plan.get('rows', args.get('Rows', 0)),
+        db_hits=plan.get('dbHits', args.get('DbHits', 0)),
+        children=[operator_profile(child) for child in plan.get('children', [])]
+    )
+
+
 def mapper(record: Record) -> ArticleNode:
     return ArticleNode(id=record['article_id'], title=record['title'], categories=record['categories'], links=link_list_mapper(record['links']))
 
@@ -174,46 +492,194 @@ def link_list_mapper(links: List[Dict[str, Any]]):
 def link_mapper(link: Dict[str, Any]):
     return ArticleLink(article_id=link['article_id'], title=link['title'])
 
+def sort_key(sort_by: SortByEnum) -> str:
+    """ Property of n the results are ordered by """
+    if sort_by == SortByEnum.LINK_COUNT:
+        return 'n.out_degree'
+    elif sort_by == SortByEnum.TITLE:
+        return 'n.title'
+    return 'n.article_id'
+
 
 # Custom Exceptions
 class Neo4jWriteException(Exception):
     pass
 
 
+class Neo4jBulkWriter:
+    """
+    Buffers article nodes, distances to the center and links and writes them in batches using UNWIND.
+    Nodes are always flushed before links, so a link can reference a node buffered in the same batch.
+    A flush is triggered when either buffer reaches batch_size or when flush_seconds passed since the last flush.
+    The last partial batch is written on flush() or close() (also when used as a context manager).
+    """
+    repo: Neo4jRepository
+    batch_size: int
+    flush_seconds: float
+    nodes_created: int
+    relationships_created: int
+    batches_written: int
+
+    def __init__(self, repo: Neo4jRepository, session: Optional[Session], batch_size: int, flush_seconds: float) -> None:
+        if batch_size <= 0:
+            raise ValueError(f'Invalid batch size {batch_size}')
+
+        self.repo = repo
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.nodes_created = 0
+        self.relationships_created = 0
+        self.batches_written = 0
+
+        self._owns_session: bool = session is None
+        self._session: Session = session if session else repo.session()
+        self._node_buffer: List[Dict[str, Any]] = []
+        self._dist_buffer: List[Dict[str, Any]] = []
+        self._link_buffer: List[Dict[str, Any]] = []
+        self._last_flush: float = time.monotonic()
+
+    def __enter__(self) -> 'Neo4jBulkWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        # Si hubo un error no escribimos el batch parcial, pero si liberamos la sesion
+        if exc_type is None:
+            self.close()
+        elif self._owns_session:
+            self._session.close()
+
+    def create_article(self, id: int, title: str, categories: List[str], revision_id: Optional[int] = None, relink: bool = False,
+                       center_dist: Optional[int] = None) -> None:
+        """
+        Creates the article, or updates it if it already exists.
+        If relink is True, the existing outgoing links of the article are deleted, so they can be created again.
+        center_dist is the distance (in links) from the center of the import.
+        """
+        self._node_buffer.append({
+            'id': id, 'title': title, 'categories': categories, 'revision_id': revision_id, 'relink': relink, 'center_dist': center_dist
+        })
+        self._maybe_flush(len(self._node_buffer))
+
+    def set_center_dist(self, id: int, center_dist: int) -> None:
+        """ Updates the distance from the center of an existing article that isn't written again """
+        self._dist_buffer.append({'id': id, 'center_dist': center_dist})
+        self._maybe_flush(len(self._dist_buffer))
+
+    def link_article(self, source_id: int, dest_title: str, count: int = 1) -> None:
+        """
+        Links the articles. count is the amount of times the source article references the destination one.
+        """
+        self._link_buffer.append({'source_id': source_id, 'dest_title': dest_title, 'count': count})
+        self._maybe_flush(len(self._link_buffer))
+
+    def _maybe_flush(self, buffered: int) -> None:
+        if buffered >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self) -> None:
+        # Primero los nodos, pues los links los referencian
+        for i in range(0, len(self._node_buffer), self.batch_size):
+            self.nodes_created += self._write('create_articles', self.repo._create_articles, self._node_buffer[i:i + self.batch_size])
+        self._node_buffer = []
+
+        for i in range(0, len(self._dist_buffer), self.batch_size):
+            self._write('set_center_dists', self.repo._set_center_dists, self._dist_buffer[i:i + self.batch_size])
+        self._dist_buffer = []
+
+        for i in range(0, len(self._link_buffer), self.batch_size):
+            self.relationships_created += self._write('link_articles', self.repo._link_articles, self._link_buffer[i:i + self.batch_size])
+        self._link_buffer = []
+
+        self._last_flush = time.monotonic()
+        self.repo.forget_center()
+
+    def _write(self, operation: str, work: Callable[[Transaction, List[Dict[str, Any]]], Any], rows: List[Dict[str, Any]]) -> Any:
+        """ Writes a batch in a transaction. The driver calls work again if the transaction fails with a transient error """
+        attempts: int = 0
+
+        @functools.wraps(work)
+        def attempt(tx: Transaction, rows: List[Dict[str, Any]]) -> Any:
+            nonlocal attempts
+            attempts += 1
+            return work(tx, rows)
+
+        with timed(import_write_batch_seconds, db='neo4j', operation=operation):
+            result: Any = self._session.write_transaction(attempt, rows)
+        self.batches_written += 1
+        if attempts > 1:
+            db_transaction_retries_total.inc(attempts - 1, db='neo4j')
+        return result
+
+    def close(self) -> None:
+        self.flush()
+        if self._owns_session:
+            self._session.close()
+
+
 Neo4jQuerySegment = Tuple[str, Optional[Dict[str, Any]]]
+# Forma de una query: de que depende su texto, sin los valores de los parametros
+Neo4jQueryShape = Tuple[Hashable, ...]
 
 
 class Neo4jQueryBuilder:
+    """
+    A segment of a Cypher query. Every value is passed as a parameter, so the text only depends on the shape of the
+    query (which builders, and the options that change their text) and the same shape always gives the same text.
+    That lets Neo4j reuse its cached plan. The text of each shape is also cached here, so it is generated only once.
+    """
     _baseBuilder: Optional['Neo4jQueryBuilder']
-    __ident = 0
+    # Texto compilado de cada forma de query
+    _compiled: Dict[Neo4jQueryShape, str] = {}
+    MAX_COMPILED: int = 1024
 
     def __init__(self, base: 'Neo4jQueryBuilder' = None) -> None:
         self._baseBuilder = base
 
-    @staticmethod
-    def ident():
-        x = Neo4jQueryBuilder.__ident
-        Neo4jQueryBuilder.__ident += 1
-        return x
+    def shape(self) -> Hashable:
+        """ What the text of this segment depends on, besides its position in the query """
+        return type(self).__name__
 
     @abstractmethod
-    def stringify(self) -> Neo4jQuerySegment:
+    def text(self, ident: int) -> str:
+        """ Text of the segment. ident is its position in the query, to name its parameters uniquely """
         pass
 
+    def parameters(self, ident: int) -> Optional[Dict[str, Any]]:
+        return None
+
     @final
-    def _build(self) -> List[Neo4jQuerySegment]:
-        list = self._baseBuilder._build() if self._baseBuilder is not None else []
-        list.append(self.stringify())
-        return list
+    def _chain(self) -> List['Neo4jQueryBuilder']:
+        chain = self._baseBuilder._chain() if self._baseBuilder is not None else []
+        chain.append(self)
+        return chain
 
     @final
     def build(self) -> Neo4jQuerySegment:
-        query, args = map(list, zip(*self._build()))
-        dic = dict(itertools.chain.from_iterable(d.items() for d in args if d is not None))
-        return ('\n'.join(query), dic)
+        chain = self._chain()
+        key: Neo4jQueryShape = tuple(builder.shape() for builder in chain)
+
+        query: Optional[str] = self._compiled.get(key)
+        if query is None:
+            query = '\n'.join(builder.text(ident) for ident, builder in enumerate(chain))
+            if len(self._compiled) >= self.MAX_COMPILED:
+                # Se descarta la forma mas vieja
+                self._compiled.pop(next(iter(self._compiled)), None)
+            self._compiled[key] = query
+
+        dic: Dict[str, Any] = {}
+        for ident, builder in enumerate(chain):
+            dic.update(builder.parameters(ident) or {})
+        return (query, dic)
 
 
 class Neo4jFilterBuilder(Neo4jQueryBuilder):
+    # Titulo del centro del import, si los articulos tienen center_dist. Lo heredan los builders siguientes.
+    center: Optional[str]
+
+    def __init__(self, base: Neo4jQueryBuilder = None, center: Optional[str] = None) -> None:
+        super().__init__(base)
+        self.center = center if center is not None else getattr(base, 'center', None)
+
     def generalFilter(self, filter: GeneralFilter):
         return Neo4jGeneralFilterBuilder(self, filter)
 
@@ -229,8 +695,11 @@ class Neo4jFilterBuilder(Neo4jQueryBuilder):
     def sortBy(self, sort: QuerySort):
         return Neo4jSortBuilder(self, sort)
 
-    def stringify(self) -> Neo4jQuerySegment:
-        return ('MATCH (n:Article)', None)
+    def keyset(self, sort: QuerySort, after: Optional[Tuple[Any, int]], limit: int):
+        return Neo4jKeysetBuilder(self, sort, after, limit)
+
+    def text(self, ident: int) -> str:
+        return 'MATCH (n:Article)'
 
 
 class Neo4jDistanceFilterBuilder(Neo4jFilterBuilder):
@@ -240,16 +709,29 @@ class Neo4jDistanceFilterBuilder(Neo4jFilterBuilder):
         super().__init__(base)
         self.filter = filter
 
-    def stringify(self) -> Neo4jQuerySegment:
-        ident = Neo4jQueryBuilder.ident()
+    def _from_center(self) -> bool:
+        return self.filter.source_node == self.center and self.filter.direction == RelationDirection.OUTGOING
+
+    def shape(self) -> Hashable:
+        return type(self).__name__, self._from_center(), self.filter.strategy, self.filter.direction
+
+    def text(self, ident: int) -> str:
+        # Desde el centro la distancia (saliente) ya esta guardada en cada nodo: alcanza con el indice de center_dist
+        if self._from_center():
+            operator = '=' if self.filter.strategy == DistanceFilterStrategy.AT_DIST else '<='
+            return f"WHERE n.center_dist {operator} $dist{ident}\n" \
+                    "WITH n"
+
         if self.filter.direction == RelationDirection.OUTGOING:
             direction = '>'
         elif self.filter.direction == RelationDirection.INGOING:
             direction = '<'
+        else:
+            direction = ''
         if self.filter.strategy == DistanceFilterStrategy.AT_DIST:
             strategy = 'athop'
             str = f"MATCH (source: Article {{title: $title{ident}}})\n" \
-                  f"CALL apoc.neighbors.{strategy}(source, 'Link{direction}', {self.filter.dist})\n" \
+                  f"CALL apoc.neighbors.{strategy}(source, 'Link{direction}', $dist{ident})\n" \
                    "YIELD node\n" \
                    "WITH collect(n.article_id) as ids, node\n" \
                    "WHERE node.article_id in ids\n" \
@@ -259,7 +741,7 @@ class Neo4jDistanceFilterBuilder(Neo4jFilterBuilder):
             str =  f"MATCH (source: Article {{title: $title{ident}}})\n" \
                    "CALL {\n" \
                        "WITH source\n" \
-                      f"CALL apoc.neighbors.{strategy}(source, 'Link{direction}', {self.filter.dist})\n" \
+                      f"CALL apoc.neighbors.{strategy}(source, 'Link{direction}', $dist{ident})\n" \
                        "YIELD node\n" \
                        "RETURN node\n" \
                        "UNION\n" \
@@ -268,8 +750,12 @@ class Neo4jDistanceFilterBuilder(Neo4jFilterBuilder):
                    "WITH collect(n.article_id) as ids, node\n" \
                    "WHERE node.article_id in ids\n" \
                    "WITH node as n\n"
-        dic = {f"title{ident}": self.filter.source_node}
-        return (str, dic)
+        return str
+
+    def parameters(self, ident: int) -> Optional[Dict[str, Any]]:
+        if self._from_center():
+            return {f"dist{ident}": self.filter.dist}
+        return {f"title{ident}": self.filter.source_node, f"dist{ident}": self.filter.dist}
 
 
 class Neo4jLinksFilterBuilder(Neo4jFilterBuilder):
@@ -279,59 +765,167 @@ class Neo4jLinksFilterBuilder(Neo4jFilterBuilder):
         super().__init__(base)
         self.filter = filter
 
-    def stringify(self) -> Neo4jQuerySegment:
-        ident = Neo4jQueryBuilder.ident()
+    def shape(self) -> Hashable:
+        return type(self).__name__, self.filter.categories is not None, self.filter.max_count is not None, self.filter.direction
+
+    def text(self, ident: int) -> str:
         hasCategories = self.filter.categories is not None
+        bounds = f"count > $min_count{ident}" + \
+                 (f" and count < $max_count{ident}" if self.filter.max_count is not None else "")
+
+        # Sin categorias alcanza con los grados guardados en el nodo. Con categorias hay que mirar cada vecino.
+        if not hasCategories:
+            if self.filter.direction == RelationDirection.OUTGOING:
+                degree = "n.out_degree"
+            elif self.filter.direction == RelationDirection.INGOING:
+                degree = "n.in_degree"
+            else:
+                degree = "n.out_degree + n.in_degree"
+            return f"WITH n, {degree} as count\n" \
+                   f"WHERE {bounds}\n" \
+                   "WITH n"
+
         if self.filter.direction == RelationDirection.OUTGOING:
             direction = "    MATCH (n)-[links:Link]->(m:Article)\n"
         elif self.filter.direction == RelationDirection.INGOING:
             direction = "    MATCH (m:Article)-[links:Link]->(n)\n"
-        str = "CALL {\n" \
-              "    WITH n\n" +\
-              direction + \
-              (f"    WHERE any(cat in $categories{ident} WHERE cat in m.categories)\n" \
-                   if hasCategories else "") + \
-              "    RETURN count(links) as links }\n" \
-              "WITH links as count, n\n" \
-              f"WHERE count > {self.filter.min_count} " + \
-              (f"and count < {self.filter.max_count}\n"
-               if self.filter.max_count is not None else "\n") + \
-              "WITH n"
-        dic = {f'categories{ident}': self.filter.categories} if hasCategories else None
-        return (str, dic)
+        else:
+            direction = "    MATCH (n)-[links:Link]-(m:Article)\n"
+        return "CALL {\n" \
+               "    WITH n\n" +\
+               direction + \
+               f"    WHERE any(cat in $categories{ident} WHERE cat in m.categories)\n" \
+               "    RETURN count(links) as links }\n" \
+               "WITH links as count, n\n" \
+               f"WHERE {bounds}\n" \
+               "WITH n"
+
+    def parameters(self, ident: int) -> Optional[Dict[str, Any]]:
+        dic = {f'min_count{ident}': self.filter.min_count}
+        if self.filter.max_count is not None:
+            dic[f'max_count{ident}'] = self.filter.max_count
+        if self.filter.categories is not None:
+            dic[f'categories{ident}'] = self.filter.categories
+        return dic
+
+
+class Neo4jKeysetBuilder(Neo4jFilterBuilder):
+    """
+    Keyset pagination: orders by the sort key and then article_id, and keeps the limit first articles after the
+    (sort key, article_id) of the last one of the previous page. Unlike SKIP, the cost of a page doesn't grow with its depth.
+    The return builder projects the key of each row (sort_key and sort_id), to build the cursor of the next page, and the
+    rows of the page (page_rows), to know if there is a next page.
+    """
+    sort: QuerySort
+    after: Optional[Tuple[Any, int]]
+    limit: int
+
+    def __init__(self, base: Neo4jQueryBuilder, sort: QuerySort, after: Optional[Tuple[Any, int]], limit: int) -> None:
+        super().__init__(base)
+        self.sort = sort
+        self.after = after
+        self.limit = limit
+
+    def shape(self) -> Hashable:
+        return type(self).__name__, self.sort.sort_by, self.sort.type, self.after is not None
+
+    def text(self, ident: int) -> str:
+        key = sort_key(self.sort.sort_by)
+        order = self.sort.type.value
+        operator = '>' if self.sort.type == SortType.ASC else '<'
+
+        str = ""
+        if self.after is not None:
+            if self.sort.sort_by == SortByEnum.ID:
+                # El id ya es unico, no hace falta desempatar
+                str = f"WHERE n.article_id {operator} $after_id{ident}\n"
+            else:
+                str = f"WHERE {key} {operator} $after{ident} OR ({key} = $after{ident} AND n.article_id {operator} $after_id{ident})\n"
+        # page_rows: filas de la pagina antes de proyectarlas, para saber si es la ultima
+        return str + \
+               f"WITH n ORDER BY {key} {order}, n.article_id {order} LIMIT $limit{ident}\n" \
+               "WITH collect(n) AS page\n" \
+               "UNWIND page AS n\n" \
+               "WITH n, size(page) AS page_rows"
+
+    def parameters(self, ident: int) -> Optional[Dict[str, Any]]:
+        dic: Dict[str, Any] = {f"limit{ident}": self.limit}
+        if self.after is not None:
+            dic[f"after{ident}"], dic[f"after_id{ident}"] = self.after
+        return dic
+
+    def returnType(self, type: QueryReturnTypes):
+        return Neo4jReturnBuilder.byType(self, type, self.sort)
 
 
 class Neo4jFinalBuilder(Neo4jQueryBuilder):
+    # Elementos de una lista que se muestran en los parametros de un profile
+    PROFILE_MAX_ITEMS: int = 20
+
     @final
-    def __execute(self, tx: Transaction) -> Result:
+    def run(self, tx: Transaction, profile: bool = False) -> Result:
         query, kwargs = self.build()
-        print(query)
-        return tx.run(query, **kwargs)
+        # Con PROFILE cambia el texto, asi que tiene su propio plan cacheado
+        return tx.run('PROFILE ' + query if profile else query, **kwargs)
 
-    def map(self, result: Result):
+    @final
+    def profile(self, stage: str) -> Neo4jQueryProfile:
+        """ An empty profile of the query, with its text and parameters, to run it with """
+        query, kwargs = self.build()
+        parameters: Dict[str, Any] = {}
+        for name, value in kwargs.items():
+            if isinstance(value, list) and len(value) > self.PROFILE_MAX_ITEMS:
+                value = value[:self.PROFILE_MAX_ITEMS] + [f'... {len(value) - self.PROFILE_MAX_ITEMS} more']
+            parameters[name] = value
+        return Neo4jQueryProfile(stage=stage, cypher=query, parameters=parameters)
+
+    def map(self, records: List[Record]):
+        pass
+
+    def map_record(self, record: Record) -> Any:
+        """ Maps a single record, for results that are streamed """
         pass
 
-    def execute(self, tx: Transaction) -> Any:
-        return self.map(self.__execute(tx))
+    def execute(self, tx: Transaction, profile: Optional[Neo4jQueryProfile] = None) -> Any:
+        # Se traen todas las filas antes de mapear, para medir por separado la query y el mapeo
+        with timed(search_neo4j_seconds, phase='cypher') as cypher:
+            result: Result = self.run(tx, profile is not None)
+            records: List[Record] = list(result)
+        with timed(search_neo4j_seconds, phase='mapping') as mapping:
+            mapped: Any = self.map(records)
+
+        if profile is not None:
+            fill_profile(profile, result.consume())
+            profile.rows = len(records)
+            profile.seconds = cypher.seconds
+            profile.mapping_seconds = mapping.seconds
+        return mapped
 
 
 class Neo4jReturnBuilder(Neo4jFinalBuilder):
     type: QueryReturnTypes
 
+    # Orden de la paginacion por keyset, si la hay
+    keyset: Optional[QuerySort]
+
     @staticmethod
-    def byType(base: Neo4jQueryBuilder, type: QueryReturnTypes) -> 'Neo4jReturnBuilder':
+    def byType(base: Neo4jQueryBuilder, type: QueryReturnTypes, keyset: Optional[QuerySort] = None) -> 'Neo4jReturnBuilder':
         if (
             type == QueryReturnTypes.NODE or
             type == QueryReturnTypes.TITLE or
             type == QueryReturnTypes.ID
         ):
-            return Neo4jListReturnBuilder(base, type)
+            return Neo4jListReturnBuilder(base, type, keyset)
         elif type == QueryReturnTypes.COUNT:
             return Neo4jSingleReturnBuilder(base, type)
 
-    def __init__(self, base: Neo4jQueryBuilder, type: QueryReturnTypes) -> None:
+    def __init__(self, base: Neo4jQueryBuilder, type: QueryReturnTypes, keyset: Optional[QuerySort] = None) -> None:
         super().__init__(base)
         self.type = type
+        self.keyset = keyset
+
+    def shape(self) -> Hashable:
+        return type(self).__name__, self.type, (self.keyset.sort_by, self.keyset.type) if self.keyset is not None else None
 
     def limit(self, n: int):
         return Neo4jLimitBuilder(self, n)
@@ -341,35 +935,47 @@ class Neo4jReturnBuilder(Neo4jFinalBuilder):
 
 
 class Neo4jListReturnBuilder(Neo4jReturnBuilder):
-    def stringify(self) -> Neo4jQuerySegment:
+    def text(self, ident: int) -> str:
         if self.type == QueryReturnTypes.NODE:
-            str = "MATCH (n)-[]->(linked)\n" \
-                  "RETURN {article_id: n.article_id, title: n.title, categories: n.categories, \n" \
-                  "links: collect({article_id: linked.article_id, title: linked.title})}"
+            # Una fila por articulo, tambien los que no tienen links: el LIMIT anterior (keyset, limit) cuenta las filas devueltas
+            str = "RETURN {article_id: n.article_id, title: n.title, categories: n.categories, \n" \
+                  "links: [(n)-[]->(linked) | {article_id: linked.article_id, title: linked.title}]}"
         elif self.type == QueryReturnTypes.TITLE:
             str = "RETURN n.title as title"
         elif self.type == QueryReturnTypes.ID:
             str = "RETURN n.article_id as id"
 
-        return (str, None)
+        if self.keyset is not None:
+            # El orden del WITH no esta garantizado en el RETURN: se vuelve a ordenar, solo las filas de la pagina
+            order = self.keyset.type.value
+            str += f", {sort_key(self.keyset.sort_by)} as sort_key, n.article_id as sort_id, page_rows\n" \
+                   f"ORDER BY sort_key {order}, sort_id {order}"
+
+        return str
 
-    def map(self, result: Result) -> list:
+    def map(self, records: List[Record]) -> list:
+        return [self.map_record(record) for record in records]
+
+    def map_record(self, record: Record) -> Any:
         if self.type == QueryReturnTypes.NODE:
-            return [mapper(record[0]) for record in result]
+            return mapper(record[0])
         elif self.type == QueryReturnTypes.TITLE:
-            return [record[0] for record in result]
+            return record[0]
         elif self.type == QueryReturnTypes.ID:
-            return [record[0] for record in result]
+            return record[0]
 
 class Neo4jSingleReturnBuilder(Neo4jReturnBuilder):
-    def stringify(self) -> Neo4jQuerySegment:
+    def text(self, ident: int) -> str:
         if self.type == QueryReturnTypes.COUNT:
             str = "RETURN count(n) as count"
-        return (str, None)
+        return str
+
+    def map(self, records: List[Record]) -> Any:
+        return self.map_record(records[0])
 
-    def map(self, result: Result) -> Any:
+    def map_record(self, record: Record) -> Any:
         if self.type == QueryReturnTypes.COUNT:
-            return ArticleCount(count=result.single()[0])
+            return ArticleCount(count=record[0])
 
 
 class Neo4jGeneralFilterBuilder(Neo4jFilterBuilder):
@@ -379,27 +985,32 @@ class Neo4jGeneralFilterBuilder(Neo4jFilterBuilder):
         super().__init__(base)
         self.filter = filter
 
-    def stringify(self) -> Neo4jQuerySegment:
-        ident = Neo4jQueryBuilder.ident()
+    def shape(self) -> Hashable:
+        return type(self).__name__, type(self.filter).__name__
 
+    def text(self, ident: int) -> str:
         if type(self.filter) == IdsFilter:
             field = 'article_id'
-            arr = self.filter.ids
         elif type(self.filter) == TitlesFilter:
             field = 'title'
-            arr = self.filter.titles
         elif type(self.filter) == CategoriesFilter:
             field = 'categories'
-            arr = self.filter.categories
         else:
             raise ValueError(f'Invalid filter type {filter}')
 
-        str = (f"WHERE n.{field} in $arr{ident}\n"
-               if field != 'categories' else
-               f"WHERE any(x in n.{field} WHERE x in $arr{ident})\n") + \
-              "WITH n"
-        dic = {f"arr{ident}": arr}
-        return (str, dic)
+        return (f"WHERE n.{field} in $arr{ident}\n"
+                if field != 'categories' else
+                f"WHERE any(x in n.{field} WHERE x in $arr{ident})\n") + \
+               "WITH n"
+
+    def parameters(self, ident: int) -> Optional[Dict[str, Any]]:
+        if type(self.filter) == IdsFilter:
+            arr = self.filter.ids
+        elif type(self.filter) == TitlesFilter:
+            arr = self.filter.titles
+        else:
+            arr = self.filter.categories
+        return {f"arr{ident}": arr}
 
 
 class Neo4jSortBuilder(Neo4jQueryBuilder):
@@ -409,18 +1020,23 @@ class Neo4jSortBuilder(Neo4jQueryBuilder):
         super().__init__(base)
         self.sort = sort
 
-    def stringify(self) -> Neo4jQuerySegment:
-        order = self.sort.type
+    def shape(self) -> Hashable:
+        # La direccion del orden no se puede pasar como parametro
+        return type(self).__name__, self.sort.sort_by, self.sort.type
+
+    def text(self, ident: int) -> str:
+        order = self.sort.type.value
         if self.sort.sort_by == SortByEnum.LINK_COUNT:
-            str = "MATCH (n)-[links:Link]->(:Article)\n" \
-                  "WITH n, count(links) as count\n" \
-                  f"ORDER BY count(links) {order}\n" \
+            # out_degree esta indexado: el filtro permite recorrer el indice ya ordenado
+            str = "WITH n\n" \
+                  "WHERE n.out_degree >= 0\n" \
+                  f"WITH n ORDER BY n.out_degree {order}\n" \
                   "WITH n"
         elif self.sort.sort_by == SortByEnum.ID:
             str = f"ORDER BY n.article_id {order}"
         elif self.sort.sort_by == SortByEnum.TITLE:
             str = f"ORDER BY n.title {order}"
-        return (str, None)
+        return str
 
     def returnType(self, type: QueryReturnTypes):
         return Neo4jReturnBuilder.byType(self, type)
@@ -433,18 +1049,24 @@ class Neo4jCutBuilder(Neo4jFinalBuilder):
         super().__init__(base)
         self.cut = cut
 
-    def map(self, result: Result):
-        return self._baseBuilder.map(result)
+    def map(self, records: List[Record]):
+        return self._baseBuilder.map(records)
+
+    def map_record(self, record: Record) -> Any:
+        return self._baseBuilder.map_record(record)
+
+    def parameters(self, ident: int) -> Optional[Dict[str, Any]]:
+        return {f"cut{ident}": self.cut}
 
 
 class Neo4jLimitBuilder(Neo4jCutBuilder):
-    def stringify(self) -> Neo4jQuerySegment:
-        return (f"LIMIT {self.cut}", None)
+    def text(self, ident: int) -> str:
+        return f"LIMIT $cut{ident}"
 
 
 class Neo4jSkipBuilder(Neo4jCutBuilder):
-    def stringify(self) -> Neo4jQuerySegment:
-        return (f"SKIP {self.cut}", None)
+    def text(self, ident: int) -> str:
+        return f"SKIP $cut{ident}"
 
     def limit(self, n: int):
         return Neo4jLimitBuilder(self, n)
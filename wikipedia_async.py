@@ -0,0 +1,143 @@
+import asyncio
+import concurrent.futures
+import threading
+from typing import Any, Awaitable, Dict, List, Optional, TypeVar
+
+import aiohttp
+from mediawiki.exceptions import MediaWikiException
+
+from metrics import import_api_errors_total, import_api_request_seconds, timed
+from wikipedia_cache import DiskResponseCache, CacheMissError
+
+T = TypeVar('T')
+
+REQUEST_TIMEOUT_SECONDS: float = 30
+
+
+class AsyncMediaWiki:
+    """
+    asyncio MediaWiki API client.
+    Every request goes through a single aiohttp session, so connections to the API host are reused, and at most
+    max_in_flight requests are executed at the same time. api_url can point to any MediaWiki compatible server.
+    Responses can optionally be stored in a DiskResponseCache, in the same way CachedMediaWiki does.
+    """
+    lang: str
+    api_url: str
+
+    def __init__(self, lang: str, user_agent: str, max_in_flight: int, connections_per_host: int, api_url: Optional[str] = None,
+                 cache: Optional[DiskResponseCache] = None, offline: bool = False) -> None:
+        if max_in_flight <= 0 or connections_per_host <= 0:
+            raise ValueError(f'Invalid max in flight requests {max_in_flight} or connections per host {connections_per_host}')
+
+        self.lang = lang
+        self.api_url = api_url or f'https://{lang}.wikipedia.org/w/api.php'
+        self.user_agent = user_agent
+        self.max_in_flight = max_in_flight
+        self.connections_per_host = connections_per_host
+        self.cache = cache
+        self.offline = offline
+        self.requests = 0
+
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def open(self) -> None:
+        # Se tienen que crear dentro del event loop que los va a usar
+        self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_in_flight, limit_per_host=self.connections_per_host),
+            headers={'User-Agent': self.user_agent},
+            timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_SECONDS),
+        )
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @staticmethod
+    def _query_params(params: Dict[str, Any]) -> Dict[str, str]:
+        # Para la API, un parametro booleano es verdadero si esta presente
+        query: Dict[str, str] = {'format': 'json', 'action': 'query'}
+        for key, value in params.items():
+            if value is True:
+                query[key] = '1'
+            elif value is not False and value is not None:
+                query[key] = str(value)
+        return query
+
+    async def wiki_request(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        key: Optional[str] = None
+        if self.cache is not None:
+            key = self.cache.key(self.lang, self.api_url, params)
+            cached: Optional[Dict[str, Any]] = self.cache.get(key)
+            if cached is not None:
+                return cached
+            if self.offline:
+                raise CacheMissError(params)
+
+        async with self._semaphore:
+            try:
+                # Solo el request: la espera por el semaforo no cuenta
+                with timed(import_api_request_seconds, client='async'):
+                    async with self._session.get(self.api_url, params=self._query_params(params)) as response:
+                        response.raise_for_status()
+                        result: Dict[str, Any] = await response.json(content_type=None)
+            except Exception:
+                import_api_errors_total.inc(client='async')
+                raise
+        self.requests += 1
+
+        if 'error' in result:
+            raise MediaWikiException(f'MediaWiki API error: {result["error"]}')
+
+        if key is not None:
+            self.cache.put(key, result)
+        return result
+
+    async def query_continued(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """ Executes the query and its continuations, returning every response """
+        params = dict(params)
+        responses: List[Dict[str, Any]] = []
+        while True:
+            response: Dict[str, Any] = await self.wiki_request(params)
+            responses.append(response)
+            if 'continue' not in response:
+                return responses
+            params.update(response['continue'])
+
+
+class AsyncWikiRunner:
+    """
+    Runs an AsyncMediaWiki in its own event loop thread, so the (synchronous) importer can use it.
+    submit() schedules a coroutine and returns a concurrent.futures.Future, so thousands of requests can be in flight
+    without a thread per request. wiki_request() is a blocking version, with the same interface as MediaWiki.
+    Pages are resolved in batches with queries (see _WikiFetcher), never one by one.
+    """
+    client: AsyncMediaWiki
+
+    def __init__(self, client: AsyncMediaWiki) -> None:
+        self.client = client
+        self._loop: asyncio.AbstractEventLoop = asyncio.new_event_loop()
+        self._thread: threading.Thread = threading.Thread(target=self._loop.run_forever, name='async-wiki', daemon=True)
+        self._thread.start()
+        self.run(client.open())
+
+    @property
+    def lang(self) -> str:
+        return self.client.lang
+
+    def submit(self, coroutine: Awaitable[T]) -> 'concurrent.futures.Future[T]':
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def run(self, coroutine: Awaitable[T]) -> T:
+        return self.submit(coroutine).result()
+
+    def wiki_request(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        return self.run(self.client.wiki_request(params))
+
+    def close(self) -> None:
+        self.run(self.client.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
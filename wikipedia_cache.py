@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from mediawiki import MediaWiki
+from mediawiki.exceptions import MediaWikiException
+
+CACHE_FILE_SUFFIX: str = '.json'
+
+
+class CacheMissError(MediaWikiException):
+    """ Raised by an offline CachedMediaWiki when a request is not in the cache. """
+
+    def __init__(self, params: Dict[str, Any]) -> None:
+        super().__init__(f'Request not found in cache (offline mode): {params}')
+        self.params = params
+
+
+class DiskResponseCache:
+    """
+    Content addressed cache of MediaWiki API responses.
+    Each response is stored in its own file, named after the hash of the request. When the cache goes over max_bytes,
+    the least recently used responses are evicted. The file modification time is used as last access time, so the
+    LRU order survives between runs.
+    """
+    path: Path
+    max_bytes: int
+
+    def __init__(self, path: str, max_bytes: int) -> None:
+        if max_bytes <= 0:
+            raise ValueError(f'Invalid cache size {max_bytes}')
+
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        self._lock: threading.Lock = threading.Lock()
+        # key -> tamaño del archivo. Ordenado del menos al mas recientemente usado.
+        self._entries: 'OrderedDict[str, int]' = OrderedDict()
+        self._total_bytes: int = 0
+
+        files = sorted(self.path.glob(f'*/*{CACHE_FILE_SUFFIX}'), key=lambda f: f.stat().st_mtime)
+        for file in files:
+            size: int = file.stat().st_size
+            self._entries[file.stem] = size
+            self._total_bytes += size
+
+    @staticmethod
+    def key(lang: str, api_url: str, params: Dict[str, Any]) -> str:
+        raw: str = json.dumps({'lang': lang, 'api_url': api_url, 'params': params}, sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def _file(self, key: str) -> Path:
+        return self.path / key[:2] / (key + CACHE_FILE_SUFFIX)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+
+        file: Path = self._file(key)
+        try:
+            with file.open('r', encoding='utf-8') as f:
+                value: Dict[str, Any] = json.load(f)
+            os.utime(file)
+        except (OSError, ValueError):
+            # Archivo borrado o corrupto -> es un miss
+            self._discard(key)
+            return None
+
+        return value
+
+    def put(self, key: str, value: Dict[str, Any]) -> None:
+        file: Path = self._file(key)
+        file.parent.mkdir(exist_ok=True)
+
+        # Escritura atomica, para que un import cortado no deje archivos a medio escribir
+        data: bytes = json.dumps(value).encode()
+        tmp_file: Path = file.with_suffix(f'.{threading.get_ident()}.tmp')
+        tmp_file.write_bytes(data)
+        os.replace(tmp_file, file)
+
+        with self._lock:
+            self._total_bytes += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            self._evict()
+
+    def _discard(self, key: str) -> None:
+        with self._lock:
+            self._total_bytes -= self._entries.pop(key, 0)
+
+    # Precondicion: tener el lock
+    def _evict(self) -> None:
+        while self._total_bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                self._file(key).unlink()
+            except FileNotFoundError:
+                pass
+
+    def clear(self) -> None:
+        with self._lock:
+            for key in self._entries:
+                try:
+                    self._file(key).unlink()
+                except FileNotFoundError:
+                    pass
+            self._entries.clear()
+            self._total_bytes = 0
+
+
+class CachedMediaWiki(MediaWiki):
+    """
+    MediaWiki client that stores every API response in a DiskResponseCache.
+    All of pymediawiki's requests (pages, links, categories, content, site info) go through wiki_request, so they are
+    all cached. In offline mode only cached responses are served, and a miss raises CacheMissError.
+    """
+
+    def __init__(self, cache: DiskResponseCache, offline: bool = False, **kwargs) -> None:
+        # MediaWiki hace requests en el constructor, el cache tiene que estar antes
+        self.cache = cache
+        self.offline = offline
+        self.cache_hits = 0
+        self.cache_misses = 0
+        super().__init__(**kwargs)
+
+    def wiki_request(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        key: str = self.cache.key(self.lang, self.api_url, params)
+
+        response: Optional[Dict[str, Any]] = self.cache.get(key)
+        if response is not None:
+            self.cache_hits += 1
+            return response
+
+        if self.offline:
+            raise CacheMissError(params)
+
+        self.cache_misses += 1
+        response = super().wiki_request(params)
+
+        # No guardamos errores, pueden ser transitorios
+        if 'error' not in response:
+            self.cache.put(key, response)
+
+        return response
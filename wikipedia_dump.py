@@ -0,0 +1,342 @@
+import bz2
+import concurrent.futures
+import gzip
+import json
+import os
+import re
+import sqlite3
+import threading
+import xml.etree.ElementTree as ElementTree
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, IO, Iterator, List, Optional, Set, Tuple, Union
+
+import mwparserfromhell
+from mediawiki import PageError
+
+from models import WikiPage
+
+ARTICLE_NAMESPACE: int = 0
+CATEGORY_NAMESPACE: int = 14
+MAX_REDIRECT_HOPS: int = 4
+PARSE_BATCH_SIZE: int = 200        # Paginas por tarea del pool de procesos
+INSERT_BATCH_SIZE: int = 1000
+INDEX_VERSION: int = 1
+
+# Tuplas (cl_from, 'cl_to', ...) de los INSERT del dump categorylinks.sql
+_CATEGORYLINKS_ROW = re.compile(r"\((\d+),'((?:[^'\\]|\\.)*)'")
+
+
+@dataclass
+class _RawPage:
+    pageid: int
+    title: str
+    revision_id: int
+    text: str
+
+
+def normalize_title(title: str) -> str:
+    title = ' '.join(title.replace('_', ' ').split())
+    return title[:1].upper() + title[1:]
+
+def _open_dump(path: str) -> IO[bytes]:
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rb')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+def _tag(elem: ElementTree.Element) -> str:
+    # Sacamos el namespace de xml: {http://www.mediawiki.org/xml/export-0.10/}page -> page
+    return elem.tag.rsplit('}', 1)[-1]
+
+def _child_text(elem: ElementTree.Element, name: str) -> Optional[str]:
+    for child in elem:
+        if _tag(child) == name:
+            return child.text
+    return None
+
+def _child(elem: ElementTree.Element, name: str) -> Optional[ElementTree.Element]:
+    for child in elem:
+        if _tag(child) == name:
+            return child
+    return None
+
+def iter_dump(path: str, namespaces: Dict[int, str]) -> Iterator[Union[_RawPage, Tuple[str, str]]]:
+    """
+    Streams the articles of a pages-articles dump.
+    Yields a _RawPage for each article and a (title, target) tuple for each redirect. Fills namespaces (key -> name)
+    with the ones declared in the dump's siteinfo.
+    """
+    with _open_dump(path) as f:
+        root: Optional[ElementTree.Element] = None
+        for event, elem in ElementTree.iterparse(f, events=('start', 'end')):
+            if root is None:
+                root = elem
+            if event != 'end':
+                continue
+
+            tag: str = _tag(elem)
+            if tag == 'namespace':
+                namespaces[int(elem.get('key'))] = elem.text or ''
+            elif tag == 'page':
+                if int(_child_text(elem, 'ns') or -1) == ARTICLE_NAMESPACE:
+                    title: str = _child_text(elem, 'title')
+                    redirect: Optional[ElementTree.Element] = _child(elem, 'redirect')
+                    revision: ElementTree.Element = _child(elem, 'revision')
+
+                    if redirect is not None:
+                        yield title, normalize_title(redirect.get('title'))
+                    elif revision is not None:
+                        yield _RawPage(int(_child_text(elem, 'id')), title, int(_child_text(revision, 'id')), _child_text(revision, 'text') or '')
+
+                # Liberamos lo ya procesado, sino el arbol completo queda en memoria
+                root.clear()
+
+def parse_wikitext(text: str, namespaces: Dict[int, str]) -> Tuple[str, List[str], List[str], Dict[str, int]]:
+    """
+    Returns the plain text content, the article links, the categories of the wikitext and the amount of references of
+    the links referenced more than once.
+    """
+    prefixes: Dict[str, int] = {name.lower(): key for key, name in namespaces.items() if name}
+    category_prefix: str = namespaces.get(CATEGORY_NAMESPACE, 'Category').lower()
+
+    wikicode = mwparserfromhell.parse(text)
+    links: Counter = Counter()
+    categories: Set[str] = set()
+
+    for wikilink in wikicode.filter_wikilinks():
+        target: str = str(wikilink.title).split('#', 1)[0].strip()
+        # [[:Category:X]] es un link a la categoria, no una categorizacion
+        escaped: bool = target.startswith(':')
+        target = target.lstrip(':').strip()
+
+        prefix, sep, rest = target.partition(':')
+        namespace: Optional[int] = prefixes.get(prefix.strip().lower()) if sep else None
+
+        if namespace is None and target:
+            links[normalize_title(target)] += 1
+            # En el texto plano queda el texto del link, o su titulo sin la seccion
+            if wikilink.text is None:
+                wikicode.replace(wikilink, target)
+            continue
+
+        if prefix.strip().lower() == category_prefix and not escaped and rest.strip():
+            categories.add(normalize_title(rest))
+        # Categorias, archivos, etc. no son parte del contenido
+        wikicode.remove(wikilink)
+
+    content: str = wikicode.strip_code(normalize=True, collapse=True).strip()
+    return content, sorted(links), sorted(categories), {link: count for link, count in links.items() if count > 1}
+
+def _parse_batch(batch: List[_RawPage], namespaces: Dict[int, str]) -> List[Tuple[int, str, int, str, str, str]]:
+    rows = []
+    for page in batch:
+        content, links, categories, link_counts = parse_wikitext(page.text, namespaces)
+        # Los links referenciados mas de una vez se repiten
+        links = [link for link in links for _ in range(link_counts.get(link, 1))]
+        rows.append((page.pageid, normalize_title(page.title), page.revision_id, content, json.dumps(links), json.dumps(categories)))
+    return rows
+
+def _iter_categorylinks(path: str) -> Iterator[Tuple[int, str]]:
+    with _open_dump(path) as f:
+        for line in f:
+            if not line.startswith(b'INSERT INTO'):
+                continue
+            for match in _CATEGORYLINKS_ROW.finditer(line.decode('utf-8', errors='replace')):
+                category: str = match.group(2).replace("\\'", "'").replace('\\\\', '\\')
+                yield int(match.group(1)), normalize_title(category)
+
+def build_dump_index(dump_path: str, index_path: str, categorylinks_path: Optional[str] = None, workers: Optional[int] = None) -> None:
+    """
+    Parses a pages-articles XML dump into a sqlite index usable by DumpWiki.
+    The dump is streamed and the wikitext is parsed in a process pool, with a bounded amount of batches in flight.
+    If a categorylinks SQL dump is given, its categories (which include the ones added by templates) are used
+    instead of the ones found in the wikitext.
+    """
+    tmp_path: Path = Path(index_path + '.tmp')
+    if tmp_path.exists():
+        tmp_path.unlink()
+
+    db: sqlite3.Connection = sqlite3.connect(str(tmp_path))
+    db.executescript(
+        'CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);'
+        'CREATE TABLE pages (pageid INTEGER, title TEXT PRIMARY KEY, revision_id INTEGER, content TEXT, links TEXT, categories TEXT);'
+        'CREATE TABLE redirects (title TEXT PRIMARY KEY, target TEXT);'
+        'CREATE TABLE categorylinks (pageid INTEGER, category TEXT);'
+    )
+
+    workers = workers or os.cpu_count() or 1
+    namespaces: Dict[int, str] = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        max_in_flight: int = 2 * workers
+        in_flight: Set[concurrent.futures.Future] = set()
+        batch: List[_RawPage] = []
+        redirects: List[Tuple[str, str]] = []
+
+        def drain(limit: int) -> None:
+            nonlocal in_flight
+            while len(in_flight) > limit:
+                done, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    db.executemany('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)', future.result())
+
+        for item in iter_dump(dump_path, namespaces):
+            if isinstance(item, _RawPage):
+                batch.append(item)
+                if len(batch) >= PARSE_BATCH_SIZE:
+                    # Backpressure: no leemos mas del dump hasta que el pool se libere
+                    drain(max_in_flight - 1)
+                    in_flight.add(executor.submit(_parse_batch, batch, dict(namespaces)))
+                    batch = []
+            else:
+                redirects.append((normalize_title(item[0]), item[1]))
+                if len(redirects) >= INSERT_BATCH_SIZE:
+                    db.executemany('INSERT OR REPLACE INTO redirects VALUES (?, ?)', redirects)
+                    redirects = []
+
+        if batch:
+            in_flight.add(executor.submit(_parse_batch, batch, dict(namespaces)))
+        drain(0)
+        db.executemany('INSERT OR REPLACE INTO redirects VALUES (?, ?)', redirects)
+
+    has_categorylinks: bool = categorylinks_path is not None
+    if has_categorylinks:
+        rows: List[Tuple[int, str]] = []
+        for row in _iter_categorylinks(categorylinks_path):
+            rows.append(row)
+            if len(rows) >= INSERT_BATCH_SIZE:
+                db.executemany('INSERT INTO categorylinks VALUES (?, ?)', rows)
+                rows = []
+        db.executemany('INSERT INTO categorylinks VALUES (?, ?)', rows)
+        db.execute('CREATE INDEX categorylinks_pageid ON categorylinks (pageid)')
+
+    db.executemany('INSERT INTO meta VALUES (?, ?)', [
+        ('version', str(INDEX_VERSION)),
+        ('category_namespace', namespaces.get(CATEGORY_NAMESPACE, 'Category')),
+        ('has_categorylinks', json.dumps(has_categorylinks)),
+    ])
+    db.commit()
+    db.close()
+
+    # Recien ahora el indice esta completo
+    tmp_path.replace(index_path)
+
+
+class DumpWiki:
+    """
+    Offline stand in for the MediaWiki client, answering from an index built with build_dump_index.
+    Supports page() and the wiki_request queries the importer uses: categories (with clcategories), revisions and
+    links, with title normalization and redirect resolution.
+    """
+    lang: str
+
+    def __init__(self, index_path: str, lang: str = 'en') -> None:
+        if not Path(index_path).exists():
+            raise ValueError(f'Dump index {index_path} not found')
+
+        self.index_path = index_path
+        self.lang = lang
+        # sqlite no permite compartir conexiones entre threads
+        self._local: threading.local = threading.local()
+
+        meta: Dict[str, str] = dict(self._db().execute('SELECT key, value FROM meta').fetchall())
+        if int(meta['version']) != INDEX_VERSION:
+            raise ValueError(f'Unsupported dump index version {meta["version"]}')
+        self.category_prefixes: Set[str] = {'Category', meta['category_namespace']}
+        self.has_categorylinks: bool = json.loads(meta['has_categorylinks'])
+
+    def _db(self) -> sqlite3.Connection:
+        db: Optional[sqlite3.Connection] = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(f'file:{self.index_path}?mode=ro', uri=True)
+        return db
+
+    def _resolve(self, title: str) -> Tuple[str, List[Dict[str, str]], List[Dict[str, str]]]:
+        normalized: List[Dict[str, str]] = []
+        redirects: List[Dict[str, str]] = []
+
+        canonical: str = normalize_title(title)
+        if canonical != title:
+            normalized.append({'from': title, 'to': canonical})
+
+        for _ in range(MAX_REDIRECT_HOPS):
+            row = self._db().execute('SELECT target FROM redirects WHERE title = ?', (canonical,)).fetchone()
+            if row is None:
+                break
+            redirects.append({'from': canonical, 'to': row[0]})
+            canonical = row[0]
+
+        return canonical, normalized, redirects
+
+    def _load(self, title: str) -> Optional[WikiPage]:
+        row = self._db().execute(
+            'SELECT pageid, title, revision_id, content, links, categories FROM pages WHERE title = ?', (title,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        pageid, title, revision_id, content, links, categories = row
+        if self.has_categorylinks:
+            categories = [category for (category,) in self._db().execute('SELECT category FROM categorylinks WHERE pageid = ?', (pageid,))]
+        else:
+            categories = json.loads(categories)
+
+        link_counts: Counter = Counter(json.loads(links))
+        return WikiPage(
+            pageid, title, revision_id, content, sorted(link_counts), sorted(categories),
+            {link: count for link, count in link_counts.items() if count > 1}
+        )
+
+    def _strip_category_prefix(self, category: str) -> str:
+        prefix, sep, rest = category.partition(':')
+        return normalize_title(rest) if sep and prefix in self.category_prefixes else normalize_title(category)
+
+    def page(self, title: str, auto_suggest: bool = False, preload: bool = False) -> WikiPage:
+        canonical, _, _ = self._resolve(title)
+        page: Optional[WikiPage] = self._load(canonical)
+        if page is None:
+            raise PageError(title=title)
+        return page
+
+    def wiki_request(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        props: Set[str] = set(params.get('prop', '').split('|')) - {''}
+        unsupported: Set[str] = props - {'categories', 'revisions', 'links'}
+        if unsupported:
+            raise ValueError(f'Unsupported props on dump source: {unsupported}')
+
+        wanted_categories: Optional[Set[str]] = None
+        if 'clcategories' in params:
+            wanted_categories = {self._strip_category_prefix(category) for category in params['clcategories'].split('|')}
+
+        query: Dict[str, Any] = {'pages': {}}
+        missing_id: int = -1
+        for title in params['titles'].split('|'):
+            canonical, normalized, redirects = self._resolve(title)
+            if normalized:
+                query.setdefault('normalized', []).extend(normalized)
+            if redirects and params.get('redirects'):
+                query.setdefault('redirects', []).extend(redirects)
+            elif redirects:
+                canonical = normalize_title(title)
+
+            page: Optional[WikiPage] = self._load(canonical)
+            if page is None:
+                query['pages'][str(missing_id)] = {'ns': ARTICLE_NAMESPACE, 'title': canonical, 'missing': ''}
+                missing_id -= 1
+                continue
+
+            result: Dict[str, Any] = {'pageid': page.pageid, 'ns': ARTICLE_NAMESPACE, 'title': page.title}
+            if 'categories' in props:
+                categories: List[str] = [category for category in page.categories if wanted_categories is None or category in wanted_categories]
+                if categories:
+                    result['categories'] = [{'ns': CATEGORY_NAMESPACE, 'title': 'Category:' + category} for category in categories]
+            if 'revisions' in props:
+                result['revisions'] = [{'revid': page.revision_id}]
+            if 'links' in props and page.links:
+                result['links'] = [{'ns': ARTICLE_NAMESPACE, 'title': link} for link in page.links]
+
+            query['pages'][str(page.pageid)] = result
+
+        return {'batchcomplete': '', 'query': query}
@@ -1,173 +1,742 @@
 import concurrent.futures
 import itertools
-from collections import deque
-import time
-from typing import Optional, Dict, Deque, List, Iterator, Any, Tuple
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
 
 from mediawiki import MediaWiki, MediaWikiPage, PageError, DisambiguationError
 
 import dependencies.databases
 from dependencies.settings import settings
-from models import ImportArticleNode, ImportSummary
-from repositories.elastic_repo import ElasticRepository
-from repositories.neo4j_repo import Neo4jRepository
+from import_checkpoint import ImportState, ImportCheckpointer, load_checkpoint
+from import_pipeline import FetchStage, ImportWriters, StageCounter
+from import_progress import ImportMonitor, ImportCancelledError
+from metrics import import_api_errors_total, import_api_request_seconds, import_nodes_total, timed
+from compact_state import ImportLevel, MAX_DIST
+from models import ImportSummary, WikiPage
+from repositories.elastic_repo import ElasticRepository, ElasticBulkIndexer
+from repositories.neo4j_repo import Neo4jRepository, Neo4jBulkWriter
+from wikipedia_cache import CachedMediaWiki, DiskResponseCache
+from wikipedia_async import AsyncMediaWiki, AsyncWikiRunner
+from wikipedia_dump import DumpWiki, build_dump_index, parse_wikitext
 
 INVALID_LINK: int = -1
 MAX_CATEGORIES: int = 49
 MAX_LINKS_PER_CATEGORY_FILTER_REQ: int = 49  # Un changui
+MAX_TITLES_PER_REQ: int = 50                 # Maximo de la API para usuarios comunes
+MAX_ALIAS_HOPS: int = 4                      # normalized -> redirect -> ... Nunca deberian ser mas de 2
 WIKIPEDIA_USER_AGENT: str = 'neo_elastic_scraper; tbrandy@itba.edu.ar'
-
-# Filtra links invalidos
-def _link_filter_request(wikipedia: MediaWiki, links: Iterator[str], categories: List[str], executor: concurrent.futures.ThreadPoolExecutor) -> Tuple[List[str], List[concurrent.futures.Future]]:
-    params: Dict[str, Any] = {
+DUMP_INDEX_SUFFIX: str = '.index.sqlite'
+
+# De donde sacamos los articulos: la API de Wikipedia (sincronica o asincronica) o un dump local
+WikiSource = Union[MediaWiki, AsyncWikiRunner, DumpWiki]
+
+def _canonical_title(aliases: Dict[str, str], title: str) -> str:
+    for _ in range(MAX_ALIAS_HOPS):
+        alias: Optional[str] = aliases.get(title, None)
+        if alias is None or alias == title:
+            break
+        title = alias
+    return title
+
+# Parametros del pedido que filtra links invalidos
+def _link_filter_params(links: List[str], categories: List[str]) -> Dict[str, Any]:
+    return {
         'action': 'query',
         'prop': 'categories',
         'redirects': True,
         'format': 'json',
-        'cllimit': 1,                           # Cantidad de categorias maximas. Con una alcanza
+        # El limite es por request, no por pagina. Con clcategories cada pagina trae a lo sumo las categorias pedidas.
+        'cllimit': 'max',
         'titles': '|'.join(links),              # Paginas a buscar
         'clcategories': '|'.join(categories)    # Categorias que debe tener la pagina (alguna de ellas)
     }
-    response: Dict[str, Any] = wikipedia.wiki_request(params)
-    pages: List[Dict[str, Any]] = response['query']['pages'].values()
-
-    invalid_links: List[str] = []
-    link_request_futures: List[concurrent.futures.Future] = []
-
-    for page in pages:
-        # Si posee alguna de las categorias, es un link valido. Preparamos el pedido de resolucion.
-        # Sino, es un link invalido. Preparamos para que se agregue al diccionario
-        # Aprovechamos para filtrar paginas invalidas por otras razones (id = 0)
-        if 'categories' in page and page['pageid'] != 0:
-            link_request_futures.append(executor.submit(wikipedia.page, page['title'], auto_suggest=False, preload=True))
-        else:
-            invalid_links.append(page['title'])
 
-    return invalid_links, link_request_futures
+# Devuelve los titulos validos, los invalidos y el mapa de alias (link pedido -> titulo canonico)
+def _parse_link_filter(responses: List[Dict[str, Any]]) -> Tuple[List[str], List[str], Dict[str, str]]:
+    aliases: Dict[str, str] = {}
+    # Las continuaciones repiten las paginas, con las categorias que faltaban
+    page_valid: Dict[str, bool] = {}
+
+    for response in responses:
+        query: Dict[str, Any] = response['query']
+
+        # Wikipedia normaliza los titulos y sigue las redirecciones. Nos guardamos como llegar al titulo canonico
+        for entry in itertools.chain(query.get('normalized', []), query.get('redirects', [])):
+            aliases[entry['from']] = entry['to']
 
-def import_wiki(center_title: str, radius: int, categories: List[str], lang: str = 'en') -> ImportSummary:
+        for page in query['pages'].values():
+            # Si posee alguna de las categorias, es un link valido. Sino, es un link invalido.
+            # Aprovechamos para filtrar paginas invalidas por otras razones (id = 0 o inexistentes)
+            valid: bool = 'categories' in page and page.get('pageid', 0) != 0
+            page_valid[page['title']] = page_valid.get(page['title'], False) or valid
+
+    valid_links: List[str] = [title for title, valid in page_valid.items() if valid]
+    invalid_links: List[str] = [title for title, valid in page_valid.items() if not valid]
+    return valid_links, invalid_links, aliases
+
+# Ultima revision de cada pagina
+def _revisions_params(titles: List[str]) -> Dict[str, Any]:
+    return {
+        'action': 'query',
+        'prop': 'revisions',
+        'rvprop': 'ids',
+        'format': 'json',
+        'titles': '|'.join(titles)
+    }
+
+def _parse_revisions(responses: List[Dict[str, Any]]) -> Dict[str, int]:
+    return {
+        page['title']: page['revisions'][0]['revid']
+        for response in responses for page in response['query']['pages'].values() if 'revisions' in page
+    }
+
+# Links (a articulos) de cada pagina. La API pagina los links de todas las paginas juntos, por eso hay varias respuestas.
+def _links_params(titles: List[str]) -> Dict[str, Any]:
+    return {
+        'action': 'query',
+        'prop': 'links',
+        'plnamespace': 0,
+        'pllimit': 'max',
+        'format': 'json',
+        'titles': '|'.join(titles)
+    }
+
+def _parse_links(responses: List[Dict[str, Any]]) -> Dict[str, List[str]]:
+    links: Dict[str, List[str]] = {}
+    for response in responses:
+        for page in response['query']['pages'].values():
+            if 'missing' not in page:
+                links.setdefault(page['title'], []).extend(link['title'] for link in page.get('links', []))
+    return links
+
+# Todo lo necesario para crear los articulos, de hasta MAX_TITLES_PER_REQ paginas a la vez.
+# El contenido se pide como wikitext (las extracciones en texto plano son de a una pagina por request) y se convierte localmente.
+def _pages_params(titles: List[str]) -> Dict[str, Any]:
+    return {
+        'action': 'query',
+        'prop': 'revisions|links|categories|pageprops',
+        'rvprop': 'ids|content',
+        'rvslots': 'main',
+        'plnamespace': 0,
+        'pllimit': 'max',
+        'cllimit': 'max',
+        'clshow': '!hidden',
+        'ppprop': 'disambiguation',
+        'redirects': True,
+        'format': 'json',
+        'titles': '|'.join(titles)
+    }
+
+# Devuelve titulo canonico -> pagina (None si no existe o es una desambiguacion) y el mapa de alias
+def _parse_pages(responses: List[Dict[str, Any]], namespaces: Dict[int, str]) -> Tuple[Dict[str, Optional[WikiPage]], Dict[str, str]]:
+    aliases: Dict[str, str] = {}
+    raw_pages: Dict[str, Dict[str, Any]] = {}
+
+    # Las continuaciones traen partes de las mismas paginas
+    for response in responses:
+        query: Dict[str, Any] = response['query']
+        for entry in itertools.chain(query.get('normalized', []), query.get('redirects', [])):
+            aliases[entry['from']] = entry['to']
+
+        for partial in query['pages'].values():
+            raw_page: Dict[str, Any] = raw_pages.setdefault(partial['title'], {})
+            for key, value in partial.items():
+                if key in ('links', 'categories'):
+                    raw_page.setdefault(key, []).extend(value)
+                else:
+                    raw_page.setdefault(key, value)
+
+    pages: Dict[str, Optional[WikiPage]] = {}
+    for title, raw_page in raw_pages.items():
+        if raw_page.get('pageid', 0) == 0 or 'revisions' not in raw_page or 'disambiguation' in raw_page.get('pageprops', {}):
+            pages[title] = None
+            continue
+
+        revision: Dict[str, Any] = raw_page['revisions'][0]
+        main_slot: Dict[str, Any] = revision['slots']['main'] if 'slots' in revision else revision
+        content, _, _, wikitext_link_counts = parse_wikitext(main_slot.get('*', main_slot.get('content', '')), namespaces)
+        links: List[str] = sorted(link['title'] for link in raw_page.get('links', []))
+
+        pages[title] = WikiPage(
+            pageid=raw_page['pageid'],
+            title=title,
+            revision_id=revision['revid'],
+            content=content,
+            links=links,
+            # Le sacamos el prefijo 'Category:' (depende del idioma), como hace pymediawiki
+            categories=sorted(category['title'].split(':', 1)[-1] for category in raw_page.get('categories', [])),
+            # Los links de la API incluyen los de templates, que no estan en el wikitext: esos cuentan una vez
+            link_counts={link: wikitext_link_counts[link] for link in links if link in wikitext_link_counts},
+        )
+
+    return pages, aliases
+
+def _namespaces_params() -> Dict[str, Any]:
+    return {'action': 'query', 'meta': 'siteinfo', 'siprop': 'namespaces', 'format': 'json'}
+
+def _parse_namespaces(responses: List[Dict[str, Any]]) -> Dict[int, str]:
+    return {int(key): namespace['*'] for response in responses for key, namespace in response['query']['namespaces'].items()}
+
+# Ejecuta la query y sus continuaciones
+def _query_continued(wikipedia: WikiSource, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+    params = dict(params)
+    responses: List[Dict[str, Any]] = []
+    while True:
+        try:
+            with timed(import_api_request_seconds, client='sync'):
+                response: Dict[str, Any] = wikipedia.wiki_request(dict(params))
+        except Exception:
+            import_api_errors_total.inc(client='sync')
+            raise
+        responses.append(response)
+        if 'continue' not in response:
+            return responses
+        params.update(response['continue'])
+
+
+class _WikiFetcher:
+    """
+    Executes the importer's requests against the wiki source.
+    query() returns a future: the async client runs it in its event loop, so concurrency is bounded by its max in flight
+    requests and not by the amount of threads. The other sources run it in the import thread pool.
+    The pipeline stages get their requests with submit_query() and submit_resolve(), which follow the same rule: with the
+    async client only the parsing of the responses runs outside the event loop, and no thread waits for a request.
+    """
+
+    def __init__(self, wikipedia: WikiSource, executor: concurrent.futures.Executor) -> None:
+        self.wikipedia = wikipedia
+        self.executor = executor
+        self.asynchronous: bool = isinstance(wikipedia, AsyncWikiRunner)
+        # El dump resuelve las paginas localmente, de a una
+        self.batched: bool = not isinstance(wikipedia, DumpWiki)
+        self._namespaces: Optional[Dict[int, str]] = None
+
+    def namespaces(self) -> Dict[int, str]:
+        if self._namespaces is None:
+            self._namespaces = _parse_namespaces(self.query_sync(_namespaces_params()))
+        return self._namespaces
+
+    def query(self, params: Dict[str, Any]) -> 'concurrent.futures.Future[List[Dict[str, Any]]]':
+        if self.asynchronous:
+            return self.wikipedia.submit(self.wikipedia.client.query_continued(params))
+        return self.executor.submit(_query_continued, self.wikipedia, params)
+
+    # Bloquea al thread que la llama hasta tener la respuesta. Solo para el thread del import.
+    def query_sync(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        if self.asynchronous:
+            return self.wikipedia.submit(self.wikipedia.client.query_continued(params)).result()
+        return _query_continued(self.wikipedia, params)
+
+    # Agrega al stage la query, cuyo resultado es parse(respuestas, *args)
+    def submit_query(self, stage: FetchStage, items: int, params: Dict[str, Any], parse: Callable[..., Any], *args) -> None:
+        if self.asynchronous:
+            stage.submit_request(items, lambda: self.query(params), parse, *args)
+        else:
+            stage.submit(items, lambda: parse(_query_continued(self.wikipedia, params), *args))
+
+    # Agrega al stage la resolucion de los titulos, cuyo resultado es el de resolve()
+    def submit_resolve(self, stage: FetchStage, titles: List[str]) -> None:
+        if self.batched:
+            self.submit_query(stage, len(titles), _pages_params(titles), self._resolved, titles)
+        else:
+            stage.submit(len(titles), self.resolve, titles)
+
+    # Solo sin batches (el dump): los demas clientes resuelven las paginas con queries
+    def page(self, title: str) -> Union[MediaWikiPage, WikiPage]:
+        return self.wikipedia.page(title, auto_suggest=False, preload=True)
+
+    # Trae y parsea las paginas. Devuelve cada titulo pedido con su pagina, o None si no existe o es una desambiguacion.
+    def resolve(self, titles: List[str]) -> List[Tuple[str, Optional[Union[MediaWikiPage, WikiPage]]]]:
+        if self.batched:
+            return self._resolved(self.query_sync(_pages_params(titles)), titles)
+
+        try:
+            return [(titles[0], self.page(titles[0]))]
+        except (PageError, DisambiguationError):
+            return [(titles[0], None)]
+
+    # Resuelve una sola pagina
+    def fetch_page(self, title: str) -> Union[MediaWikiPage, WikiPage]:
+        if not self.batched:
+            return self.page(title)
+
+        page: Optional[Union[MediaWikiPage, WikiPage]] = self.resolve([title])[0][1]
+        if page is None:
+            raise PageError(title=title)
+        return page
+
+    def _resolved(self, responses: List[Dict[str, Any]], titles: List[str]) -> List[Tuple[str, Optional[Union[MediaWikiPage, WikiPage]]]]:
+        pages, aliases = _parse_pages(responses, self.namespaces())
+        return [(title, pages.get(_canonical_title(aliases, title), None)) for title in titles]
+
+
+class _LinkFilter:
+    """
+    Link filtering stage: asks, in batches, which links are articles in the import categories.
+    The links of the nodes of the next level are requested while the current level is still being resolved, so when the
+    next level starts most of its links are already filtered. Results are applied by the import thread: invalid links
+    are marked in title_dists, and valid ones kept in valid until the level is prepared.
+    """
+
+    def __init__(self, state: ImportState, fetcher: _WikiFetcher, stage: FetchStage) -> None:
+        self.state = state
+        self.fetcher = fetcher
+        self.stage = stage
+        # Titulos canonicos validos y links ya pedidos (en vuelo o terminados)
+        self.valid: Set[str] = set()
+        self._requested: Set[str] = set()
+        self._batch: List[str] = []
+
+    def request(self, link: str) -> None:
+        if link in self._requested:
+            return
+
+        self._requested.add(link)
+        self._batch.append(link)
+        # Puedo preguntar como maximo por MAX_LINKS_PER_CATEGORY_FILTER_REQ links en un mismo request
+        if len(self._batch) >= MAX_LINKS_PER_CATEGORY_FILTER_REQ:
+            self._submit()
+
+    # Pide los links (desconocidos) de un nodo del siguiente nivel, si ese nivel va a necesitar filtrarlos
+    def prefetch(self, links: List[str]) -> None:
+        state: ImportState = self.state
+        if state.current_dist + 1 >= state.radius:
+            return
+
+        for link in links:
+            link = _canonical_title(state.title_alias_dict, link)
+            # Los titulos pendientes del nivel actual ya se filtraron
+            if state.title_dists.get(link, None) is None and (state.title_linkers is None or link not in state.title_linkers):
+                self.request(link)
+
+    def apply_completed(self, wait: bool = False) -> None:
+        for future in self.stage.completed(wait):
+            valid_links, invalid_links, aliases = future.result()
+            _add_aliases(self.state, aliases)
+            self.valid.update(valid_links)
+
+            # Marcamos los links invalidos
+            for link in invalid_links:
+                self.state.title_dists[link] = INVALID_LINK
+
+    # Espera el resultado de todos los links pedidos
+    def finish(self) -> None:
+        if self._batch:
+            self._submit()
+        while self.stage.pending:
+            self.apply_completed(wait=True)
+
+    def reset(self) -> None:
+        self.valid = set()
+        self._requested = set()
+
+    def _submit(self) -> None:
+        batch: List[str] = self._batch
+        self._batch = []
+        self.fetcher.submit_query(self.stage, len(batch), _link_filter_params(batch, self.state.categories), _parse_link_filter)
+
+def _batches(titles: List[str], size: int) -> List[List[str]]:
+    return [titles[i:i + size] for i in range(0, len(titles), size)]
+
+def _open_wikipedia(lang: str, dump_path: Optional[str] = None) -> WikiSource:
+    if dump_path is not None:
+        # La primera vez se indexa el dump. Los imports siguientes sobre el mismo dump reutilizan el indice.
+        index_path: str = dump_path + DUMP_INDEX_SUFFIX
+        if not Path(index_path).exists():
+            build_dump_index(dump_path, index_path, settings.wiki_import_dump_categorylinks, settings.wiki_import_dump_workers)
+        return DumpWiki(index_path, lang)
+
+    # Sin directorio de cache configurado, vamos directo a la API
+    cache: Optional[DiskResponseCache] = None
+    if settings.wiki_import_cache_dir is not None:
+        cache = DiskResponseCache(settings.wiki_import_cache_dir, settings.wiki_import_cache_max_bytes)
+    elif settings.wiki_import_offline:
+        raise ValueError('Offline import requires a cache directory')
+
+    if settings.wiki_import_async:
+        return AsyncWikiRunner(AsyncMediaWiki(
+            lang, WIKIPEDIA_USER_AGENT, settings.wiki_import_max_in_flight, settings.wiki_import_connections_per_host,
+            settings.wiki_import_api_url, cache, settings.wiki_import_offline
+        ))
+
+    kwargs: Dict[str, Any] = {'lang': lang, 'user_agent': WIKIPEDIA_USER_AGENT}
+    if settings.wiki_import_api_url is not None:
+        kwargs['url'] = settings.wiki_import_api_url
+
+    if cache is None:
+        return MediaWiki(**kwargs)
+    return CachedMediaWiki(cache, settings.wiki_import_offline, **kwargs)
+
+def import_wiki(center_title: str, radius: int, categories: List[str], lang: str = 'en', incremental: bool = False,
+                dump_path: Optional[str] = None, monitor: Optional[ImportMonitor] = None) -> ImportSummary:
+    """
+    Imports every article in the given categories up to radius links away from the center article.
+    If incremental is True, the databases aren't truncated: only new articles and articles whose revision changed since the
+    last import are fetched and written again, and articles that are no longer reachable are deleted.
+    If dump_path is given, articles are read from that local pages-articles XML dump instead of the Wikipedia API.
+    Progress is reported to monitor (by default, to stdout). If it is cancelled, ImportCancelledError is raised once
+    everything imported so far is written and checkpointed.
+    """
     if len(categories) > MAX_CATEGORIES or len(categories) == 0:
         raise ValueError(f'Max filtering categories on import is {MAX_CATEGORIES}')
-
-    # Logging variables
-    start_time = time.time()
-    total_nodes: int = 0
-    total_relationships: int = 0
+    if radius >= MAX_DIST:
+        raise ValueError(f'Max import radius is {MAX_DIST - 1}')
 
     # Normalizo las categorias
     categories = ['Category:' + cat for cat in categories]
 
-    wikipedia: MediaWiki = MediaWiki(lang=lang, user_agent=WIKIPEDIA_USER_AGENT)
+    state: ImportState = ImportState(
+        center_title, radius, categories, lang, incremental=incremental, dump_path=dump_path,
+        links_memory_bytes=settings.wiki_import_links_memory_bytes
+    )
+    return _run_import(state, fresh=True, monitor=monitor)
+
+def resume_import(checkpoint_path: Optional[str] = None, monitor: Optional[ImportMonitor] = None) -> ImportSummary:
+    """
+    Continues the import saved in the checkpoint file (by default the configured one).
+    Nodes and relationships persisted before the checkpoint are neither fetched nor written again.
+    """
+    checkpoint_path = checkpoint_path or settings.wiki_import_checkpoint_file
+    if checkpoint_path is None:
+        raise ValueError('No import checkpoint file configured')
+
+    state: ImportState = load_checkpoint(checkpoint_path, settings.wiki_import_links_memory_bytes)
+    return _run_import(state, fresh=False, checkpoint_path=checkpoint_path, monitor=monitor)
+
+def _run_import(state: ImportState, fresh: bool, checkpoint_path: Optional[str] = None, monitor: Optional[ImportMonitor] = None) -> ImportSummary:
+    monitor = monitor or ImportMonitor(settings.wiki_import_progress_seconds)
+    monitor.start(state)
+
+    wikipedia: WikiSource = _open_wikipedia(state.lang, state.dump_path)
+    try:
+        return _import(wikipedia, state, fresh, checkpoint_path or settings.wiki_import_checkpoint_file, monitor)
+    finally:
+        state.close()
+        if isinstance(wikipedia, AsyncWikiRunner):
+            wikipedia.close()
+
+def _import(wikipedia: WikiSource, state: ImportState, fresh: bool, checkpoint_path: Optional[str], monitor: ImportMonitor) -> ImportSummary:
     es: ElasticRepository = dependencies.databases.es_instance()
     neo: Neo4jRepository = dependencies.databases.neo_instance()
 
-    # Utilizamos cola pues BFS
-    node_q: Deque[ImportArticleNode] = deque()
-    # La distancia al centro de cada nodo. INVALID_LINK significa que es un nodo invalido.
-    title_dist_dict: Dict[str, int] = {}
-
-    # Buscamos y creamos nodo centro
-    center_page: MediaWikiPage = wikipedia.page(center_title, auto_suggest=False, preload=True)
-    center_node: ImportArticleNode = ImportArticleNode(int(center_page.pageid), center_page.title, center_page.links)
-
-    # Utilizamos una sola sesion de neo para el proceso de importacion
-    with neo.session() as neo_session:
-        # Truncamos las bases antes del import
-        neo.truncate_db(neo_session)
-        es.truncate_db()
-
-        # Cargamos centro en las db
-        neo.create_article(center_node.id, center_node.title, center_page.categories)
-        es.create_article(center_node.id, center_node.title, center_page.content, center_page.categories)
-
-        title_dist_dict[center_page.title] = 0
-        node_q.append(center_node)
-        total_nodes += 1
-
-        # Recorrido BFS para poder saber la distancia al centro de cada nodo
-        while node_q:
-            current_node: ImportArticleNode = node_q.popleft()
-            current_dist: int = title_dist_dict[current_node.title]  # Distancia del nodo al centro
-
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-
-                # Calculamos que links ya resolvimos y creamos, y cuales necesitamos resolver/crear
-                links_needing_request: List[str] = []
-                for link in current_node.links:
-                    dist: Optional[int] = title_dist_dict.get(link, None)
-
-                    # Si no esta en el mapa, todavia no calculamos este link. Hay que calcularlo y guardarlo.
-                    if dist is None:
-                        # Si el nodo anterior estaba al borde del grafo, entonces no hay que crear nada, pues sino nos pasamos del radio
-                        if current_dist < radius:
-                            links_needing_request.append(link)
-
-                    else:
-                        # El nodo ya existia -> solo creo la relacion y listo. No queremos links invalidos ni autoreferencias
-                        if dist != INVALID_LINK and current_node.title != link:
-                            neo.link_article(current_node.id, link, neo_session)
-                            total_relationships += 1
-
-                # Preparamos los request para filtrar los links por categoria (y invalidos)
-                link_filter_request_futures: List[concurrent.futures.Future] = []
-                for i in range(0, len(links_needing_request), MAX_LINKS_PER_CATEGORY_FILTER_REQ):
-                    # Puedo preguntar como maximo por MAX_LINKS_PER_CATEGORY_FILTER_REQ links en un mismo request
-                    link_filter_request_futures.append(
-                        executor.submit(_link_filter_request, wikipedia, itertools.islice(links_needing_request, i, i + MAX_LINKS_PER_CATEGORY_FILTER_REQ), categories, executor)
-                    )
-
-                # Ejecutamos los request de filtrado y preparamos a partir de ellos los request de resolucion de links validos
-                links_resolution_futures: List[concurrent.futures.Future] = []
-                for future in concurrent.futures.as_completed(link_filter_request_futures):
-                    invalid_links: List[str]
-                    partial_links_resolution_futures: List[concurrent.futures.Future]
-                    invalid_links, partial_links_resolution_futures = future.result()
-
-                    # Guardamos los links invalidos en el dict
-                    for link in invalid_links:
-                        title_dist_dict[link] = INVALID_LINK
-
-                    links_resolution_futures.extend(partial_links_resolution_futures)
-
-                # Ejecutamos los request de resolcuion de links validos (al fin!)
-                for future in concurrent.futures.as_completed(links_resolution_futures):
-                    try:
-                        page: MediaWikiPage = future.result()
-                    except (PageError, DisambiguationError) as e:
-                        # Link no encontrado -> Informamos y se current_node_count: int = 0guimos adelante
-                        print(f'Couldn\'t find link {e.title} - Ignoring page from now on')
-                        title_dist_dict[e.title] = INVALID_LINK
-                        continue
-
-                    # pageid viene como str!
-                    pageid: int = int(page.pageid)
-
-                    if page.title in title_dist_dict:
-                        # Si esta en el dict, entonces ya lo habiamos calculado, no deberiamos estar aca. No deberia pasar, pero pasa (???
-                        continue
-
-                    # Creo nodo y relacion en neo
-                    if not neo.create_and_link_article(current_node.id, pageid, page.title, page.categories, neo_session):
-                        raise Exception('Un nodo que pense que tenia que crear, ya esta creado')
-
-                    # Creo articulo en elastic
-                    es.create_article(pageid, page.title, page.content, page.categories)
-
-                    # Pongo el nuevo nodo en las estructuras
-                    title_dist_dict[page.title] = current_dist + 1
-                    node_q.append(ImportArticleNode(pageid, page.title, page.links))
-
-                    total_nodes += 1
-                    total_relationships += 1
-                    print(f'Total time: {int(time.time() - start_time)}. Total nodes: {total_nodes}. Total relations: {total_relationships}. New node: ({current_node.title})-->({page.title})')
-
-    return ImportSummary(total_nodes=total_nodes, total_relationships=total_relationships, seconds_elapsed=(time.time() - start_time))
+    # Utilizamos una sola sesion de neo y un solo pool de workers, compartido por los stages que hacen requests
+    workers: int = settings.wiki_import_filter_concurrency + settings.wiki_import_resolve_concurrency
+    with neo.session() as neo_session, concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        fetcher: _WikiFetcher = _WikiFetcher(wikipedia, executor)
+        if fetcher.batched:
+            # La resolucion los necesita y puede correr en el event loop, donde no se pueden pedir. Los pedimos antes, una sola vez.
+            fetcher.namespaces()
+
+        # Con el cliente asincronico los requests no ocupan threads: el limite de requests simultaneos es el de su event loop
+        filter_concurrency: int = settings.wiki_import_max_in_flight if fetcher.asynchronous else settings.wiki_import_filter_concurrency
+        resolve_concurrency: int = settings.wiki_import_max_in_flight if fetcher.asynchronous else settings.wiki_import_resolve_concurrency
+        link_filter: _LinkFilter = _LinkFilter(state, fetcher, FetchStage('link_filter', executor, filter_concurrency))
+        resolve_stage: FetchStage = FetchStage('page_resolution', executor, resolve_concurrency)
+
+        center_page: Optional[Union[MediaWikiPage, WikiPage]] = None
+        if fresh:
+            # Buscamos nodo centro
+            center_page = fetcher.fetch_page(state.center_title)
+
+        if fresh and state.incremental:
+            # Nos guardamos que habia antes, para saber que cambio
+            state.previous_articles = neo.get_article_revisions()
+        elif fresh:
+            # Truncamos las bases antes del import
+            neo.truncate_db(neo_session)
+            es.truncate_db()
+
+        # Las escrituras a las db se acumulan y se escriben por lotes, cada base desde su propio stage.
+        # Al salir se escribe el ultimo lote parcial.
+        neo_writer: Neo4jBulkWriter
+        es_indexer: ElasticBulkIndexer
+        writers: ImportWriters
+        with neo.bulk_writer(neo_session, settings.wiki_import_neo_batch_size, settings.wiki_import_neo_flush_seconds) as neo_writer, \
+                es.bulk_indexer(settings.wiki_import_es_chunk_size, settings.wiki_import_es_max_chunk_bytes, state.es_settings) as es_indexer, \
+                ImportWriters(neo_writer, es_indexer, settings.wiki_import_neo_queue_size, settings.wiki_import_es_queue_size) as writers:
+
+            def flush() -> None:
+                writers.flush()
+                state.failed_documents.extend(es_indexer.failures)
+                es_indexer.failures.clear()
+
+            state.es_settings = es_indexer.original_settings
+            checkpointer: ImportCheckpointer = ImportCheckpointer(checkpoint_path, settings.wiki_import_checkpoint_seconds, flush, state.seconds_elapsed)
+
+            if fresh:
+                # Cargamos centro en las db
+                center_id: int = int(center_page.pageid)
+                center_revision: int = int(center_page.revision_id)
+                if _is_unchanged(state, center_page.title, center_revision):
+                    # No se vuelve a escribir, pero el centro puede ser otro
+                    state.unchanged_titles.add(state.titles.intern_title(center_page.title))
+                    writers.set_center_dist(center_id, 0)
+                else:
+                    writers.create_article(center_id, center_page.title, center_page.content, center_page.categories, center_revision, state.incremental, 0)
+
+                state.title_dists[center_page.title] = 0
+                state.frontier.append(center_id, center_page.title, center_page.links, _link_counts(center_page))
+                state.total_nodes += 1
+                import_nodes_total.inc()
+                checkpointer.checkpoint(state)
+
+            # Recorrido BFS por niveles para poder saber la distancia al centro de cada nodo.
+            try:
+                while state.frontier:
+                    monitor.check_cancelled()
+                    if state.title_linkers is None:
+                        state.title_linkers = _prepare_level(state, link_filter, writers)
+                        checkpointer.checkpoint(state)
+
+                    _resolve_level(state, fetcher, resolve_stage, link_filter, writers, checkpointer, monitor)
+
+                    state.advance_level()
+                    checkpointer.checkpoint(state)
+            except ImportCancelledError:
+                # Escribimos lo importado hasta ahora y lo guardamos, para poder continuar el import
+                flush()
+                checkpointer.checkpoint(state)
+                monitor.report(state, len(state.title_linkers or {}), force=True)
+                raise
+            finally:
+                # Si no vamos a seguir, no tiene sentido esperar los requests pendientes
+                resolve_stage.cancel()
+                link_filter.stage.cancel()
+
+            flush()
+
+        deleted_nodes: int = 0
+        if state.incremental:
+            # Borramos los articulos que ya no estan dentro del radio o de las categorias
+            deleted_nodes = _delete_unreachable(state, neo, es, neo_session)
+
+    # El import termino, el checkpoint ya no sirve
+    checkpointer.finish()
+    checkpointer.update_elapsed(state)
+    monitor.report(state, 0, force=True)
+
+    counters: List[StageCounter] = [link_filter.stage.counter, resolve_stage.counter] + writers.counters()
+    return ImportSummary(
+        total_nodes=state.total_nodes, total_relationships=state.total_relationships, seconds_elapsed=state.seconds_elapsed,
+        failed_documents=state.failed_documents, missing_pages=state.missing_pages, unchanged_nodes=len(state.unchanged_titles), deleted_nodes=deleted_nodes,
+        stages={counter.name: counter.stats() for counter in counters}
+    )
+
+def _is_unchanged(state: ImportState, title: str, revision_id: int) -> bool:
+    return state.incremental and title in state.previous_articles and state.previous_articles[title][1] == revision_id
+
+# pymediawiki no trae la cantidad de referencias de cada link
+def _link_counts(page: Union[MediaWikiPage, WikiPage]) -> Dict[str, int]:
+    return getattr(page, 'link_counts', {})
+
+# Los nodos de la frontera que referencian a un titulo aparecen una vez por referencia, ordenados.
+# Devuelve cada nodo con su cantidad de referencias.
+def _linker_counts(linkers: List[int]) -> List[Tuple[int, int]]:
+    return [(i, len(list(group))) for i, group in itertools.groupby(linkers)]
+
+# En un import incremental, las relaciones entre articulos que no cambiaron ya existen
+def _needs_link(state: ImportState, source_title: str, dest_title: str) -> bool:
+    return not state.incremental or source_title not in state.unchanged_titles or dest_title not in state.previous_articles
+
+def _delete_unreachable(state: ImportState, neo: Neo4jRepository, es: ElasticRepository, neo_session) -> int:
+    unreachable: List[Tuple[int, str]] = [
+        (article_id, title) for title, (article_id, _) in state.previous_articles.items()
+        if state.title_dists.get(title, INVALID_LINK) == INVALID_LINK
+    ]
+    if not unreachable:
+        return 0
+
+    deleted_ids: List[int] = neo.delete_articles(unreachable, neo_session)
+    es.delete_articles(deleted_ids)
+    return len(deleted_ids)
+
+# Los alias se guardan con los titulos de la tabla, para no duplicarlos
+def _add_aliases(state: ImportState, aliases: Dict[str, str]) -> None:
+    for alias, title in aliases.items():
+        state.title_alias_dict[state.titles.intern_title(alias)] = state.titles.intern_title(title)
+
+# Crea las relaciones de la frontera a nodos conocidos y filtra los links desconocidos.
+# Devuelve los titulos validos que hay que resolver -> indices de los nodos de la frontera que los referencian (en orden BFS).
+def _prepare_level(state: ImportState, link_filter: _LinkFilter, writers: ImportWriters) -> Dict[str, List[int]]:
+    frontier: ImportLevel = state.frontier
+
+    # Link sin resolver -> indices de los nodos de la frontera que lo referencian, una vez por referencia
+    pending_links: Dict[str, List[int]] = {}
+
+    # Calculamos que links ya resolvimos y creamos, y cuales necesitamos resolver/crear
+    for i in range(len(frontier)):
+        node_title: str = frontier.title(i)
+        # Referencias a nodos ya creados. Distintos alias de un mismo articulo suman a la misma relacion.
+        known_links: Dict[str, int] = {}
+        for link, count in frontier.node_links(i):
+            link = _canonical_title(state.title_alias_dict, link)
+            dist: Optional[int] = state.title_dists.get(link, None)
+
+            # Si no esta en el mapa, todavia no calculamos este link. Hay que calcularlo y guardarlo.
+            if dist is None:
+                # Si la frontera esta al borde del grafo, entonces no hay que crear nada, pues sino nos pasamos del radio
+                if state.current_dist < state.radius:
+                    pending_links.setdefault(link, []).extend([i] * count)
+
+            # El nodo ya existia -> solo creo la relacion y listo. No queremos links invalidos ni autoreferencias
+            elif dist != INVALID_LINK and node_title != link:
+                known_links[link] = known_links.get(link, 0) + count
+
+        for link, count in known_links.items():
+            if _needs_link(state, node_title, link):
+                writers.link_article(frontier.article_id(i), link, count)
+            state.total_relationships += 1
+
+    # Filtramos por categoria (e invalidos) los links que no se filtraron mientras se resolvia el nivel anterior
+    for link in pending_links:
+        link_filter.request(link)
+    link_filter.finish()
+
+    # Agrupamos los nodos que referencian a un mismo articulo a traves de distintos alias
+    title_linkers: Dict[str, List[int]] = {}
+    for link, linkers in pending_links.items():
+        title_linkers.setdefault(state.titles.intern_title(_canonical_title(state.title_alias_dict, link)), []).extend(linkers)
+
+    for title in list(title_linkers):
+        linkers = title_linkers[title] = sorted(title_linkers[title])
+        dist = state.title_dists.get(title, None)
+        if dist is None and title in link_filter.valid:
+            continue
+
+        del title_linkers[title]
+        if dist is not None and dist != INVALID_LINK:
+            # El alias nos lleva a un articulo ya creado -> solo creamos las relaciones
+            for i, count in _linker_counts(linkers):
+                if frontier.title(i) != title:
+                    if _needs_link(state, frontier.title(i), title):
+                        writers.link_article(frontier.article_id(i), title, count)
+                    state.total_relationships += 1
+
+    link_filter.reset()
+    return title_linkers
+
+# Resuelve los titulos pendientes del nivel, creando los nodos del siguiente nivel
+def _resolve_level(state: ImportState, fetcher: _WikiFetcher, resolve_stage: FetchStage, link_filter: _LinkFilter,
+                   writers: ImportWriters, checkpointer: ImportCheckpointer, monitor: ImportMonitor) -> None:
+    title_linkers: Dict[str, List[int]] = state.title_linkers
+    monitor.report(state, len(title_linkers), force=True)
+
+    if state.incremental:
+        # Los articulos que no cambiaron no se vuelven a traer ni a escribir. Solo necesitamos sus links para seguir el BFS.
+        # Su distancia al centro si puede haber cambiado.
+        for title, links in _fetch_unchanged_links(state, fetcher, list(title_linkers)).items():
+            state.unchanged_titles.add(state.titles.intern_title(title))
+            article_id: int = state.previous_articles[title][0]
+            writers.set_center_dist(article_id, state.current_dist + 1)
+            _add_level_node(state, title_linkers.pop(title), article_id, title, links, link_filter, writers)
+
+        checkpointer.maybe_checkpoint(state)
+
+    def process_resolved(wait: bool) -> None:
+        for future in resolve_stage.completed(wait):
+            # Entre paginas el estado es consistente, podemos cortar aca
+            monitor.check_cancelled()
+            _process_resolution(state, future.result(), link_filter, writers, monitor)
+            checkpointer.maybe_checkpoint(state)
+        link_filter.apply_completed()
+
+    # Resolvemos los links validos (al fin!), de a MAX_TITLES_PER_REQ titulos si la fuente lo permite.
+    # Mientras, los links de los nodos nuevos se van filtrando y las escrituras se hacen en sus stages.
+    for batch in _batches(list(title_linkers), MAX_TITLES_PER_REQ if fetcher.batched else 1):
+        fetcher.submit_resolve(resolve_stage, batch)
+        process_resolved(wait=False)
+
+    while resolve_stage.pending:
+        process_resolved(wait=True)
+
+# Crea los nodos de las paginas resueltas por un request, o marca como invalidos los titulos que no existen
+def _process_resolution(state: ImportState, resolved: List[Tuple[str, Optional[Union[MediaWikiPage, WikiPage]]]],
+                        link_filter: _LinkFilter, writers: ImportWriters, monitor: ImportMonitor) -> None:
+    title_linkers: Dict[str, List[int]] = state.title_linkers
+
+    for requested_title, page in resolved:
+        linkers: List[int] = title_linkers.pop(requested_title)
+
+        if page is None:
+            # Link no encontrado -> Lo contamos y seguimos adelante, ignorando la pagina de ahora en mas
+            state.title_dists[requested_title] = INVALID_LINK
+            state.missing_pages += 1
+            monitor.missing_page(requested_title)
+            continue
+
+        _add_resolved_page(state, requested_title, linkers, page, link_filter, writers)
+        monitor.report(state, len(title_linkers))
+
+def _add_resolved_page(state: ImportState, requested_title: str, linkers: List[int], page: Union[MediaWikiPage, WikiPage],
+                       link_filter: _LinkFilter, writers: ImportWriters) -> None:
+    frontier: ImportLevel = state.frontier
+
+    # pageid viene como str!
+    pageid: int = int(page.pageid)
+
+    if page.title != requested_title:
+        _add_aliases(state, {requested_title: page.title})
+
+    dist: Optional[int] = state.title_dists.get(page.title, None)
+    if dist is not None:
+        # Otro alias ya nos habia llevado a este articulo -> solo creamos las relaciones
+        if dist != INVALID_LINK:
+            for i, count in _linker_counts(linkers):
+                if frontier.title(i) != page.title:
+                    if _needs_link(state, frontier.title(i), page.title):
+                        writers.link_article(frontier.article_id(i), page.title, count)
+                    state.total_relationships += 1
+        return
+
+    revision_id: int = int(page.revision_id)
+
+    # Creo nodo en neo y articulo en elastic. El nodo se escribe antes que las relaciones que lo referencian.
+    # Si ya existia (import incremental), se recrean sus links salientes.
+    writers.create_article(pageid, page.title, page.content, page.categories, revision_id, state.incremental, state.current_dist + 1)
+
+    # Pongo el nuevo nodo en las estructuras y creo sus relaciones
+    _add_level_node(state, linkers, pageid, page.title, page.links, link_filter, writers, _link_counts(page))
+
+# Agrega un nodo al siguiente nivel del BFS, con las relaciones desde los nodos de la frontera que lo referencian.
+# Sus links se empiezan a filtrar para el siguiente nivel.
+def _add_level_node(state: ImportState, linkers: List[int], article_id: int, title: str, links: List[str],
+                    link_filter: _LinkFilter, writers: ImportWriters, link_counts: Optional[Dict[str, int]] = None) -> None:
+    linker_counts: List[Tuple[int, int]] = _linker_counts(linkers)
+    for i, count in linker_counts:
+        if _needs_link(state, state.frontier.title(i), title):
+            writers.link_article(state.frontier.article_id(i), title, count)
+
+    state.title_dists[title] = state.current_dist + 1
+    state.next_frontier.append(article_id, title, links, link_counts)
+    link_filter.prefetch(links)
+
+    state.total_nodes += 1
+    import_nodes_total.inc()
+    state.total_relationships += len(linker_counts)
+
+# De los titulos que ya estaban importados, consulta cuales no cambiaron de revision y trae sus links
+def _fetch_unchanged_links(state: ImportState, fetcher: _WikiFetcher, titles: List[str]) -> Dict[str, List[str]]:
+    candidates: List[str] = [title for title in titles if title in state.previous_articles]
+
+    unchanged: List[str] = []
+    revision_futures: List[concurrent.futures.Future] = [fetcher.query(_revisions_params(batch)) for batch in _batches(candidates, MAX_TITLES_PER_REQ)]
+    for future in revision_futures:
+        revisions: Dict[str, int] = _parse_revisions(future.result())
+        unchanged.extend(title for title, revision_id in revisions.items() if _is_unchanged(state, title, revision_id))
+
+    title_links: Dict[str, List[str]] = {}
+    links_futures: List[concurrent.futures.Future] = [fetcher.query(_links_params(batch)) for batch in _batches(unchanged, MAX_TITLES_PER_REQ)]
+    for future in links_futures:
+        title_links.update(_parse_links(future.result()))
+
+    return title_links
 
 
 # Para testear
 if __name__ == '__main__':
     dependencies.databases.neo_open(settings.wiki_neo_ip, settings.wiki_neo_port, settings.wiki_neo_user, settings.wiki_neo_pass, settings.wiki_neo_db)
-    dependencies.databases.es_open(settings.wiki_es_ip, settings.wiki_es_port, settings.wiki_es_user, settings.wiki_es_pass, settings.wiki_es_db)
+    dependencies.databases.es_open(settings.wiki_es_ip, settings.wiki_es_port, settings.wiki_es_user, settings.wiki_es_pass, settings.wiki_es_db,
+                                           settings.wiki_es_embedded_path)
 
     import_wiki("Titanic (1997 film)", 3, ['English-language films'])
 